@@ -1,4 +1,6 @@
 import json
+import time
+import threading
 import urllib
 import xml.etree.ElementTree as ET
 
@@ -27,6 +29,13 @@ class Tabcmd(TableauBase):
         self.user_auth_token = None
         self.tabcmd_config_location = tabcmd_config_location
         self.tabcmd_config_filename = 'tabcmd-session.xml'
+        # Impersonated sessions are reused for this many seconds, which should be less than the server's session
+        # timeout. { (site, username) : (session_id, auth_token, expires_at) }
+        self.user_session_cache_seconds = 1200
+        self.user_session_cache = {}
+        self.user_session_cache_lock = threading.Lock()
+        # (site, username, session_id) currently written into tabcmd-session.xml
+        self.configured_tabcmd_session = None
 
         # Configurable options for the exports
         self.export_pagesize = 'letter'
@@ -81,6 +90,14 @@ class Tabcmd(TableauBase):
 
         return cmd
 
+    @staticmethod
+    def build_export_filename(export_type, filename):
+        # fullpdf still ends with pdf
+        if export_type.lower() == 'fullpdf':
+            return '{}.{}'.format(filename, 'pdf')
+        else:
+            return '{}.{}'.format(filename, export_type.lower())
+
     @staticmethod
     def build_refreshextracts_cmd(project, workbook_or_datasource, content_pretty_name,
                                 incremental=False, workbook_url_name=None):
@@ -130,28 +147,33 @@ class Tabcmd(TableauBase):
         # Kill the password file as soon as it has run.
         os.remove(pw_filename)
 
-    def _set_tabcmd_auth_info_from_repository_for_impersonation(self, username_to_impersonate):
+    # Returns (session_id, auth_token) of the most recent session for the user, without touching any state on self,
+    # so it can be used by several exports at once (see TabcmdExportPool)
+    def get_session_info_from_repository(self, username_to_impersonate):
         # After you create a session, you must query the repository to retrieve the auth_token from it
-        repository = TableauRepository(self.tableau_server_url, self.repository_pw)
+        repository = TableauRepository(self.tableau_server_url, self.repository_pw, use_connection_pool=True)
         cur = repository.query_sessions(username_to_impersonate)
 
         # Did anything return?
         if cur.rowcount > 0:
             first_row = cur.fetchone()
-            self.user_session_id = first_row[0]
+            session_id = first_row[0]
 
             wg_json = first_row[4]
             json_obj = json.loads(wg_json)
-            self.user_auth_token = json_obj["auth_token"]
             cur.close()
+            return session_id, json_obj["auth_token"]
         else:
             raise NoResultsException('There were no sessions found for the username {}'.format(username_to_impersonate))
 
-    def _configure_tabcmd_config_for_user_session(self, user):
-        # tabcmd keeps a session history, stored within its XML configuration file.
-        # Rather than logging into tabcmd again, once there is a session history, we simply substitute in the
-        # impersonated user's info directly into the XML.
-        xml_tree = ET.parse(self.tabcmd_config_location + self.tabcmd_config_filename)
+    def _set_tabcmd_auth_info_from_repository_for_impersonation(self, username_to_impersonate):
+        (self.user_session_id, self.user_auth_token) = self.get_session_info_from_repository(username_to_impersonate)
+
+    # tabcmd keeps a session history, stored within its XML configuration file.
+    # Rather than logging into tabcmd again, once there is a session history, we simply substitute in the
+    # impersonated user's info directly into the XML.
+    def write_tabcmd_config_for_user_session(self, config_filename, user, session_id, auth_token, site):
+        xml_tree = ET.parse(config_filename)
         root = xml_tree.getroot()
 
         for child in root:
@@ -160,23 +182,51 @@ class Tabcmd(TableauBase):
             if child.tag == 'base-url':
                 child.text = self.tableau_server_url
             if child.tag == 'session-id':
-                child.text = self.user_session_id
+                child.text = session_id
             if child.tag == 'authenticity-token':
-                child.text = self.user_auth_token
+                child.text = auth_token
             if child.tag == 'site-prefix':
-                if self.site.lower() != 'default':
-                    child.text = 't/{}'.format(self.site)
+                if site.lower() != 'default':
+                    child.text = 't/{}'.format(site)
                 else:
                     child.text = None
-        xml_tree.write(self.tabcmd_config_location + self.tabcmd_config_filename, encoding='UTF8',
-                       xml_declaration=True, default_namespace=None
-                       )
+        xml_tree.write(config_filename, encoding='UTF8', xml_declaration=True, default_namespace=None)
+
+    def _configure_tabcmd_config_for_user_session(self, user):
+        self.write_tabcmd_config_for_user_session(self.tabcmd_config_location + self.tabcmd_config_filename, user,
+                                                  self.user_session_id, self.user_auth_token, self.site)
+
+    # Returns (session_id, auth_token) for the user on the site. A cached session is used while it hasn't expired,
+    # otherwise a new one is made with a trusted ticket and read back from the repository
+    def get_user_session(self, user, view_location, site):
+        cache_key = (site.lower(), user)
+        with self.user_session_cache_lock:
+            cached_session = self.user_session_cache.get(cache_key)
+        if cached_session is not None and cached_session[2] > time.time():
+            return cached_session[0], cached_session[1]
 
-    def _create_session_and_configure_tabcmd_for_user(self, user, view_location):
         tabhttp = TableauHTTP(self.tableau_server_url)
-        tabhttp.create_trusted_ticket_session(view_location, user, site=self.site)
-        self._set_tabcmd_auth_info_from_repository_for_impersonation(user)
-        self._configure_tabcmd_config_for_user_session(user)
+        tabhttp.create_trusted_ticket_session(view_location, user, site=site)
+        (session_id, auth_token) = self.get_session_info_from_repository(user)
+        with self.user_session_cache_lock:
+            self.user_session_cache[cache_key] = (session_id, auth_token,
+                                                  time.time() + self.user_session_cache_seconds)
+        return session_id, auth_token
+
+    # Drops cached sessions, for example after an export fails because the server ended the session. With no
+    # arguments the whole cache is cleared
+    def invalidate_user_session(self, user=None, site=None):
+        with self.user_session_cache_lock:
+            for (cached_site, cached_user) in self.user_session_cache.keys():
+                if (user is None or cached_user == user) and (site is None or cached_site == site.lower()):
+                    del self.user_session_cache[(cached_site, cached_user)]
+
+    def _create_session_and_configure_tabcmd_for_user(self, user, view_location):
+        (self.user_session_id, self.user_auth_token) = self.get_user_session(user, view_location, self.site)
+        # Consecutive exports as the same user don't need the config rewritten
+        if self.configured_tabcmd_session != (self.site.lower(), user, self.user_session_id):
+            self._configure_tabcmd_config_for_user_session(user)
+            self.configured_tabcmd_session = (self.site.lower(), user, self.user_session_id)
 
     #
     # Methods to use
@@ -193,11 +243,7 @@ class Tabcmd(TableauBase):
             self._create_session_and_configure_tabcmd_for_user(user_to_impersonate, view_location)
 
         directory_cmd = self.build_directory_cmd()
-        # fullpdf still ends with pdf
-        if export_type.lower() == 'fullpdf':
-            saved_filename = '{}.{}'.format(filename, 'pdf')
-        else:
-            saved_filename = '{}.{}'.format(filename, export_type.lower())
+        saved_filename = self.build_export_filename(export_type, filename)
 
         export_cmds = self.build_export_cmd(export_type, saved_filename, view_location, view_filter_map)
 
@@ -207,8 +253,12 @@ class Tabcmd(TableauBase):
         temp_bat.write(export_cmds + "\n")
         temp_bat.close()
 
-        os.system("export.bat")
+        return_code = os.system("export.bat")
         os.remove("export.bat")
+        if return_code != 0 and user_to_impersonate is not None:
+            self.log(u'Export failed with code {}, dropping the cached session for {}'.format(return_code,
+                                                                                              user_to_impersonate))
+            self.invalidate_user_session(user_to_impersonate, self.site)
         full_file_location = self.tabcmd_folder + saved_filename
         self.end_log_block()
         return full_file_location
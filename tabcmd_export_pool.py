@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import uuid
+import shutil
+import subprocess
+import Queue
+from multiprocessing.pool import ThreadPool
+
+from tableau_tools.tableau_base import TableauBase
+from tableau_tools.tableau_exceptions import *
+from tableau_tools import tableau_repository
+
+
+# Runs many tabcmd exports at once, each in its own tabcmd process. tabcmd keeps its session in a single config file,
+# so every worker gets its own directory, and the environment variable tabcmd uses to find its config
+# (config_environment_variable) is pointed at that directory for the worker's processes. Each export writes its own
+# uniquely named script file in the worker directory, rather than the shared export.bat of Tabcmd.create_export.
+# The admin session from the Tabcmd object is copied into each worker's config before every export, and impersonation
+# is then written into that copy only
+class TabcmdExportPool(TableauBase):
+    def __init__(self, tabcmd_obj, working_directory, max_workers=4, logger_obj=None,
+                 config_environment_variable=u'LOCALAPPDATA', config_subdirectory=u'Tableau\\Tabcmd'):
+        super(self.__class__, self).__init__()
+        """
+        :type tabcmd_obj: Tabcmd
+        """
+        self.logger = logger_obj
+        self.log(u'Initializing a TabcmdExportPool object')
+        self.tabcmd = tabcmd_obj
+        self.working_directory = working_directory
+        # Every impersonated export takes a pooled repository connection for its session lookup, and the pool raises
+        # PoolError rather than waiting when it runs out, so there are never more workers than pooled connections
+        if max_workers > tableau_repository.repository_pool_max_connections:
+            self.log(u'Limiting workers to {}, the size of the repository connection pool'.format(
+                tableau_repository.repository_pool_max_connections))
+            max_workers = tableau_repository.repository_pool_max_connections
+        self.max_workers = max_workers
+        self.config_environment_variable = config_environment_variable
+        self.config_subdirectory = config_subdirectory
+        # Worker directories not currently running an export. An export takes one and puts it back when done
+        self.__free_worker_directories = Queue.Queue()
+        for i in xrange(0, max_workers):
+            worker_directory = os.path.join(working_directory, u'tabcmd-worker-{}'.format(i))
+            config_directory = os.path.join(worker_directory, config_subdirectory)
+            if not os.path.isdir(config_directory):
+                os.makedirs(config_directory)
+            self.__free_worker_directories.put(worker_directory)
+
+    # An export job is a dict with the same keys as the arguments of Tabcmd.create_export (export_type,
+    # view_location, view_filter_map, user_to_impersonate, filename), plus site. Everything but view_location is
+    # optional
+    @staticmethod
+    def create_export_job(export_type, view_location, view_filter_map=None, user_to_impersonate=None,
+                          filename=None, site=None):
+        return {u'export_type': export_type, u'view_location': view_location, u'view_filter_map': view_filter_map,
+                u'user_to_impersonate': user_to_impersonate, u'filename': filename, u'site': site}
+
+    # Runs one job on a free worker and returns the job dict with the results added: filename (full path of the
+    # export), return_code, seconds and error. Errors are recorded in the result rather than raised, so one failed
+    # export doesn't stop the rest
+    def run_export_job(self, job):
+        worker_directory = self.__free_worker_directories.get()
+        try:
+            return self.run_export_job_in_worker(job, worker_directory)
+        finally:
+            self.__free_worker_directories.put(worker_directory)
+
+    def run_export_job_in_worker(self, job, worker_directory):
+        result = dict(job)
+        start_time = time.time()
+        export_type = job.get(u'export_type', u'fullpdf')
+        if self.tabcmd.export_type is not None:
+            export_type = self.tabcmd.export_type
+        site = job.get(u'site')
+        if site is None:
+            site = self.tabcmd.site
+        user = job.get(u'user_to_impersonate')
+        filename = job.get(u'filename')
+        if filename is None:
+            filename = u'export-{}'.format(uuid.uuid4().hex)
+        saved_filename = self.tabcmd.build_export_filename(export_type, filename)
+        script_filename = os.path.join(worker_directory, u'export-{}.bat'.format(uuid.uuid4().hex))
+        try:
+            config_filename = os.path.join(worker_directory, self.config_subdirectory,
+                                           self.tabcmd.tabcmd_config_filename)
+            shutil.copyfile(self.tabcmd.tabcmd_config_location + self.tabcmd.tabcmd_config_filename,
+                            config_filename)
+            if user is not None:
+                (session_id, auth_token) = self.tabcmd.get_user_session(user, job[u'view_location'], site)
+                self.tabcmd.write_tabcmd_config_for_user_session(config_filename, user, session_id, auth_token, site)
+
+            export_cmd = self.tabcmd.build_export_cmd(export_type, saved_filename, job[u'view_location'],
+                                                      job.get(u'view_filter_map'))
+            script_fh = open(script_filename, 'w')
+            script_fh.write(self.tabcmd.build_directory_cmd() + "\n")
+            script_fh.write(export_cmd + "\n")
+            script_fh.close()
+
+            env = dict(os.environ)
+            env[self.config_environment_variable] = worker_directory
+            result[u'return_code'] = subprocess.call(script_filename, shell=True, env=env)
+            result[u'filename'] = self.tabcmd.tabcmd_folder + saved_filename
+            if result[u'return_code'] != 0:
+                result[u'error'] = u'tabcmd exited with code {}'.format(result[u'return_code'])
+                # The session may have ended on the server, so make a new one next time
+                if user is not None:
+                    self.tabcmd.invalidate_user_session(user, site)
+            else:
+                result[u'error'] = None
+        # Repository, HTTP and file errors alike only fail this export, so the results of the others aren't lost
+        except Exception as e:
+            self.log(u'Export of {} for {} failed: {}'.format(job[u'view_location'], user, e))
+            result[u'filename'] = None
+            result[u'return_code'] = None
+            result[u'error'] = unicode(e)
+        finally:
+            if os.path.exists(script_filename):
+                os.remove(script_filename)
+        result[u'seconds'] = round(time.time() - start_time, 3)
+        return result
+
+    # Runs all of the jobs, up to max_workers at a time, and returns the results in the same order as the jobs
+    def run_exports(self, jobs):
+        self.start_log_block()
+        self.log(u'Running {} tabcmd exports with {} workers'.format(len(jobs), self.max_workers))
+        pool = ThreadPool(self.max_workers)
+        try:
+            results = pool.map(self.run_export_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        self.end_log_block()
+        return results
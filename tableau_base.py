@@ -293,6 +293,20 @@ class TableauBase(object):
                 break
             yield data
 
+    # Tableau documents can be passed around as XML strings or as filenames. XML starts with a tag (after an optional
+    # byte order mark and whitespace), which a filename never does. Only looks at the start, so it is cheap on huge
+    # strings
+    @staticmethod
+    def is_xml_string(s):
+        # The BOM is the character U+FEFF in a decoded string but three bytes in an encoded one
+        if isinstance(s, unicode):
+            pattern = u'\ufeff?\\s*<'
+        else:
+            pattern = r'(\xef\xbb\xbf)?\s*<'
+        if re.match(pattern, s) is not None:
+            return True
+        return False
+
     # You must generate a boundary string that is used both in the headers and the generated request that you post.
     # This builds a simple 30 hex digit string
     @staticmethod
@@ -4,3 +4,4 @@ from tableau_datasource_generator import TableauDatasourceGenerator
 from tableau_document import TableauColumns
 from tableau_packaged_file import TableauPackagedFile
 from tableau_workbook import TableauWorkbook
+from connection_rewriter import ConnectionRewriter
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import shutil
+import multiprocessing
+
+from ..tableau_base import TableauBase
+from ..tableau_exceptions import *
+from tableau_connection import TableauConnection
+from tableau_datasource import TableauDatasource
+from tableau_packaged_file import TableauPackagedFile
+from tableau_workbook import TableauWorkbook
+
+
+# Rewrites the connection attributes of many TWB / TWBX / TDS / TDSX files at once, one file per worker process.
+# Rules are plain tuples so they can be sent to the workers:
+#   (attribute, match, replacement, is_regex, connection_type)
+# attribute is one of server, port, dbname or username. A plain rule replaces values equal to match, a regex rule
+# replaces wherever the pattern is found (re.sub). connection_type limits the rule to one connection class, e.g.
+# u'postgres' or u'sqlproxy'. Every <connection> in a datasource is checked, including those inside federated ones.
+# Workbooks are read and written through TableauWorkbook, so only the datasources section is parsed and
+# only changed datasources are serialized; packages copy every other member across without recompressing it.
+# On Windows, rewrite_files() must be called from under an  if __name__ == '__main__':  guard
+class ConnectionRewriter(TableauBase):
+    def __init__(self, logger_obj=None, max_workers=None):
+        super(self.__class__, self).__init__()
+        self.logger = logger_obj
+        self.log(u'Initializing a ConnectionRewriter object')
+        # None means one process per CPU
+        self.max_workers = max_workers
+        self.rules = []
+
+    def add_rule(self, attribute, match, replacement, is_regex=False, connection_type=None):
+        self.start_log_block()
+        if attribute not in connection_rewriter_attributes:
+            self.end_log_block()
+            raise InvalidOptionException(u"attribute must be one of: {}".format(
+                u", ".join(sorted(connection_rewriter_attributes))))
+        # XML attribute values are always strings, so a rule given as add_port_rule(5432, 5433) must be too
+        match = self.to_unicode(match)
+        replacement = self.to_unicode(replacement)
+        # Catch a bad pattern here rather than in every worker
+        if is_regex is True:
+            re.compile(match)
+        self.rules.append((attribute, match, replacement, is_regex, connection_type))
+        self.end_log_block()
+
+    @staticmethod
+    def to_unicode(value):
+        if isinstance(value, str):
+            return value.decode('utf-8')
+        return unicode(value)
+
+    def add_server_rule(self, old_server, new_server, connection_type=None):
+        self.add_rule(u'server', old_server, new_server, connection_type=connection_type)
+
+    def add_port_rule(self, old_port, new_port, connection_type=None):
+        self.add_rule(u'port', old_port, new_port, connection_type=connection_type)
+
+    def add_dbname_rule(self, old_dbname, new_dbname, connection_type=None):
+        self.add_rule(u'dbname', old_dbname, new_dbname, connection_type=connection_type)
+
+    def add_username_rule(self, old_username, new_username, connection_type=None):
+        self.add_rule(u'username', old_username, new_username, connection_type=connection_type)
+
+    # Lists every file in a directory tree that the rewriter can handle
+    @staticmethod
+    def find_document_files(directory):
+        filenames = []
+        for (dir_path, dir_names, file_names) in os.walk(directory):
+            for file_name in file_names:
+                if os.path.splitext(file_name)[1].lower() in connection_rewriter_extensions:
+                    filenames.append(os.path.join(dir_path, file_name))
+        return filenames
+
+    # Without output_directory, files are rewritten in place. With it, every file (changed or not) is written there
+    # under its own name. dry_run only reports what would change and writes nothing.
+    # Returns one report dict per file: { filename, output_filename, changes, change_count, error }, where each
+    # change is { datasource, connection_type, attribute, old_value, new_value }. A file that fails to process
+    # records the error in its report rather than stopping the run
+    def rewrite_files(self, filenames, output_directory=None, dry_run=False):
+        self.start_log_block()
+        filenames = self.to_list(filenames)
+        if output_directory is not None and dry_run is False and not os.path.isdir(output_directory):
+            os.makedirs(output_directory)
+        jobs = []
+        for filename in filenames:
+            jobs.append((filename, self.rules, output_directory, dry_run))
+
+        # Not worth starting processes for a single file
+        if len(jobs) <= 1 or self.max_workers == 1:
+            reports = map(rewrite_document_file, jobs)
+        else:
+            pool = multiprocessing.Pool(processes=self.max_workers)
+            try:
+                reports = pool.map(rewrite_document_file, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        for report in reports:
+            if report[u'error'] is not None:
+                self.log(u'Error rewriting {}: {}'.format(report[u'filename'], report[u'error']))
+            else:
+                self.log(u'{} changes in {}'.format(report[u'change_count'], report[u'filename']))
+        self.end_log_block()
+        return reports
+
+    def rewrite_directory(self, directory, output_directory=None, dry_run=False):
+        return self.rewrite_files(self.find_document_files(directory), output_directory, dry_run)
+
+    # Totals across the reports from rewrite_files()
+    @staticmethod
+    def summarize_reports(reports):
+        summary = {u'files': len(reports), u'files_changed': 0, u'changes': 0, u'errors': 0}
+        for report in reports:
+            if report[u'error'] is not None:
+                summary[u'errors'] += 1
+            elif report[u'change_count'] > 0:
+                summary[u'files_changed'] += 1
+                summary[u'changes'] += report[u'change_count']
+        return summary
+
+
+connection_rewriter_attributes = {u'server': (TableauConnection.get_server, TableauConnection.set_server),
+                                  u'port': (TableauConnection.get_port, TableauConnection.set_port),
+                                  u'dbname': (TableauConnection.get_dbname, TableauConnection.set_dbname),
+                                  u'username': (TableauConnection.get_username, TableauConnection.set_username)}
+
+connection_rewriter_extensions = [u'.twb', u'.twbx', u'.tds', u'.tdsx']
+
+
+# The functions below run in the worker processes, so they live at module level where they can be pickled
+
+def rewrite_document_file(job):
+    (filename, rules, output_directory, dry_run) = job
+    report = {u'filename': filename, u'output_filename': None, u'changes': [], u'change_count': 0, u'error': None}
+    try:
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in connection_rewriter_extensions:
+            raise InvalidOptionException(u'{} is not a TWB, TWBX, TDS or TDSX file'.format(filename))
+        if output_directory is None:
+            output_filename = filename
+        else:
+            output_filename = os.path.join(output_directory, os.path.basename(filename))
+
+        packaged_file = None
+        tableau_file = None
+        if extension in [u'.twbx', u'.tdsx']:
+            packaged_file = TableauPackagedFile(filename)
+            document = packaged_file.get_tableau_object()
+        elif extension == u'.twb':
+            document = TableauWorkbook(filename)
+            tableau_file = document
+        else:
+            document = TableauDatasource(filename)
+
+        if isinstance(document, TableauWorkbook):
+            datasources = document.datasources_list
+        else:
+            datasources = [document]
+        for ds in datasources:
+            ds_changes = apply_connection_rules(ds, rules)
+            if len(ds_changes) > 0:
+                ds.set_modified()
+                report[u'changes'].extend(ds_changes)
+        report[u'change_count'] = len(report[u'changes'])
+
+        if dry_run is False:
+            if report[u'change_count'] > 0:
+                write_document_file(extension, output_filename, document, packaged_file)
+                report[u'output_filename'] = output_filename
+            elif output_filename != filename:
+                shutil.copyfile(filename, output_filename)
+                report[u'output_filename'] = output_filename
+        if packaged_file is not None:
+            packaged_file.zf.close()
+        if tableau_file is not None:
+            tableau_file.close()
+    except Exception as e:
+        report[u'error'] = u'{}: {}'.format(e.__class__.__name__, e)
+    return report
+
+
+def apply_connection_rules(ds, rules):
+    changes = []
+    for connection_xml in ds.xml.getroot().iter(u'connection'):
+        connection = TableauConnection(connection_xml)
+        for (attribute, match, replacement, is_regex, connection_type) in rules:
+            if connection_type is not None and connection.get_connection_type() != connection_type:
+                continue
+            (getter, setter) = connection_rewriter_attributes[attribute]
+            old_value = getter(connection)
+            if old_value is None:
+                continue
+            if is_regex is True:
+                new_value = re.sub(match, replacement, old_value)
+            elif old_value == match:
+                new_value = replacement
+            else:
+                continue
+            if new_value == old_value:
+                continue
+            setter(connection, new_value)
+            changes.append({u'datasource': ds.get_datasource_name(),
+                            u'connection_type': connection.get_connection_type(),
+                            u'attribute': attribute,
+                            u'old_value': old_value,
+                            u'new_value': new_value})
+    return changes
+
+
+# Writes to a temporary file next to the output and renames it over, so the source is never truncated while it is
+# still being read from (an in-place rewrite reads and writes the same file)
+def write_document_file(extension, output_filename, document, packaged_file):
+    (output_base, output_extension) = os.path.splitext(output_filename)
+    # Keeps the extension, which save_new_packaged_file() strips off before adding its own
+    temp_filename = u'{}-rewrite-{}{}'.format(output_base, os.getpid(), output_extension)
+    if packaged_file is not None:
+        temp_filename = packaged_file.save_new_packaged_file(temp_filename)
+    elif extension == u'.twb':
+        document.save_workbook_xml(temp_filename)
+    else:
+        lh = open(temp_filename, 'wb')
+        lh.write(document.get_datasource_xml())
+        lh.close()
+    # Windows won't rename over an existing file
+    if os.name == 'nt' and os.path.exists(output_filename):
+        if isinstance(document, TableauWorkbook):
+            document.close()
+        os.remove(output_filename)
+    os.rename(temp_filename, output_filename)
@@ -9,10 +9,16 @@ class TableauConnection(TableauBase):
     def __init__(self, connection_xml_obj, logger_obj=None):
         self.logger = logger_obj
         self.xml_obj = connection_xml_obj
+        # Set by any of the set_ methods, so unchanged connections can be written back out as-is
+        self.__modified = False
+
+    def is_modified(self):
+        return self.__modified
 
     def set_dbname(self, new_db_name):
         if self.xml_obj.get("dbname") is not None:
             self.xml_obj.attrib["dbname"] = new_db_name
+            self.__modified = True
 
     def get_dbname(self):
         return self.xml_obj.get("dbname")
@@ -20,6 +26,7 @@ class TableauConnection(TableauBase):
     def set_server(self, new_server):
         if self.xml_obj.get("server") is not None:
             self.xml_obj.attrib["server"] = new_server
+            self.__modified = True
 
     def get_server(self):
         return self.xml_obj.get("server")
@@ -27,10 +34,15 @@ class TableauConnection(TableauBase):
     def set_username(self, new_username):
         if self.xml_obj.get("username") is not None:
             self.xml_obj.attrib["username"] = new_username
+            self.__modified = True
+
+    def get_username(self):
+        return self.xml_obj.get("username")
 
     def set_port(self, new_port):
         if self.xml_obj.get("port") is not None:
             self.xml_obj.attrib["port"] = new_port
+            self.__modified = True
 
     def get_port(self):
         return self.xml_obj.get("port")
@@ -41,6 +53,7 @@ class TableauConnection(TableauBase):
     def set_connection_type(self, new_type):
         if self.xml_obj.get("class") is not None:
             self.xml_obj.attrib["class"] = new_type
+            self.__modified = True
 
     def is_published_datasource(self):
         if self.xml_obj.get("class") == 'sqlproxy':
@@ -57,6 +70,7 @@ class TableauConnection(TableauBase):
 
     def set_sslmode(self, value='require'):
         self.xml_obj.attrib["sslmode"] = value
+        self.__modified = True
 
 
 # Represents the repository-location tag present in a published datasource in a workbook
@@ -64,6 +78,10 @@ class TableauRepositoryLocation(TableauBase):
     def __init__(self, repository_xml_obj, logger_obj=None):
         self.logger = logger_obj
         self.xml_obj = repository_xml_obj
+        self.__modified = False
+
+    def is_modified(self):
+        return self.__modified
 
     def get_site(self):
         return self.xml_obj.get("site")
@@ -77,6 +95,7 @@ class TableauRepositoryLocation(TableauBase):
         elif self.xml_obj.get("site") is not None:
             self.xml_obj.attrib["path"] = self.xml_obj.get("path").replace(self.xml_obj.get("site"), new_site_content_url)
         self.xml_obj.attrib['site'] = new_site_content_url
+        self.__modified = True
         self.end_log_block()
 
     def get_xml_string(self):
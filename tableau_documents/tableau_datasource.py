@@ -9,18 +9,39 @@ import zipfile
 import os
 
 
-# Meant to represent a TDS file, does not handle the file opening
+# Meant to represent a TDS file. datasource_string can be the XML, a filename, an open file object, or an already
+# parsed lxml <datasource> element, which is used as-is
 class TableauDatasource(TableauBase):
     def __init__(self, datasource_string, logger_obj=None):
         self.logger = logger_obj
-        self.original_xml_string = datasource_string
-        utf8_parser = etree.XMLParser(encoding='utf-8', recover=True)
-        self.xml = etree.parse(StringIO(datasource_string), parser=utf8_parser)
+        utf8_parser = etree.XMLParser(encoding='utf-8', recover=True, huge_tree=True)
+        if isinstance(datasource_string, etree._Element):
+            self.original_xml_string = None
+            self.xml = etree.ElementTree(datasource_string)
+        # Files and filenames are handed straight to lxml, so the TDS is never read into a Python string
+        elif hasattr(datasource_string, 'read'):
+            self.original_xml_string = None
+            self.xml = etree.parse(datasource_string, parser=utf8_parser)
+        elif not self.is_xml_string(datasource_string):
+            self.log(u"datasource_string is not XML, assuming it is actually a filename")
+            self.original_xml_string = None
+            self.xml = etree.parse(datasource_string, parser=utf8_parser)
+        else:
+            self.original_xml_string = datasource_string
+            self.xml = etree.parse(StringIO(datasource_string), parser=utf8_parser)
         self.parameters = False
+        self.connection = None
+        self.repository_location = None
+        self.tde_filename = None
+        self.__modified = False
+        # A standalone TDS usually only has formatted-name on its root
+        self.ds_name = None
         if self.xml.getroot().get("caption"):
             self.ds_name = self.xml.getroot().attrib["caption"]
         elif self.xml.getroot().get("name"):
             self.ds_name = self.xml.getroot().attrib['name']
+        elif self.xml.getroot().get("formatted-name"):
+            self.ds_name = self.xml.getroot().attrib['formatted-name']
 
         self.columns = None
         # Possible, though unlikely, that there would be no columns
@@ -31,18 +52,16 @@ class TableauDatasource(TableauBase):
         # Internal "Parameters" datasource of a TWB acts differently
         if self.ds_name == u'Parameters':
             self.parameters = True
-            self.ds_generator = TableauParametersGenerator()
+            self.ds_generator = TableauParametersGenerator(self.logger)
         else:
             connection_xml_obj = self.xml.getroot().find(u'connection')
             self.log(u'connection tags found, building a TableauConnection object')
             self.connection = TableauConnection(connection_xml_obj)
 
-            self.repository_location = None
-            if len(self.xml.getroot().find(u'repository-location')) == 0:
-                repository_location_xml = self.xml.getroot().find(u'repository-location')
+            repository_location_xml = self.xml.getroot().find(u'repository-location')
+            if repository_location_xml is not None:
                 self.repository_location = TableauRepositoryLocation(repository_location_xml, self.logger)
 
-            self.tde_filename = None
             if self.connection.get_connection_type() == u'sqlproxy':
                 self.ds_generator = None
             else:
@@ -59,6 +78,27 @@ class TableauDatasource(TableauBase):
         self.end_log_block()
         return name
 
+    # Lets a TableauWorkbook write untouched datasources back out byte for byte. Changes made through this object,
+    # its TableauConnection or its generator are tracked automatically. Handing out the columns object or parameter
+    # elements counts as a change, since they can be edited in place. If you change the lxml directly, call
+    # set_modified() so the change isn't skipped
+    def is_modified(self):
+        if self.__modified is True or self.tde_filename is not None:
+            return True
+        if self.connection is not None and self.connection.is_modified():
+            return True
+        if self.repository_location is not None and self.repository_location.is_modified():
+            return True
+        # Anything queued up in the generator gets appended when the XML is generated
+        if isinstance(self.ds_generator, TableauDatasourceGenerator):
+            if len(self.ds_generator.column_aliases) > 0 or len(self.ds_generator.column_instances) > 0 \
+                    or len(self.ds_generator.datasource_filters) > 0:
+                return True
+        return False
+
+    def set_modified(self):
+        self.__modified = True
+
     def add_extract(self, new_extract_filename):
         self.log(u'add_extract called, chicking if extract exists already')
         # Test to see if extract exists already
@@ -74,37 +114,40 @@ class TableauDatasource(TableauBase):
             self.log(u'Adding extract to the generated data source')
             self.ds_generator.add_extract(self.tde_filename)
 
-    def get_datasource_xml(self):
+    # Leave off the xml_declaration when the datasource is being embedded in a workbook
+    def get_datasource_xml(self, xml_declaration=True):
         # Run through and generate any new sections to be added from the datasource_generator
 
         # Column Mappings
 
-        # Column Aliases
-        cas = self.ds_generator.generate_aliases_column_section()
-        # If there is no existing aliases tag, gotta add one. Unlikely but safety first
-        if len(cas) > 0 and self.xml.getroot().find('aliases') is False:
-            self.xml.append(self.ds_generator.generate_aliases_tag())
-        for c in cas:
-            self.log(u'Appending the column alias XML')
-            self.xml.getroot().append(c)
-        # Column Instances
-        cis = self.ds_generator.generate_column_instances_section()
-        for ci in cis:
-            self.log(u'Appending the column-instances XML')
-            self.xml.append(ci)
-        # Datasource Filters
-        dsf = self.ds_generator.generate_datasource_filters_section()
-        self.log(u'Appending the ds filters to existing XML')
-        for f in dsf:
-            self.xml.getroot().append(f)
-        # Extracts
-        if self.tde_filename is not None:
-            self.log(u'Generating the extract and XML object related to it')
-            extract_xml = self.ds_generator.generate_extract_section()
-            self.log(u'Appending the new extract XML to the existing XML')
-            self.xml.getroot().append(extract_xml)
-
-        xmlstring = etree.tostring(self.xml, pretty_print=True, xml_declaration=True, encoding='utf-8')
+        # Published (sqlproxy) and Parameters datasources have nothing generated to add
+        if isinstance(self.ds_generator, TableauDatasourceGenerator):
+            # Column Aliases
+            cas = self.ds_generator.generate_aliases_column_section()
+            # If there is no existing aliases tag, gotta add one. Unlikely but safety first
+            if len(cas) > 0 and self.xml.getroot().find('aliases') is False:
+                self.xml.append(self.ds_generator.generate_aliases_tag())
+            for c in cas:
+                self.log(u'Appending the column alias XML')
+                self.xml.getroot().append(c)
+            # Column Instances
+            cis = self.ds_generator.generate_column_instances_section()
+            for ci in cis:
+                self.log(u'Appending the column-instances XML')
+                self.xml.append(ci)
+            # Datasource Filters
+            dsf = self.ds_generator.generate_datasource_filters_section()
+            self.log(u'Appending the ds filters to existing XML')
+            for f in dsf:
+                self.xml.getroot().append(f)
+            # Extracts
+            if self.tde_filename is not None:
+                self.log(u'Generating the extract and XML object related to it')
+                extract_xml = self.ds_generator.generate_extract_section()
+                self.log(u'Appending the new extract XML to the existing XML')
+                self.xml.getroot().append(extract_xml)
+
+        xmlstring = etree.tostring(self.xml, pretty_print=True, xml_declaration=xml_declaration, encoding='utf-8')
         self.log(xmlstring)
         return xmlstring
 
@@ -145,6 +188,8 @@ class TableauDatasource(TableauBase):
 
     def get_columns_obj(self):
         self.start_log_block()
+        # The columns can be changed through the returned object, which this object can't see
+        self.__modified = True
         cols = self.columns
         self.end_log_block()
         return cols
@@ -153,9 +198,13 @@ class TableauDatasource(TableauBase):
         self.start_log_block()
         self.columns.set_translation_dict(translation_dict)
         self.columns.translate_captions()
+        self.__modified = True
         self.end_log_block()
 
     # Parameters manipulation methods
     def get_parameter_by_name(self, parameter_name):
-        param_column = self.xml.xpath(u'//t:column[@alias="{}"]'.format(parameter_name), namespaces=self.ns_map)
+        param_column = self.xml.xpath(u'//t:column[@alias = $alias]', namespaces=self.ns_map, alias=parameter_name)
+        # The returned elements can be edited in place
+        if len(param_column) > 0:
+            self.__modified = True
         return param_column
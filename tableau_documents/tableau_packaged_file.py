@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import zipfile
+import struct
+import copy
 import os
-import shutil
 from ..tableau_base import *
 from tableau_datasource import TableauDatasource
 from tableau_workbook import TableauWorkbook
 
 
 # Represents a TWBX or TDSX and allows manipulation of the XML objects inside via their related object
+# Only the zip directory is read when the object is created. The TWB or TDS is parsed the first time
+# get_tableau_object() is called, so listing or republishing a package unchanged never parses it
 class TableauPackagedFile(TableauBase):
     def __init__(self, zip_file_obj, logger_obj=None):
         self.logger = logger_obj
@@ -22,17 +25,13 @@ class TableauPackagedFile(TableauBase):
             # Ignore anything in the subdirectories
             if name.find('/') == -1:
                 if name.endswith('.tds'):
-                    self.log(u'Detected a .TDS file in archive, creating a TableauDatasource object')
+                    self.log(u'Detected a .TDS file in archive')
                     self.type = 'tdsx'
                     self.xml_name = name
-                    tds_file_obj = self.zf.open(self.xml_name)
-                    self.tableau_object = TableauDatasource(tds_file_obj.read(), self.logger)
                 elif name.endswith('.twb'):
-                    self.log(u'Detected a .TWB file in archive, creating a TableauDatasource object')
+                    self.log(u'Detected a .TWB file in archive')
                     self.type = 'twbx'
                     self.xml_name = name
-                    twb_file_obj = self.zf.open(self.xml_name)
-                    self.tableau_object = TableauWorkbook(twb_file_obj.read(), self.logger)
 
             else:
                 self.other_files.append(name)
@@ -45,48 +44,106 @@ class TableauPackagedFile(TableauBase):
 
     def get_tableau_object(self):
         self.start_log_block()
+        if self.tableau_object is None:
+            if self.type == 'tdsx':
+                self.log(u'Creating a TableauDatasource object from {}'.format(self.xml_name))
+                tds_file_obj = self.zf.open(self.xml_name)
+                self.tableau_object = TableauDatasource(tds_file_obj, self.logger)
+                tds_file_obj.close()
+            elif self.type == 'twbx':
+                self.log(u'Creating a TableauWorkbook object from {}'.format(self.xml_name))
+                twb_file_obj = self.zf.open(self.xml_name)
+                self.tableau_object = TableauWorkbook(twb_file_obj, self.logger)
+                twb_file_obj.close()
         obj = self.tableau_object
         self.end_log_block()
         return obj
 
+    # Names of every file in the package, read from the zip directory without opening any of them
+    def get_member_names(self):
+        return self.zf.namelist()
+
+    # Dict of { member name : uncompressed size in bytes }, read from the zip directory without opening any of them
+    def get_member_sizes(self):
+        sizes = {}
+        for zip_info in self.zf.infolist():
+            sizes[zip_info.filename] = zip_info.file_size
+        return sizes
+
     # Appropriate extension added if needed
+    # The new package is written zip to zip: every member other than the TWB or TDS is copied across as its raw
+    # compressed bytes, so nothing is extracted to disk or recompressed. Only the XML is regenerated
     def save_new_packaged_file(self, new_filename_no_extension):
         self.start_log_block()
-        new_filename = new_filename_no_extension.split('.') # simple algorithm to kill extension
+        new_filename = os.path.splitext(new_filename_no_extension)[0]  # kill any extension
 
-        # Save the object down
         if self.type == 'twbx':
-            save_filename = new_filename[0] + '.twbx'
-            new_zf = zipfile.ZipFile(save_filename, 'w')
-            self.log(u'Creating temporary XML file {}'.format(self.xml_name))
-            self.tableau_object.save_workbook_xml(self.xml_name)
-            new_zf.write(self.xml_name)
-            os.remove(self.xml_name)
-        elif self.type == 'tdsx':
-            save_filename = new_filename[0] + '.tdsx'
-            new_zf = zipfile.ZipFile(save_filename, 'w')
-            self.log(u'Creating temporary XML file {}'.format(self.xml_name))
-            self.tableau_object.save_datasource_xml(self.xml_name)
-            new_zf.write(self.xml_name)
-            os.remove(self.xml_name)
-            self.log(u'Removed file {}'.format(save_filename))
-
-        temp_directories_to_remove = {}
+            save_filename = new_filename + '.twbx'
+        else:
+            save_filename = new_filename + '.tdsx'
+        new_zf = zipfile.ZipFile(save_filename, 'w', allowZip64=True)
+        original_xml_info = self.zf.getinfo(self.xml_name)
+        # Never parsed or never changed, so the original XML can be copied across like everything else
+        if self.tableau_object is None or self.tableau_object.is_modified() is False:
+            self.log(u'Copying unchanged {} into the new packaged file'.format(self.xml_name))
+            self.copy_zip_member_without_recompressing(self.zf, new_zf, original_xml_info)
+        else:
+            self.log(u'Writing the XML for {} into the new packaged file'.format(self.xml_name))
+            if self.type == 'twbx':
+                xml_string = self.tableau_object.get_workbook_xml()
+            else:
+                xml_string = self.tableau_object.get_datasource_xml()
+            xml_info = zipfile.ZipInfo(self.xml_name, original_xml_info.date_time)
+            xml_info.compress_type = original_xml_info.compress_type
+            xml_info.external_attr = original_xml_info.external_attr
+            new_zf.writestr(xml_info, xml_string)
+
         for filename in self.other_files:
-            self.log(u'Extracting file {} temporarily'.format(filename))
-            self.zf.extract(filename)
-            new_zf.write(filename)
-            os.remove(filename)
-            self.log(u'Removed file {}'.format(filename))
-            lowest_level = filename.split('/')
-            temp_directories_to_remove[lowest_level[0]] = True
-
-        # Cleanup all the temporary directories
-        for directory in temp_directories_to_remove:
-            shutil.rmtree(directory)
+            self.log(u'Copying file {} into the new packaged file'.format(filename))
+            self.copy_zip_member_without_recompressing(self.zf, new_zf, self.zf.getinfo(filename))
+
         new_zf.close()
         self.zf.close()
 
         # Return the filename so it can be opened from disk by other objects
         self.end_log_block()
-        return save_filename
\ No newline at end of file
+        return save_filename
+
+    # zipfile has no public way to copy a member between archives without decompressing and compressing it again,
+    # so this reads the raw compressed bytes from the source and writes them behind a new local header
+    @staticmethod
+    def copy_zip_member_without_recompressing(source_zf, dest_zf, zip_info, chunk_size=(1024 * 1024 * 10)):
+        source_zf.fp.seek(zip_info.header_offset)
+        file_header = struct.unpack(zipfile.structFileHeader, source_zf.fp.read(zipfile.sizeFileHeader))
+        source_zf.fp.read(file_header[zipfile._FH_FILENAME_LENGTH] + file_header[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+        new_info = copy.copy(zip_info)
+        # CRC and sizes are known, so they go in the header instead of a trailing data descriptor
+        new_info.flag_bits &= ~0x08
+        # Any ZIP64 extra field is rebuilt by zipfile when the header and central directory are written
+        new_info.extra = TableauPackagedFile.remove_zip64_extra_field(zip_info.extra)
+        new_info.header_offset = dest_zf.fp.tell()
+        dest_zf.fp.write(new_info.FileHeader())
+
+        bytes_remaining = zip_info.compress_size
+        while bytes_remaining > 0:
+            data = source_zf.fp.read(min(chunk_size, bytes_remaining))
+            if not data:
+                raise zipfile.BadZipfile(u'Unexpected end of data for {}'.format(zip_info.filename))
+            dest_zf.fp.write(data)
+            bytes_remaining -= len(data)
+
+        dest_zf.filelist.append(new_info)
+        dest_zf.NameToInfo[new_info.filename] = new_info
+        dest_zf._didModify = True
+
+    @staticmethod
+    def remove_zip64_extra_field(extra):
+        new_extra = ''
+        position = 0
+        while position + 4 <= len(extra):
+            (header_id, data_size) = struct.unpack('<HH', extra[position:position + 4])
+            if header_id != 0x0001:
+                new_extra += extra[position:position + 4 + data_size]
+            position += 4 + data_size
+        return new_extra
@@ -2,49 +2,142 @@
 
 from ..tableau_base import *
 from tableau_datasource import TableauDatasource
+from cStringIO import StringIO as ByteStringIO
+import mmap
+import os
 
 
+# wb_string can be the XML of the TWB, a filename, or an open file object. Files are memory-mapped rather than read into
+# a string, so even very large workbooks are never copied onto the Python heap
 class TableauWorkbook(TableauBase):
     def __init__(self, wb_string, logger_obj=None):
         self.logger = logger_obj
         self.log(u'Initializing a TableauWorkbook object')
-        self.wb_string = wb_string
-        if self.wb_string.find('.twb') != -1:
-            self.log(u".twb found in wb_string, assuming it is actually a filename. Opening file")
-            fh = open(self.wb_string, 'rb')
-            self.wb_string = fh.read()
-        self.wb = StringIO(self.wb_string)
-        self.start_xml = ""
-        self.end_xml = ""
+        self.source_filename = None
+        if hasattr(wb_string, 'read'):
+            self.log(u"wb_string is a file object, mapping it into memory")
+            self.wb_string = self.map_file(wb_string)
+        elif not self.is_xml_string(wb_string):
+            self.log(u"wb_string is not XML, assuming it is actually a filename. Opening file")
+            self.source_filename = wb_string
+            fh = open(wb_string, 'rb')
+            self.wb_string = self.map_file(fh)
+            fh.close()
+        else:
+            self.wb_string = wb_string
+        # The parser and the byte offsets work on the encoded bytes
+        if isinstance(self.wb_string, unicode):
+            self.wb_string = self.wb_string.encode('utf-8')
         self.datasources = {}
-        start_flag = True
-        ds_flag = False
-        current_ds = ""
+        # The TableauDatasource objects in the order they appear in the workbook
+        self.datasources_list = []
+        # Byte offsets into wb_string. Everything before ds_inner_start and from ds_inner_end on is never touched
+        self.ds_inner_start = len(self.wb_string)
+        self.ds_inner_end = len(self.wb_string)
+        # (start, end) byte offsets of each datasource in datasources_list, so unchanged ones can be copied as-is
+        self.datasource_ranges = None
 
         if self.logger is not None:
             self.enable_logging(self.logger)
 
-        for line in self.wb:
-            # Start parsing the datasources
-            if start_flag is True and ds_flag is False:
-                self.start_xml += line
-            if start_flag is False and ds_flag is False:
-                self.end_xml += line
-            if ds_flag is True:
-                current_ds += line
-                # Break and load the datasource
-                if line.find(u"</datasource>") != -1:
-                    self.log(u"Building TableauDatasource object")
-                    ds_obj = TableauDatasource(current_ds, logger_obj=self.logger)
-                    self.datasources[ds_obj.get_datasource_name()] = ds_obj
-                    current_ds = ""
-            if line.find(u"<datasources") != -1 and start_flag is True:
-                start_flag = False
-                ds_flag = True
-
-            if line.find(u"</datasources>") != -1 and ds_flag is True:
-                self.end_xml += line
-                ds_flag = False
+        self.load_workbook()
+
+    # Single pass through the workbook with iterparse. Each top-level <datasource> is parsed exactly once and handed
+    # to a TableauDatasource as an element. Parsing stops as soon as the top-level <datasources> tag closes, so the
+    # (usually much larger) worksheets and dashboards that follow are never parsed
+    def load_workbook(self):
+        # Everything up to and including the opening <datasources> tag, and everything from the
+        # closing </datasources> tag on, is written back out from the original bytes
+        ds_region_start = self.wb_string.find('<datasources')
+        if ds_region_start == -1:
+            self.log(u'No datasources found in workbook')
+            return
+        ds_inner_start = self.wb_string.find('>', ds_region_start) + 1
+        # <datasources /> means there is nothing to load
+        if self.wb_string[ds_inner_start - 2] == '/':
+            return
+        self.ds_inner_start = ds_inner_start
+        self.ds_inner_end = self.wb_string.find('</datasources>', ds_inner_start)
+
+        # A mmap can be read from directly, a string needs a file-like wrapper (cStringIO doesn't copy it)
+        if isinstance(self.wb_string, mmap.mmap):
+            self.wb_string.seek(0)
+            parse_source = self.wb_string
+        else:
+            parse_source = ByteStringIO(self.wb_string)
+        depth = 0
+        in_datasources = False
+        for (event, element) in etree.iterparse(parse_source, events=('start', 'end'),
+                                                recover=True, huge_tree=True):
+            if event == 'start':
+                depth += 1
+                if depth == 2 and element.tag == u'datasources':
+                    in_datasources = True
+                continue
+            depth -= 1
+            if in_datasources is True and depth == 2 and element.tag == u'datasource':
+                # Detach so the datasource becomes the root of its own tree
+                element.getparent().remove(element)
+                element.tail = None
+                self.log(u"Building TableauDatasource object")
+                ds_obj = TableauDatasource(element, logger_obj=self.logger)
+                self.datasources[ds_obj.get_datasource_name()] = ds_obj
+                self.datasources_list.append(ds_obj)
+            elif in_datasources is True and depth == 1:
+                break
+            elif depth == 1:
+                # Top-level sections before the datasources aren't needed, free them as we go
+                element.clear()
+
+        ranges = self.find_datasource_ranges()
+        if len(ranges) == len(self.datasources_list):
+            self.datasource_ranges = ranges
+        else:
+            self.log(u'Could not match datasource byte ranges to the parsed datasources, all will be regenerated')
+
+    # Returns a read-only mmap of the file, or its contents if it can't be mapped (e.g. a file inside a zip, or empty)
+    @staticmethod
+    def map_file(file_obj):
+        try:
+            return mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, IOError, ValueError, EnvironmentError):
+            return file_obj.read()
+
+    # Releases the memory mapping (and on Windows the lock on the file). The object can't be saved afterwards
+    def close(self):
+        if isinstance(self.wb_string, mmap.mmap):
+            self.wb_string.close()
+
+    # Finds where each top-level <datasource> starts and ends between ds_inner_start and ds_inner_end
+    def find_datasource_ranges(self):
+        ranges = []
+        position = self.ds_inner_start
+        while True:
+            ds_start = self.wb_string.find('<datasource', position, self.ds_inner_end)
+            if ds_start == -1:
+                break
+            # Skip over things like <datasource-dependencies>
+            if self.wb_string[ds_start + 11] not in ' \t\r\n/>':
+                position = ds_start + 11
+                continue
+            tag_end = self.wb_string.find('>', ds_start, self.ds_inner_end)
+            if self.wb_string[tag_end - 1] == '/':
+                ds_end = tag_end + 1
+            else:
+                ds_end = self.wb_string.find('</datasource>', tag_end, self.ds_inner_end)
+                if ds_end == -1:
+                    break
+                ds_end += len('</datasource>')
+            ranges.append((ds_start, ds_end))
+            position = ds_end
+        return ranges
+
+    # Any datasource changed means the workbook XML has to be rewritten
+    def is_modified(self):
+        for ds in self.datasources_list:
+            if ds.is_modified():
+                return True
+        return False
 
     def get_datasources(self):
         self.start_log_block()
@@ -54,22 +147,66 @@ class TableauWorkbook(TableauBase):
 
     def get_workbook_xml(self):
         self.start_log_block()
-        xml = self.start_xml
-        for ds in self.datasources:
-            self.log(u'Adding in XML from datasource {}'.format(ds))
-            xml += self.datasources.get(ds).get_datasource_xml()
-        xml += self.end_xml
+        xml = ByteStringIO()
+        self.write_workbook_xml(xml)
+        self.end_log_block()
+        return xml.getvalue()
+
+    # Writes the workbook to an open file object. Untouched byte ranges are written straight from the original
+    # buffer without being copied into new strings; only modified datasources are serialized again
+    def write_workbook_xml(self, file_obj, chunk_size=(1024 * 1024 * 10)):
+        self.start_log_block()
+        self.write_buffer_range(file_obj, 0, self.ds_inner_start, chunk_size)
+        if self.datasource_ranges is None:
+            for ds in self.datasources_list:
+                self.log(u'Adding in XML from datasource {}'.format(ds.get_datasource_name()))
+                file_obj.write('\n')
+                file_obj.write(ds.get_datasource_xml(xml_declaration=False))
+        else:
+            position = self.ds_inner_start
+            for (ds, (ds_start, ds_end)) in zip(self.datasources_list, self.datasource_ranges):
+                # Whitespace between the datasources
+                self.write_buffer_range(file_obj, position, ds_start, chunk_size)
+                if ds.is_modified():
+                    self.log(u'Adding in regenerated XML from datasource {}'.format(ds.get_datasource_name()))
+                    file_obj.write(ds.get_datasource_xml(xml_declaration=False))
+                else:
+                    self.write_buffer_range(file_obj, ds_start, ds_end, chunk_size)
+                position = ds_end
+            self.write_buffer_range(file_obj, position, self.ds_inner_end, chunk_size)
+        self.write_buffer_range(file_obj, self.ds_inner_end, len(self.wb_string), chunk_size)
         self.end_log_block()
-        return xml
+
+    def write_buffer_range(self, file_obj, start, end, chunk_size=(1024 * 1024 * 10)):
+        while start < end:
+            length = min(chunk_size, end - start)
+            file_obj.write(buffer(self.wb_string, start, length))
+            start += length
 
     def save_workbook_xml(self, filename):
         self.start_log_block()
         try:
-            lh = open(filename, 'wb')
-            lh.write(self.get_workbook_xml())
-            lh.close()
+            # Truncating a file that is memory-mapped would pull the original out from under the writer, so
+            # overwriting the source goes through a temporary file
+            if self.source_filename is not None and os.path.exists(filename) \
+                    and os.path.realpath(filename) == os.path.realpath(self.source_filename):
+                lh = open(filename + u'.tmp', 'wb')
+                self.write_workbook_xml(lh)
+                lh.close()
+                # Elsewhere the rename leaves the existing mapping of the old file intact. Windows won't replace a
+                # mapped file, so there the original has to be held in memory instead
+                if os.name == 'nt':
+                    original_xml = self.wb_string[:]
+                    self.close()
+                    self.wb_string = original_xml
+                    os.remove(filename)
+                os.rename(filename + u'.tmp', filename)
+            else:
+                lh = open(filename, 'wb')
+                self.write_workbook_xml(lh)
+                lh.close()
             self.end_log_block()
         except IOError:
             self.log(u"Error: File '{} cannot be opened to write to".format(filename))
             self.end_log_block()
-            raise
\ No newline at end of file
+            raise
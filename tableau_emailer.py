@@ -9,44 +9,140 @@ from email import Encoders
 from email.mime.base import MIMEBase
 
 import os
+import time
+import uuid
+import socket
+import threading
+import Queue
 from os.path import basename
+from tableau_base import TableauBase
 from tableau_repository import TableauRepository
 from tabcmd import Tabcmd
+from tabcmd_export_pool import TabcmdExportPool
 
 
-class TableauEmailer:
+# Shares SMTP connections between senders. A connection is checked with NOOP before reuse, and one left idle longer
+# than max_idle_seconds is closed rather than reused, since servers drop idle connections (often during a long render).
+# At most one connection is open per thread sending at the same time
+class SmtpConnectionPool(object):
+    def __init__(self, smtp_server, smtp_username=None, smtp_password=None, max_idle_seconds=60):
+        self.smtp_server = smtp_server
+        self.smtp_username = smtp_username
+        self.smtp_password = smtp_password
+        self.max_idle_seconds = max_idle_seconds
+        # (connection, last used time), most recently used first
+        self.idle_connections = Queue.LifoQueue()
+
+    def connect(self):
+        connection = smtplib.SMTP(self.smtp_server)
+        if self.smtp_username is not None and self.smtp_password is not None:
+            connection.login(self.smtp_username, self.smtp_password)
+        return connection
+
+    @staticmethod
+    def close_connection(connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            connection.close()
+
+    def get_connection(self):
+        while True:
+            try:
+                (connection, last_used) = self.idle_connections.get_nowait()
+            except Queue.Empty:
+                return self.connect()
+            if time.time() - last_used <= self.max_idle_seconds:
+                try:
+                    if connection.noop()[0] == 250:
+                        return connection
+                except (smtplib.SMTPException, socket.error):
+                    pass
+            self.close_connection(connection)
+
+    def put_connection(self, connection):
+        self.idle_connections.put((connection, time.time()))
+
+    # Sends on a pooled connection, reconnecting once if the server has dropped it or the socket has failed
+    def sendmail(self, from_user, to_user, msg_string):
+        connection = self.get_connection()
+        try:
+            connection.sendmail(from_user, to_user, msg_string)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            self.close_connection(connection)
+            connection = self.connect()
+            try:
+                connection.sendmail(from_user, to_user, msg_string)
+            except (smtplib.SMTPException, socket.error):
+                # Not knowing what state the new connection is in, it is closed rather than returned to the pool
+                self.close_connection(connection)
+                raise
+        except smtplib.SMTPException:
+            # Refused recipients and the like; the connection itself is still good
+            self.put_connection(connection)
+            raise
+        self.put_connection(connection)
+
+    def close_all(self):
+        while True:
+            try:
+                (connection, last_used) = self.idle_connections.get_nowait()
+            except Queue.Empty:
+                return
+            self.close_connection(connection)
+
+
+class TableauEmailer(TableauBase):
     def __init__(self, tabcmd_dir, tabcmd_config_location, repository_pw,
                  tableau_server_url, tableau_server_admin_user, tableau_server_admin_pw,
-                 smtp_server, smtp_username=None, smtp_password=None):
-
+                 smtp_server, smtp_username=None, smtp_password=None, export_working_directory=None,
+                 smtp_max_idle_seconds=60, logger_obj=None):
+        super(self.__class__, self).__init__()
+        self.logger = logger_obj
         self.tableau_server_url = tableau_server_url
         self.repository_pw = repository_pw
-        self.smtp_server = smtplib.SMTP(smtp_server)
-        if smtp_username is not None and smtp_password is not None:
-            self.smtp_server.login(smtp_username, smtp_password)
+        # Where the worker directories for parallel exports go
+        if export_working_directory is None:
+            export_working_directory = tabcmd_config_location
+        self.export_working_directory = export_working_directory
+        # Connections are made when first needed and reused, see SmtpConnectionPool
+        self.smtp_pool = SmtpConnectionPool(smtp_server, smtp_username, smtp_password,
+                                            max_idle_seconds=smtp_max_idle_seconds)
+        # Most messages waiting between pipeline stages in send_render_plans, which bounds memory use
+        self.pipeline_queue_size = 20
+        # { template_name : (text, html) }
+        self.templates = {}
+        self.templates_lock = threading.Lock()
 
         # Create the tabcmd obj so you can do some querying. We will change the site later on at will
         self.tabcmd = Tabcmd(tabcmd_dir, tableau_server_url, tableau_server_admin_user, tableau_server_admin_pw,
                              repository_password=repository_pw, tabcmd_config_location=tabcmd_config_location)
 
-    def email_file_from_template(self, from_user, to_user, subject, template_name, filename_to_attach):
-        # Every template_name should have two versions, a .html and a .txt fallback
+    # Every template_name should have two versions, a .html and a .txt fallback. Each is read from disk once
+    def get_template(self, template_name):
+        with self.templates_lock:
+            if template_name not in self.templates:
+                text_fh = open(template_name + '.txt')
+                html_fh = open(template_name + '.html')
+                self.templates[template_name] = (text_fh.read(), html_fh.read())
+                text_fh.close()
+                html_fh.close()
+            return self.templates[template_name]
+
+    def build_email_message(self, from_user, to_user, subject, template_name, filename_to_attach):
         msg = MIMEMultipart('alternative')
         msg['Subject'] = subject
         msg['From'] = from_user
         msg['To'] = to_user
-        text_fh = open(template_name + '.txt')
-        html_fh = open(template_name + '.html')
-        part1 = MIMEText(text_fh.read(), 'plain')
-        part2 = MIMEText(html_fh.read(), 'html')
+        (template_text, template_html) = self.get_template(template_name)
+        part1 = MIMEText(template_text, 'plain')
+        part2 = MIMEText(template_html, 'html')
         msg.attach(part1)
         msg.attach(part2)
-        text_fh.close()
-        html_fh.close()
         filename_to_attach = filename_to_attach.replace("\\", "/")
 
         base_filename = basename(filename_to_attach)
-        file_extension = os.path.splitext(base_filename)
+        file_extension = os.path.splitext(base_filename)[1][1:]
 
         with open(filename_to_attach, 'rb') as attach_fh:
 
@@ -55,9 +151,16 @@ class TableauEmailer:
             Encoders.encode_base64(file_to_attach)
             file_to_attach.add_header('Content-Disposition', 'attachment', filename=base_filename)
             msg.attach(file_to_attach)
-        self.smtp_server.sendmail(from_user, to_user, msg.as_string())
+        return msg
+
+    # remove_file=False keeps the attachment, for when the same file goes to more recipients
+    def email_file_from_template(self, from_user, to_user, subject, template_name, filename_to_attach,
+                                 remove_file=True):
+        msg = self.build_email_message(from_user, to_user, subject, template_name, filename_to_attach)
+        self.smtp_pool.sendmail(from_user, to_user, msg.as_string())
         # Cleanup the file
-        os.remove(filename_to_attach)
+        if remove_file is True:
+            os.remove(filename_to_attach)
 
     def generate_email_from_view(self, email_from_user, email_to_user, email_subject, email_template_name,
                                  view_user, view_location, email_content_type='fullpdf', view_filter_map=None):
@@ -66,23 +169,187 @@ class TableauEmailer:
         self.email_file_from_template(email_from_user, email_to_user, email_subject, email_template_name,
                                       filename_to_attach)
 
-    def generate_emails_from_named_schedule_in_repository(self, schedule_name, email_from_user, email_template_name,
-                                                          email_content_type='fullpdf'):
-        repository = TableauRepository(self.tableau_server_url, self.repository_pw)
-        cur = repository.query_subscriptions(schedule_name)
+    @staticmethod
+    def convert_subscription_rows(cur):
+        subscriptions = []
         for row in cur:
-            email_subject = row[1]
-            user = row[2]
-            site = row[3]
-            view_location = row[4]
-            # schedule_name = row[5]
-            user_email = row[6]
-            # Configure the site
-            self.tabcmd.site = site
-            self.generate_email_from_view(email_from_user, user_email, email_subject, email_template_name, user,
-                                          view_location, email_content_type=email_content_type)
+            subscriptions.append({u'subject': row[1], u'user': row[2], u'site': row[3], u'view_location': row[4],
+                                  u'email': row[6], u'view_filter_map': None})
+        return subscriptions
+
+    # Groups subscriptions that would render the identical file: same site, view, filters, content type and security
+    # context. Each group is rendered once, impersonating its first user, and sent to every recipient in it.
+    # NOTE: by default the security context is the subscriber, so only repeat subscriptions by the same user are
+    # merged and nearly every subscription still gets its own render. When the views have no row level security,
+    # pass row_level_security=False to group on site, view, filters and content type alone. If row level security
+    # depends on something coarser, like group membership, pass security_context_function instead, which is called
+    # with (username, site) and returns a hashable value that is equal for users who see the same data
+    @staticmethod
+    def plan_renders(subscriptions, email_content_type='fullpdf', security_context_function=None,
+                     row_level_security=True):
+        render_plans = []
+        render_plans_by_key = {}
+        for subscription in subscriptions:
+            if not row_level_security:
+                security_context = None
+            elif security_context_function is not None:
+                security_context = security_context_function(subscription[u'user'], subscription[u'site'])
+            else:
+                security_context = subscription[u'user']
+            view_filter_map = subscription.get(u'view_filter_map')
+            filter_key = None
+            if view_filter_map is not None:
+                filter_key = tuple(sorted(view_filter_map.items()))
+            render_key = (subscription[u'site'].lower(), subscription[u'view_location'], filter_key, security_context,
+                          email_content_type)
+            render_plan = render_plans_by_key.get(render_key)
+            if render_plan is None:
+                render_plan = {u'site': subscription[u'site'], u'view_location': subscription[u'view_location'],
+                               u'view_filter_map': view_filter_map, u'content_type': email_content_type,
+                               u'render_user': subscription[u'user'], u'recipients': []}
+                render_plans_by_key[render_key] = render_plan
+                render_plans.append(render_plan)
+            render_plan[u'recipients'].append(subscription)
+        return render_plans
+
+    # Renders each plan once and emails the file to all of its recipients, then removes it. Rendering, building the
+    # messages and sending run as separate stages connected by queues, so sends go out while the next exports are
+    # still rendering: export_workers render threads (in parallel with a TabcmdExportPool above 1), one thread
+    # building the MIME messages, and send_workers threads sending through the SMTP pool.
+    # Returns the plans with the filename and error of each render and a list of (email, error) for failed sends;
+    # recipients of a failed render are not emailed
+    def send_render_plans(self, render_plans, email_from_user, email_template_name, export_workers=1,
+                          send_workers=2):
+        render_queue = Queue.Queue()
+        for render_plan in render_plans:
+            render_plan[u'send_errors'] = []
+            render_queue.put(render_plan)
+        rendered_queue = Queue.Queue(maxsize=self.pipeline_queue_size)
+        message_queue = Queue.Queue(maxsize=self.pipeline_queue_size)
 
+        export_pool = None
+        if export_workers > 1:
+            export_pool = TabcmdExportPool(self.tabcmd, self.export_working_directory, max_workers=export_workers)
 
+        send_threads = []
+        for i in xrange(0, send_workers):
+            send_threads.append(threading.Thread(target=self.run_send_stage, args=(message_queue, email_from_user)))
+        message_thread = threading.Thread(target=self.run_message_stage,
+                                          args=(rendered_queue, message_queue, email_from_user, email_template_name,
+                                                send_workers))
+        render_threads = []
+        for i in xrange(0, max(export_workers, 1)):
+            render_threads.append(threading.Thread(target=self.run_render_stage,
+                                                   args=(render_queue, rendered_queue, export_pool)))
+        for thread in send_threads + [message_thread, ] + render_threads:
+            thread.daemon = True
+            thread.start()
+        for thread in render_threads:
+            thread.join()
+        rendered_queue.put(None)
+        message_thread.join()
+        for thread in send_threads:
+            thread.join()
+        return render_plans
 
+    def run_render_stage(self, render_queue, rendered_queue, export_pool):
+        while True:
+            try:
+                render_plan = render_queue.get_nowait()
+            except Queue.Empty:
+                return
+            # A failed render may still have left a partial file behind, which is removed before the plan moves on
+            if export_pool is not None:
+                try:
+                    result = export_pool.run_export_job(
+                        TabcmdExportPool.create_export_job(render_plan[u'content_type'],
+                                                           render_plan[u'view_location'],
+                                                           view_filter_map=render_plan[u'view_filter_map'],
+                                                           user_to_impersonate=render_plan[u'render_user'],
+                                                           site=render_plan[u'site']))
+                    render_plan[u'filename'] = result[u'filename']
+                    render_plan[u'error'] = result[u'error']
+                except Exception as e:
+                    render_plan[u'error'] = unicode(e)
+            else:
+                # Only one render thread without a pool, as create_export uses the shared tabcmd config.
+                # The message stage may still be reading the previous file, so every render gets its own name
+                export_type = render_plan[u'content_type']
+                if self.tabcmd.export_type is not None:
+                    export_type = self.tabcmd.export_type
+                filename = u'export-{}'.format(uuid.uuid4().hex)
+                render_plan[u'filename'] = self.tabcmd.tabcmd_folder + self.tabcmd.build_export_filename(
+                    export_type, filename)
+                try:
+                    self.tabcmd.site = render_plan[u'site']
+                    render_plan[u'filename'] = self.tabcmd.create_export(
+                        render_plan[u'content_type'], render_plan[u'view_location'],
+                        user_to_impersonate=render_plan[u'render_user'],
+                        view_filter_map=render_plan[u'view_filter_map'], filename=filename)
+                    render_plan[u'error'] = None
+                except Exception as e:
+                    render_plan[u'error'] = unicode(e)
+            if render_plan[u'error'] is not None:
+                self.remove_rendered_file(render_plan)
+            rendered_queue.put(render_plan)
 
+    # The message strings hold the attachment, so the exported file can be removed once they are built
+    def run_message_stage(self, rendered_queue, message_queue, email_from_user, email_template_name, send_workers):
+        try:
+            while True:
+                render_plan = rendered_queue.get()
+                if render_plan is None:
+                    break
+                if render_plan[u'error'] is not None:
+                    continue
+                try:
+                    for subscription in render_plan[u'recipients']:
+                        msg = self.build_email_message(email_from_user, subscription[u'email'],
+                                                       subscription[u'subject'], email_template_name,
+                                                       render_plan[u'filename'])
+                        message_queue.put((render_plan, subscription[u'email'], msg.as_string()))
+                # Anything raised here must not stop the stage, or the render threads would block on a full queue
+                except Exception as e:
+                    render_plan[u'error'] = unicode(e)
+                finally:
+                    self.remove_rendered_file(render_plan)
+        finally:
+            # The send threads only stop on these, so they go out however this stage ends
+            for i in xrange(0, send_workers):
+                message_queue.put(None)
 
+    # Removes the exported file of a plan, if there is one. Failing to remove it is logged but not an error of the plan
+    def remove_rendered_file(self, render_plan):
+        filename = render_plan.get(u'filename')
+        if filename is not None and os.path.exists(filename):
+            try:
+                os.remove(filename)
+            except OSError as e:
+                self.log(u'Could not remove {}: {}'.format(filename, e))
+        if render_plan[u'error'] is not None:
+            render_plan[u'filename'] = None
+
+    def run_send_stage(self, message_queue, email_from_user):
+        while True:
+            message = message_queue.get()
+            if message is None:
+                return
+            (render_plan, email, msg_string) = message
+            try:
+                self.smtp_pool.sendmail(email_from_user, email, msg_string)
+            except (smtplib.SMTPException, socket.error) as e:
+                render_plan[u'send_errors'].append((email, unicode(e)))
+
+    # Subscribers that would get an identical export share one render (see plan_renders)
+    def generate_emails_from_named_schedule_in_repository(self, schedule_name, email_from_user, email_template_name,
+                                                          email_content_type='fullpdf', export_workers=1,
+                                                          security_context_function=None, send_workers=2,
+                                                          row_level_security=True):
+        repository = TableauRepository(self.tableau_server_url, self.repository_pw, use_connection_pool=True)
+        cur = repository.query_subscriptions(schedule_name)
+        subscriptions = self.convert_subscription_rows(cur)
+        cur.close()
+        render_plans = self.plan_renders(subscriptions, email_content_type, security_context_function,
+                                         row_level_security)
+        return self.send_render_plans(render_plans, email_from_user, email_template_name, export_workers,
+                                      send_workers)
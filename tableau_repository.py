@@ -1,21 +1,233 @@
 # -*- coding: utf-8 -*-
 
 from tableau_exceptions import *
+import threading
+import itertools
+import time
+import re
+import gzip
+import bz2
+import json
+import os
+import weakref
+from collections import OrderedDict
 import psycopg2
 import psycopg2.extensions
+import psycopg2.pool
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
 
+# Process-wide connection pools shared by every pooled TableauRepository
+# { (server, port, database, username) : psycopg2.pool.ThreadedConnectionPool }
+repository_connection_pools = {}
+repository_connection_pools_lock = threading.Lock()
+# Most connections a single pool will open at once. getconn() raises PoolError past this
+repository_pool_max_connections = 10
+# Names for server-side cursors must be unique within a connection, and pooled connections outlive any one object
+repository_cursor_counter = itertools.count(1)
+
+
+def get_repository_connection_pool(server, port, database, username, password):
+    key = (server, port, database, username)
+    with repository_connection_pools_lock:
+        pool = repository_connection_pools.get(key)
+        if pool is None or pool.closed is True:
+            pool = psycopg2.pool.ThreadedConnectionPool(0, repository_pool_max_connections, host=server,
+                                                        database=database, user=username, password=password,
+                                                        port=port)
+            repository_connection_pools[key] = pool
+        return pool
+
+
+# Closes every pooled connection, for long running processes that are done with the repository
+def close_repository_connection_pools():
+    with repository_connection_pools_lock:
+        for pool in repository_connection_pools.values():
+            if pool.closed is False:
+                pool.closeall()
+        repository_connection_pools.clear()
+
+# Column used for the time window by export_table_to_file, for the tables that are most often exported
+repository_export_time_columns = {
+    u'_background_jobs': u'created_at',
+    u'_http_requests': u'created_at',
+    u'_sessions': u'updated_at',
+    u'_views_stats': u'time',
+    u'background_jobs': u'created_at',
+    u'http_requests': u'created_at',
+    u'sessions': u'updated_at'
+}
+# (time column, unique id column) that order the rows of a table for query_changes_since / RepositoryChangeFeed
+repository_change_feed_columns = {
+    u'background_jobs': (u'updated_at', u'id'),
+    u'sessions': (u'updated_at', u'session_id')
+}
+# Table and column names are put into the SQL directly, so they must be plain (optionally schema qualified) identifiers
+repository_identifier_pattern = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$')
+
+
+# File wrapper for COPY output that counts the CSV rows as they are written. Fields containing quotes or line breaks
+# are quoted, and quotes inside them are doubled, so only line breaks outside of quotes end a row
+class RepositoryCsvRowCounter(object):
+    def __init__(self, fh):
+        self.fh = fh
+        self.line_count = 0
+        self.in_quotes = False
+
+    def write(self, data):
+        self.fh.write(data)
+        if '"' not in data:
+            if self.in_quotes is False:
+                self.line_count += data.count('\n')
+            return
+        # Splitting on quotes gives segments that alternate between outside and inside of a quoted field
+        for segment in data.split('"'):
+            if self.in_quotes is False:
+                self.line_count += segment.count('\n')
+            self.in_quotes = not self.in_quotes
+        # One more toggle was counted than there are quotes
+        self.in_quotes = not self.in_quotes
+
+
+# Named (server-side) cursor that hands itself back to its TableauRepository when closed, so the repository can end
+# the transaction the cursor was read in. Holds only a weak reference to the repository, which has a __del__ and so
+# must not be part of a reference cycle
+class RepositoryServerSideCursor(psycopg2.extensions.cursor):
+    def close(self):
+        if self.closed is False and self.connection.closed == 0:
+            super(RepositoryServerSideCursor, self).close()
+        repository_ref = getattr(self, 'repository_ref', None)
+        self.repository_ref = None
+        if repository_ref is not None and repository_ref() is not None:
+            repository_ref().end_server_side_cursor(self)
+
+
+# Cache for the ID lookups, which are called over and over with the same arguments and almost never change.
+# Entries expire after ttl_seconds, and the least recently used are dropped past max_entries. One cache can be shared
+# by many TableauRepository objects (see TableauRepository.use_lookup_cache); keys include the server
+class RepositoryLookupCache(object):
+    def __init__(self, ttl_seconds=3600, max_entries=10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # { (server, lookup name, arguments...) : (value, stored at) }, oldest use first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or time.time() - entry[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            # Re-inserting moves it to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time())
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # With no lookup_name, empties the cache. Otherwise removes the entries for that lookup (e.g. u'project_id'),
+    # only those whose arguments start with key_values if any are given
+    def invalidate(self, lookup_name=None, *key_values):
+        with self.lock:
+            if lookup_name is None:
+                self.entries.clear()
+                return
+            for key in self.entries.keys():
+                if key[1] == lookup_name and key[2:2 + len(key_values)] == key_values:
+                    del self.entries[key]
+
+    def get_stats(self):
+        with self.lock:
+            return {u'hits': self.hits, u'misses': self.misses, u'entries': len(self.entries)}
+
+
+# Follows the changes to a repository table (sessions and background_jobs are set up in
+# repository_change_feed_columns) by remembering the (updated_at, id) of the last row read. Each get_changes() only
+# reads rows after that point, using the index on updated_at, rather than rescanning the table. The watermark is saved
+# as JSON to watermark_filename after each call, so a restarted monitor carries on where it left off.
+# Rows are only seen once their transaction commits, so a long running transaction can commit rows with an updated_at
+# older than the watermark; settle_seconds holds back rows newer than that many seconds (repository times are UTC)
+# to allow for it
+class RepositoryChangeFeed(object):
+    def __init__(self, repository, table_name, watermark_filename=None, columns=None, time_column=None, id_column=None,
+                 batch_size=10000, settle_seconds=0):
+        self.repository = repository
+        self.table_name = table_name
+        self.watermark_filename = watermark_filename
+        self.columns = columns
+        self.time_column = time_column
+        self.id_column = id_column
+        self.batch_size = batch_size
+        self.settle_seconds = settle_seconds
+        self.last_updated_at = None
+        self.last_id = None
+        if watermark_filename is not None and os.path.exists(watermark_filename):
+            self.load_watermark()
+
+    def load_watermark(self):
+        with open(self.watermark_filename, 'rb') as fh:
+            watermark = json.load(fh)
+        self.last_updated_at = watermark.get(u'updated_at')
+        self.last_id = watermark.get(u'id')
+
+    def save_watermark(self):
+        if self.watermark_filename is None:
+            return
+        # Write then rename, so a crash mid-write never leaves a broken watermark
+        temp_filename = u'{}.tmp'.format(self.watermark_filename)
+        with open(temp_filename, 'wb') as fh:
+            json.dump({u'table': self.table_name, u'updated_at': self.last_updated_at, u'id': self.last_id}, fh)
+        if os.name == 'nt' and os.path.exists(self.watermark_filename):
+            os.remove(self.watermark_filename)
+        os.rename(temp_filename, self.watermark_filename)
+
+    # Starts the feed from a point in time (anything Postgres can compare to a timestamp), rather than the beginning
+    def set_watermark(self, updated_at, last_id=None):
+        self.last_updated_at = updated_at
+        self.last_id = last_id
+        self.save_watermark()
+
+    # Returns the list of rows changed since the last call, up to batch_size of them, and moves the watermark past them.
+    # Call again straight away while a full batch comes back
+    def get_changes(self):
+        cur = self.repository.query_changes_since(self.table_name, self.last_updated_at, self.last_id,
+                                                  columns=self.columns, time_column=self.time_column,
+                                                  id_column=self.id_column, limit=self.batch_size,
+                                                  settle_seconds=self.settle_seconds)
+        rows = cur.fetchall()
+        if len(rows) > 0:
+            column_names = [column[0] for column in cur.description]
+            (time_column, id_column) = self.repository.get_change_feed_columns(self.table_name, self.time_column,
+                                                                               self.id_column)
+            last_row = rows[-1]
+            self.last_updated_at = last_row[column_names.index(time_column)].isoformat()
+            self.last_id = last_row[column_names.index(id_column)]
+            self.save_watermark()
+        cur.close()
+        return rows
+
 
 class TableauRepository:
-    def __init__(self, tableau_server_url, repository_password, repository_username='readonly'):
+    # use_connection_pool=True takes a connection from the process-wide pool for this server and user, and gives it
+    # back on close() (or when the object is garbage collected), so repeated short-lived repository objects don't
+    # each pay for a new TCP connection and Postgres authentication
+    def __init__(self, tableau_server_url, repository_password, repository_username='readonly',
+                 use_connection_pool=False):
         if repository_username not in ['tableau', 'readonly', 'tblwgadmin']:
             raise InvalidOptionException('Must use one of the three valid usernames')
 
         # Remove the http:// or https:// to log in to the repository. (Do we need things if this is SSL?)
         colon_slash_slash = tableau_server_url.find('://')
         if colon_slash_slash != -1:
-            self.repository_server = tableau_server_url[colon_slash_slash+2:]
+            self.repository_server = tableau_server_url[colon_slash_slash+3:]
         else:
             self.repository_server = tableau_server_url
 
@@ -25,22 +237,142 @@ class TableauRepository:
         self.repository_user = repository_username
         self.repository_pw = repository_password
 
-        self.db_conn = psycopg2.connect(host=self.repository_server, database=self.repository_db,
-                                        user=self.repository_user, password=self.repository_pw,
-                                        port=self.repository_port)
-        self.db_conn.set_session(autocommit=True)
+        # Rows per network round trip when iterating a server-side cursor
+        self.cursor_itersize = 2000
+        self.server_side_cursors = []
+        self.lookup_cache = None
+        self.connection_pool = None
+        self.db_conn = None
+        if use_connection_pool is True:
+            self.connection_pool = get_repository_connection_pool(self.repository_server, self.repository_port,
+                                                                  self.repository_db, self.repository_user,
+                                                                  self.repository_pw)
+            self.db_conn = self.get_healthy_pooled_connection()
+        else:
+            self.db_conn = psycopg2.connect(host=self.repository_server, database=self.repository_db,
+                                            user=self.repository_user, password=self.repository_pw,
+                                            port=self.repository_port)
+            self.db_conn.set_session(autocommit=True)
 
     def __del__(self):
-        self.db_conn.close()
+        self.close()
 
-    # Base method for querying
-    def query(self, sql, sql_parameter_array):
+    # Returns a pooled connection to the pool, or closes an unpooled one
+    def close(self):
+        # May be called from __del__ after a failed __init__
+        if getattr(self, 'db_conn', None) is None:
+            return
+        # Closing the last server-side cursor ends its transaction, so the connection goes back in autocommit mode
+        for cur in list(self.server_side_cursors):
+            cur.close()
+        self.server_side_cursors = []
+        self.end_server_side_transaction()
+        if self.connection_pool is not None:
+            if self.connection_pool.closed is False:
+                self.connection_pool.putconn(self.db_conn, close=self.db_conn.closed != 0)
+        else:
+            self.db_conn.close()
+        self.db_conn = None
+
+    # Connections sitting in the pool may have been dropped by the server (restart, idle timeout). Each one is checked
+    # with a trivial query before use, and any that fail are thrown away and replaced
+    def get_healthy_pooled_connection(self):
+        for i in xrange(0, repository_pool_max_connections + 1):
+            conn = self.connection_pool.getconn()
+            try:
+                if conn.closed == 0:
+                    if conn.autocommit is False:
+                        conn.autocommit = True
+                    cur = conn.cursor()
+                    cur.execute('SELECT 1')
+                    cur.close()
+                    return conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                pass
+            self.connection_pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError('Could not get a working connection to the repository on {}'.format(
+            self.repository_server))
+
+    # Caches the ID lookups (get_site_id_*, get_extract_schedule_id_by_name, query_*_id_*). Pass a
+    # RepositoryLookupCache to share one between repository objects, otherwise a new one is created. Returns the cache
+    def use_lookup_cache(self, lookup_cache=None, ttl_seconds=3600, max_entries=10000):
+        if lookup_cache is None:
+            lookup_cache = RepositoryLookupCache(ttl_seconds=ttl_seconds, max_entries=max_entries)
+        self.lookup_cache = lookup_cache
+        return lookup_cache
+
+    def stop_using_lookup_cache(self):
+        self.lookup_cache = None
 
+    def get_cached_lookup(self, lookup_name, *key_values):
+        if self.lookup_cache is None:
+            return None
+        return self.lookup_cache.get((self.repository_server, lookup_name) + key_values)
+
+    def set_cached_lookup(self, value, lookup_name, *key_values):
+        if self.lookup_cache is not None:
+            self.lookup_cache.set((self.repository_server, lookup_name) + key_values, value)
+
+    # Base method for querying
+    # The default cursor reads the whole result into memory on execute. server_side=True uses a named cursor instead,
+    # which only brings back itersize rows (default self.cursor_itersize) at a time as it is iterated, so memory stays
+    # flat for big tables like sessions. rowcount is not known up front for a server-side cursor.
+    # A named cursor has to live in a transaction (WITH HOLD would have Postgres build the whole result up front), so
+    # autocommit is turned off until the last open server-side cursor is closed; other queries run in that same
+    # transaction meanwhile. Close the cursor when done (close() on the repository closes any left open)
+    def query(self, sql, sql_parameter_array=None, server_side=False, itersize=None):
+        if server_side is True:
+            if self.db_conn.autocommit is True:
+                self.db_conn.autocommit = False
+            cur = self.db_conn.cursor(name='tableau_tools_{}'.format(repository_cursor_counter.next()),
+                                      cursor_factory=RepositoryServerSideCursor)
+            cur.repository_ref = weakref.ref(self)
+            if itersize is None:
+                itersize = self.cursor_itersize
+            cur.itersize = itersize
+            self.server_side_cursors.append(cur)
+            try:
+                cur.execute(sql, sql_parameter_array)
+            except psycopg2.Error:
+                cur.close()
+                raise
+            return cur
         cur = self.db_conn.cursor()
         cur.execute(sql, sql_parameter_array)
         return cur
 
-    def query_sessions(self, username=None):
+    # Called by RepositoryServerSideCursor.close()
+    def end_server_side_cursor(self, cur):
+        if cur in self.server_side_cursors:
+            self.server_side_cursors.remove(cur)
+        if len(self.server_side_cursors) == 0:
+            self.end_server_side_transaction()
+
+    def end_server_side_transaction(self):
+        if self.db_conn is None or self.db_conn.closed != 0 or self.db_conn.autocommit is True:
+            return
+        try:
+            self.db_conn.commit()
+        except psycopg2.Error:
+            self.db_conn.rollback()
+        self.db_conn.autocommit = True
+
+    # Generator of lists of up to batch_size rows, read through a server-side cursor. The cursor is closed when the
+    # generator is exhausted or thrown away
+    def query_in_batches(self, sql, sql_parameter_array=None, batch_size=None):
+        if batch_size is None:
+            batch_size = self.cursor_itersize
+        cur = self.query(sql, sql_parameter_array, server_side=True, itersize=batch_size)
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                yield rows
+        finally:
+            cur.close()
+
+    def query_sessions(self, username=None, server_side=False):
         # Trusted tickets sessions do not have anything in the 'data' column
         # The auth token is contained within the shared_wg_write column, stored as JSON
         sessions_sql = """
@@ -63,12 +395,12 @@ WHERE sessions.user_id = users.id AND users.system_user_id = system_users.id
         sessions_sql += "ORDER BY sessions.updated_at DESC;"
 
         if username is not None:
-            cur = self.query(sessions_sql, [username, ])
+            cur = self.query(sessions_sql, [username, ], server_side=server_side)
         else:
-            cur = self.query(sessions_sql)
+            cur = self.query(sessions_sql, server_side=server_side)
         return cur
 
-    def query_subscriptions(self, schedule_name=None, views_only=True):
+    def query_subscriptions(self, schedule_name=None, views_only=True, server_side=False):
         subscriptions_sql = """
 SELECT
 s.id,
@@ -92,9 +424,9 @@ JOIN system_users su ON su.name = s.user_name
                 subscriptions_sql += 'WHERE s.view_url IS NOT NULL -- Export command in tabcmd requires a View not a Workbook'
 
         if schedule_name is not None:
-            cur = self.query(subscriptions_sql, [schedule_name, ])
+            cur = self.query(subscriptions_sql, [schedule_name, ], server_side=server_side)
         else:
-            cur = self.query(subscriptions_sql)
+            cur = self.query(subscriptions_sql, server_side=server_side)
         return cur
 
     # Set extract refresh schedules
@@ -106,13 +438,16 @@ WHERE scheduled_action_type = 'Refresh Extracts'
 AND hidden = false
 """
         if schedule_name is not None:
-            schedules_sql += 'WHERE name = %s\n'
+            schedules_sql += 'AND name = %s\n'
             cur = self.query(schedules_sql, [schedule_name, ])
         else:
             cur = self.query(schedules_sql)
         return cur
 
     def get_extract_schedule_id_by_name(self, schedule_name):
+        sched_id = self.get_cached_lookup(u'extract_schedule_id', schedule_name)
+        if sched_id is not None:
+            return sched_id
         cur = self.query_extract_schedules(schedule_name=schedule_name)
         if cur.rowcount == 0:
             raise NoMatchFoundException('No schedule found with name "{}"'.format(schedule_name))
@@ -120,6 +455,7 @@ AND hidden = false
         # Should only be one row
         for row in cur:
             sched_id = row[0]
+        self.set_cached_lookup(sched_id, u'extract_schedule_id', schedule_name)
         return sched_id
 
     def query_sites(self, site_content_url=None, site_pretty_name=None):
@@ -137,12 +473,15 @@ FROM _sites
             sites_sql += 'WHERE name = %s\n'
             cur = self.query(sites_sql, [site_pretty_name, ])
         else:
-            sites_sql += 'WHERE url_namesspace = %s AND name = %s\n'
+            sites_sql += 'WHERE url_namespace = %s AND name = %s\n'
             cur = self.query(sites_sql, [site_content_url, site_pretty_name])
 
         return cur
 
     def get_site_id_by_site_content_url(self, site_content_url):
+        site_id = self.get_cached_lookup(u'site_id_by_content_url', site_content_url)
+        if site_id is not None:
+            return site_id
         cur = self.query_sites(site_content_url=site_content_url)
         if cur.rowcount == 0:
             raise NoMatchFoundException('No site found with content url "{}"'.format(site_content_url))
@@ -150,9 +489,13 @@ FROM _sites
         # Should only be one row
         for row in cur:
             site_id = row[0]
+        self.set_cached_lookup(site_id, u'site_id_by_content_url', site_content_url)
         return site_id
 
     def get_site_id_by_site_pretty_name(self, site_pretty_name):
+        site_id = self.get_cached_lookup(u'site_id_by_pretty_name', site_pretty_name)
+        if site_id is not None:
+            return site_id
         cur = self.query_sites(site_pretty_name=site_pretty_name)
         if cur.rowcount == 0:
             raise NoMatchFoundException('No site found with pretty name "{}"'.format(site_pretty_name))
@@ -160,11 +503,15 @@ FROM _sites
         # Should only be one row
         for row in cur:
             site_id = row[0]
+        self.set_cached_lookup(site_id, u'site_id_by_pretty_name', site_pretty_name)
         return site_id
 
     def query_project_id_on_site_by_name(self, project_name, site_id):
+        project_id = self.get_cached_lookup(u'project_id', site_id, project_name)
+        if project_id is not None:
+            return project_id
         project_sql = """
-        SELECT *
+        SELECT id
         FROM _projects
         WHERE project_name = %s
         AND site_id = %s
@@ -175,11 +522,15 @@ FROM _sites
         project_id = None
         for row in cur:
             project_id = row[0]
+        self.set_cached_lookup(project_id, u'project_id', site_id, project_name)
         return project_id
 
     def query_datasource_id_on_site_in_project(self, datasource_name, site_id, project_id):
+        datasource_id = self.get_cached_lookup(u'datasource_id', site_id, project_id, datasource_name)
+        if datasource_id is not None:
+            return datasource_id
         datasource_query = """
-        SELECT *
+        SELECT id
         FROM _datasources
         WHERE name = %s
         AND site_id = %s
@@ -191,11 +542,15 @@ FROM _sites
         datasource_id = None
         for row in cur:
             datasource_id = row[0]
+        self.set_cached_lookup(datasource_id, u'datasource_id', site_id, project_id, datasource_name)
         return datasource_id
 
     def query_workbook_id_on_site_in_project(self, workbook_name, site_id, project_id):
+        workbook_id = self.get_cached_lookup(u'workbook_id', site_id, project_id, workbook_name)
+        if workbook_id is not None:
+            return workbook_id
         workbook_query = """
-        SELECT *
+        SELECT id
         FROM _workbooks
         WHERE name = %s
         AND site_id = %s
@@ -207,5 +562,174 @@ FROM _sites
         workbook_id = None
         for row in cur:
             workbook_id = row[0]
+        self.set_cached_lookup(workbook_id, u'workbook_id', site_id, project_id, workbook_name)
         return workbook_id
 
+    # Bulk versions of the lookups above. Every name is resolved in one query using = ANY(%s), and the result is
+    # { name : id }. Names that don't exist are left out of the dict rather than raising, so check for them if needed.
+    # With a lookup cache, only the names not already cached are queried, and the results are cached
+    def query_name_id_map(self, sql, names, other_parameters, lookup_name):
+        name_id_map = {}
+        names_to_query = []
+        for name in names:
+            cached_id = self.get_cached_lookup(lookup_name, *(other_parameters + [name, ]))
+            if cached_id is not None:
+                name_id_map[name] = cached_id
+            else:
+                names_to_query.append(name)
+        if len(names_to_query) == 0:
+            return name_id_map
+        cur = self.query(sql, [names_to_query, ] + other_parameters)
+        for row in cur:
+            name_id_map[row[0]] = row[1]
+            self.set_cached_lookup(row[1], lookup_name, *(other_parameters + [row[0], ]))
+        cur.close()
+        return name_id_map
+
+    def query_project_ids_on_site_by_names(self, project_names, site_id):
+        project_sql = """
+        SELECT project_name, id
+        FROM _projects
+        WHERE project_name = ANY(%s)
+        AND site_id = %s
+"""
+        return self.query_name_id_map(project_sql, project_names, [site_id, ], u'project_id')
+
+    def query_datasource_ids_on_site_in_project(self, datasource_names, site_id, project_id):
+        datasource_query = """
+        SELECT name, id
+        FROM _datasources
+        WHERE name = ANY(%s)
+        AND site_id = %s
+        AND project_id = %s
+"""
+        return self.query_name_id_map(datasource_query, datasource_names, [site_id, project_id], u'datasource_id')
+
+    def query_workbook_ids_on_site_in_project(self, workbook_names, site_id, project_id):
+        workbook_query = """
+        SELECT name, id
+        FROM _workbooks
+        WHERE name = ANY(%s)
+        AND site_id = %s
+        AND project_id = %s
+"""
+        return self.query_name_id_map(workbook_query, workbook_names, [site_id, project_id], u'workbook_id')
+
+    # Bulk export using COPY (...) TO STDOUT, which Postgres streams straight into the file as CSV without any per-row
+    # work in Python. compression is None, u'gzip' or u'bz2'; if not given, it is chosen from a .gz or .bz2 filename.
+    # COPY can't take bind parameters, so any sql_parameter_array values are inlined with mogrify.
+    # Returns the number of rows written
+    def export_query_to_file(self, sql, filename, sql_parameter_array=None, compression=None, header=True):
+        if compression is None:
+            if filename.lower().endswith(u'.gz'):
+                compression = u'gzip'
+            elif filename.lower().endswith(u'.bz2'):
+                compression = u'bz2'
+        if compression not in [None, u'gzip', u'bz2']:
+            raise InvalidOptionException(u"compression must be None, 'gzip' or 'bz2'")
+
+        cur = self.db_conn.cursor()
+        select_sql = cur.mogrify(sql.strip().rstrip(u';'), sql_parameter_array)
+        copy_sql = 'COPY ({}) TO STDOUT WITH CSV'.format(select_sql)
+        if header is True:
+            copy_sql += ' HEADER'
+
+        if compression == u'gzip':
+            fh = gzip.open(filename, 'wb')
+        elif compression == u'bz2':
+            fh = bz2.BZ2File(filename, 'wb')
+        else:
+            fh = open(filename, 'wb')
+        # Counted while writing, since cursor.rowcount isn't reliably set for COPY TO
+        row_counter = RepositoryCsvRowCounter(fh)
+        try:
+            cur.copy_expert(copy_sql, row_counter)
+        finally:
+            fh.close()
+        cur.close()
+        if header is True and row_counter.line_count > 0:
+            return row_counter.line_count - 1
+        return row_counter.line_count
+
+    # Exports a table or view (e.g. _sessions, _http_requests, _background_jobs, _views_stats) with export_query_to_file.
+    # start_time and end_time (datetimes or timestamp strings) limit the export to start_time <= time_column < end_time,
+    # so consecutive windows can be extracted incrementally without overlap. time_column defaults to the one in
+    # repository_export_time_columns for known tables. Rows are written in whatever order Postgres reads them;
+    # order_by_time=True sorts them by time_column, at the cost of a sort over everything exported
+    def export_table_to_file(self, table_name, filename, columns=None, start_time=None, end_time=None,
+                             time_column=None, compression=None, header=True, order_by_time=False):
+        identifiers = [table_name, ]
+        if columns is not None:
+            identifiers.extend(columns)
+        if time_column is None and (start_time is not None or end_time is not None or order_by_time is True):
+            time_column = repository_export_time_columns.get(table_name)
+            if time_column is None:
+                raise InvalidOptionException(u'No time_column known for {}, please pass one'.format(table_name))
+        if time_column is not None:
+            identifiers.append(time_column)
+        for identifier in identifiers:
+            if repository_identifier_pattern.match(identifier) is None:
+                raise InvalidOptionException(u'"{}" is not a valid table or column name'.format(identifier))
+
+        if columns is None:
+            export_sql = u'SELECT * FROM {}'.format(table_name)
+        else:
+            export_sql = u'SELECT {} FROM {}'.format(u', '.join(columns), table_name)
+        params = None
+        conditions = []
+        if start_time is not None:
+            conditions.append(u'{} >= %(start_time)s'.format(time_column))
+        if end_time is not None:
+            conditions.append(u'{} < %(end_time)s'.format(time_column))
+        if len(conditions) > 0:
+            export_sql += u'\nWHERE ' + u'\nAND '.join(conditions)
+            params = {u'start_time': start_time, u'end_time': end_time}
+        if order_by_time is True:
+            export_sql += u'\nORDER BY {}'.format(time_column)
+        return self.export_query_to_file(export_sql, filename, params, compression=compression, header=header)
+
+    def get_change_feed_columns(self, table_name, time_column=None, id_column=None):
+        (default_time_column, default_id_column) = repository_change_feed_columns.get(table_name, (u'updated_at', u'id'))
+        if time_column is None:
+            time_column = default_time_column
+        if id_column is None:
+            id_column = default_id_column
+        return time_column, id_column
+
+    # Rows of table_name after the watermark (last_updated_at, last_id), in (time, id) order. Comparing the pair means
+    # rows sharing a timestamp are neither skipped nor repeated between batches. With no watermark, reads from the
+    # start. See RepositoryChangeFeed for keeping track of the watermark between calls
+    def query_changes_since(self, table_name, last_updated_at=None, last_id=None, columns=None, time_column=None,
+                            id_column=None, limit=None, settle_seconds=0):
+        (time_column, id_column) = self.get_change_feed_columns(table_name, time_column, id_column)
+        if columns is None:
+            select_columns = [u'*', ]
+        else:
+            select_columns = list(columns)
+            for column in [time_column, id_column]:
+                if column not in select_columns:
+                    select_columns.append(column)
+        for identifier in [table_name, time_column, id_column] + select_columns:
+            if identifier != u'*' and repository_identifier_pattern.match(identifier) is None:
+                raise InvalidOptionException(u'"{}" is not a valid table or column name'.format(identifier))
+
+        changes_sql = u'SELECT {}\nFROM {}\n'.format(u', '.join(select_columns), table_name)
+        # A row without a time can't be placed relative to the watermark, so it is never part of the feed
+        conditions = [u'{} IS NOT NULL'.format(time_column), ]
+        params = []
+        if last_updated_at is not None:
+            if last_id is not None:
+                conditions.append(u'({}, {}) > (%s, %s)'.format(time_column, id_column))
+                params.extend([last_updated_at, last_id])
+            else:
+                conditions.append(u'{} >= %s'.format(time_column))
+                params.append(last_updated_at)
+        if settle_seconds > 0:
+            conditions.append(u"{} < (now() AT TIME ZONE 'UTC') - %s * interval '1 second'".format(time_column))
+            params.append(settle_seconds)
+        changes_sql += u'WHERE ' + u'\nAND '.join(conditions) + u'\n'
+        changes_sql += u'ORDER BY {}, {}\n'.format(time_column, id_column)
+        if limit is not None:
+            changes_sql += u'LIMIT %s\n'
+            params.append(int(limit))
+        return self.query(changes_sql, params)
@@ -1 +1,4 @@
 from tableau_rest_api_connection import TableauRestApiConnection
+from content_exporter import ContentExporter, PreviewImageHarvester
+from rest_records import WorkbookRecord, DatasourceRecord, ProjectRecord, UserRecord, GroupRecord, ViewRecord, SiteRecord
+from inventory_snapshot import InventorySnapshot
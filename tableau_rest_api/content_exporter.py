@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+from ..tableau_base import TableauBase
+from ..tableau_exceptions import *
+
+
+# Site name used in export paths, shared by ContentExporter and PreviewImageHarvester
+def get_export_site_name(tableau_rest_api_obj):
+    site_content_url = tableau_rest_api_obj._site_content_url
+    if site_content_url.lower() in [u'default', u'']:
+        return u'default'
+    return site_content_url
+
+
+# Writes JSON to a temporary file first and then renames it, so an interrupted run never leaves a half-written file
+def save_json_file(obj, file_location):
+    json_fh = open(file_location + u'.tmp', 'wb')
+    json.dump(obj, json_fh, indent=2)
+    json_fh.close()
+    # rename() replaces the old file in one step, except on Windows where it must be removed first
+    if os.name == 'nt' and os.path.isfile(file_location):
+        os.remove(file_location)
+    os.rename(file_location + u'.tmp', file_location)
+
+
+# Downloads workbooks and datasources from the signed-in site concurrently, streaming each one to disk, and writes a
+# manifest of what was exported. directory_layout is relative to export_directory and can use {site}, {project}
+# and {name}; the file extension is added automatically
+class ContentExporter(TableauBase):
+    def __init__(self, tableau_rest_api_obj, export_directory, logger_obj=None, max_workers=4,
+                 directory_layout=u'{site}/{project}/{name}'):
+        super(self.__class__, self).__init__()
+        """
+        :type tableau_rest_api_obj: TableauRestApiConnection
+        """
+        self.logger = logger_obj
+        self.log(u'Initializing a ContentExporter object')
+        self.t_rest_api = tableau_rest_api_obj
+        self.export_directory = export_directory
+        self.max_workers = max_workers
+        self.directory_layout = directory_layout
+        self.checksum_algorithm = u'sha256'
+        self.__directory_lock = threading.Lock()
+
+    # Characters that aren't allowed in file names on Windows are swapped out for underscores
+    @staticmethod
+    def make_safe_filename(name):
+        return re.sub(r'[\\/:*?"<>|]', u'_', name).strip()
+
+    def get_site_name(self):
+        return get_export_site_name(self.t_rest_api)
+
+    # Turns a list response into a list of dicts with the details needed for the export and the manifest
+    def convert_content_xml_to_item_list(self, lxml_obj, content_type):
+        items = []
+        ns_prefix = self.t_rest_api.ns_prefix
+        for element in lxml_obj.iter(ns_prefix + content_type):
+            project_name = None
+            project = element.find(ns_prefix + u'project')
+            if project is not None:
+                project_name = project.get(u'name')
+            items.append({u'luid': element.get(u'id'),
+                          u'type': content_type,
+                          u'name': element.get(u'name'),
+                          u'project': project_name,
+                          u'updated_at': element.get(u'updatedAt')})
+        return items
+
+    # Uses the site-level workbooks endpoint. Older API versions can only list the signed-in user's workbooks, which
+    # would silently leave content out of the export (and mark it deleted in an incremental one), so they are refused
+    def query_workbook_items(self):
+        if self.t_rest_api.api_version in [u"2.0", u"2.1", u"2.2"]:
+            raise InvalidOptionException(u'Exporting the workbooks of a whole site needs API version 2.3 or later')
+        return self.convert_content_xml_to_item_list(self.t_rest_api.query_resource(u"workbooks"), u'workbook')
+
+    def query_datasource_items(self):
+        return self.convert_content_xml_to_item_list(self.t_rest_api.query_datasources(), u'datasource')
+
+    # Filters a full listing down to the requested LUIDs. Anything not in the listing is looked up individually
+    def filter_items_by_luids(self, items, luids, content_type):
+        luids = self.to_list(luids)
+        items_by_luid = {}
+        for item in items:
+            items_by_luid[item[u'luid']] = item
+        filtered_items = []
+        for luid in luids:
+            if luid in items_by_luid:
+                filtered_items.append(items_by_luid[luid])
+            else:
+                if content_type == u'workbook':
+                    content_xml = self.t_rest_api.query_workbook_by_luid(luid)
+                else:
+                    content_xml = self.t_rest_api.query_datasource_by_luid(luid)
+                found_items = self.convert_content_xml_to_item_list(content_xml, content_type)
+                if len(found_items) == 0:
+                    raise NoMatchFoundException(u'No {} found with luid {}'.format(content_type, luid))
+                filtered_items.append(found_items[0])
+        return filtered_items
+
+    def build_filename_no_extension(self, item):
+        project_name = item[u'project']
+        if project_name is None:
+            project_name = u'no_project'
+        relative_path = self.directory_layout.format(site=self.make_safe_filename(self.get_site_name()),
+                                                     project=self.make_safe_filename(project_name),
+                                                     name=self.make_safe_filename(item[u'name']))
+        return os.path.join(self.export_directory, *relative_path.split(u'/'))
+
+    # Downloads a single item and returns its manifest entry. Errors are recorded in the entry rather than raised,
+    # so one missing or locked item doesn't stop the rest of the export
+    def export_item(self, item):
+        entry = dict(item)
+        filename_no_extension = self.build_filename_no_extension(item)
+        with self.__directory_lock:
+            directory = os.path.dirname(filename_no_extension)
+            if directory != u'' and not os.path.isdir(directory):
+                os.makedirs(directory)
+        if item[u'type'] == u'workbook':
+            url = self.t_rest_api.build_api_url(u"workbooks/{}/content".format(item[u'luid']))
+            extension_map = self.t_rest_api.workbook_extension_map
+        else:
+            url = self.t_rest_api.build_api_url(u"datasources/{}/content".format(item[u'luid']))
+            extension_map = self.t_rest_api.datasource_extension_map
+        checksum_obj = hashlib.new(self.checksum_algorithm)
+        start_time = time.time()
+        try:
+            saved_filename = self.t_rest_api.send_binary_get_request_to_file(url, filename_no_extension,
+                                                                             extension_map,
+                                                                             checksum_obj=checksum_obj)
+            entry[u'filename'] = saved_filename
+            entry[u'size'] = os.path.getsize(saved_filename)
+            entry[u'checksum'] = checksum_obj.hexdigest()
+            entry[u'checksum_algorithm'] = self.checksum_algorithm
+            entry[u'error'] = None
+        except RecoverableHTTPException as e:
+            self.log(u"Export of {} {} resulted in HTTP error {}, Tableau Code {}".format(
+                item[u'type'], item[u'luid'], e.http_code, e.tableau_error_code))
+            entry[u'error'] = u'HTTP error {}, Tableau Code {}'.format(e.http_code, e.tableau_error_code)
+        except IOError as e:
+            self.log(u"Export of {} {} could not be saved: {}".format(item[u'type'], item[u'luid'], e))
+            entry[u'error'] = unicode(e)
+        # Anything else (a parse error, a dropped connection) is still only a failure of this item. A partially
+        # written file is removed by send_binary_get_request_to_file
+        except Exception as e:
+            self.log(u"Export of {} {} failed: {}".format(item[u'type'], item[u'luid'], repr(e)))
+            entry[u'error'] = repr(e)
+        if entry[u'error'] is not None:
+            entry[u'filename'] = None
+        entry[u'seconds'] = round(time.time() - start_time, 3)
+        return entry
+
+    # Runs the downloads on a bounded pool of threads. Each download streams to its own file. Each export method
+    # defaults to its own manifest name, so exporting workbooks and then datasources into one folder keeps both
+    def export_items(self, items, manifest_filename=u'items_manifest.json'):
+        self.start_log_block()
+        self.log(u'Exporting {} items with {} workers'.format(len(items), self.max_workers))
+        start_time = time.time()
+        pool = ThreadPool(self.max_workers)
+        try:
+            entries = pool.map(self.export_item, items)
+        finally:
+            pool.close()
+            pool.join()
+        manifest = {u'site': self.get_site_name(),
+                    u'started_at': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start_time)),
+                    u'seconds': round(time.time() - start_time, 3),
+                    u'items': entries}
+        if manifest_filename is not None:
+            self.save_manifest(manifest, manifest_filename)
+        self.end_log_block()
+        return manifest
+
+    def save_manifest(self, manifest, manifest_filename):
+        if not os.path.isdir(self.export_directory):
+            os.makedirs(self.export_directory)
+        manifest_fh = open(os.path.join(self.export_directory, manifest_filename), 'wb')
+        json.dump(manifest, manifest_fh, indent=2)
+        manifest_fh.close()
+
+    # Leave wb_luids as None to export every workbook on the site
+    def export_workbooks(self, wb_luids=None, manifest_filename=u'workbooks_manifest.json'):
+        self.start_log_block()
+        items = self.query_workbook_items()
+        if wb_luids is not None:
+            items = self.filter_items_by_luids(items, wb_luids, u'workbook')
+        manifest = self.export_items(items, manifest_filename)
+        self.end_log_block()
+        return manifest
+
+    # Leave ds_luids as None to export every datasource on the site
+    def export_datasources(self, ds_luids=None, manifest_filename=u'datasources_manifest.json'):
+        self.start_log_block()
+        items = self.query_datasource_items()
+        if ds_luids is not None:
+            items = self.filter_items_by_luids(items, ds_luids, u'datasource')
+        manifest = self.export_items(items, manifest_filename)
+        self.end_log_block()
+        return manifest
+
+    def export_site(self, manifest_filename=u'site_manifest.json'):
+        self.start_log_block()
+        items = self.query_workbook_items()
+        items.extend(self.query_datasource_items())
+        manifest = self.export_items(items, manifest_filename)
+        self.end_log_block()
+        return manifest
+
+    # Incremental backup. The state file keeps the updatedAt of everything exported so far, by LUID, and only content
+    # that has changed (or has no updatedAt to compare) is downloaded. Content in the state file that is no longer on
+    # the site is listed under 'deleted' in the manifest and dropped from the state
+    def export_site_incremental(self, state_filename=u'export_state.json',
+                                manifest_filename=u'incremental_manifest.json'):
+        self.start_log_block()
+        state = self.load_export_state(state_filename)
+        current_items = self.query_workbook_items()
+        current_items.extend(self.query_datasource_items())
+
+        items_to_export = []
+        current_luids = {u'workbook': {}, u'datasource': {}}
+        for item in current_items:
+            current_luids[item[u'type']][item[u'luid']] = True
+            previous = state[item[u'type']].get(item[u'luid'])
+            if previous is None or item[u'updated_at'] is None or previous[u'updated_at'] != item[u'updated_at']:
+                items_to_export.append(item)
+        self.log(u'{} of {} items have changed since the last export'.format(len(items_to_export),
+                                                                             len(current_items)))
+
+        deleted_entries = []
+        for content_type in state:
+            for luid in state[content_type].keys():
+                if luid not in current_luids[content_type]:
+                    deleted_entry = dict(state[content_type][luid])
+                    deleted_entry[u'luid'] = luid
+                    deleted_entry[u'type'] = content_type
+                    deleted_entries.append(deleted_entry)
+                    del state[content_type][luid]
+
+        manifest = self.export_items(items_to_export, manifest_filename=None)
+        manifest[u'unchanged'] = len(current_items) - len(items_to_export)
+        manifest[u'deleted'] = deleted_entries
+        # Only successful downloads move forward in the state, so failures are retried next time
+        for entry in manifest[u'items']:
+            if entry[u'error'] is None:
+                state[entry[u'type']][entry[u'luid']] = {u'updated_at': entry[u'updated_at'],
+                                                         u'name': entry[u'name'],
+                                                         u'project': entry[u'project'],
+                                                         u'filename': entry[u'filename']}
+        if manifest_filename is not None:
+            self.save_manifest(manifest, manifest_filename)
+        self.save_export_state(state, state_filename)
+        self.end_log_block()
+        return manifest
+
+    def load_export_state(self, state_filename):
+        state_file_location = os.path.join(self.export_directory, state_filename)
+        if not os.path.isfile(state_file_location):
+            self.log(u'No state file found at {}, exporting everything'.format(state_file_location))
+            return {u'workbook': {}, u'datasource': {}}
+        state_fh = open(state_file_location, 'rb')
+        state = json.load(state_fh)
+        state_fh.close()
+        return state
+
+    def save_export_state(self, state, state_filename):
+        if not os.path.isdir(self.export_directory):
+            os.makedirs(self.export_directory)
+        save_json_file(state, os.path.join(self.export_directory, state_filename))
+
+
+# Saves the preview image of every view on the signed-in site, fetching them on a bounded pool of threads and
+# streaming each one to disk. A state file remembers the updatedAt of each view's workbook at the last harvest, so
+# views of unchanged workbooks are skipped. directory_layout can use {site}, {workbook} and {view}
+class PreviewImageHarvester(TableauBase):
+    def __init__(self, tableau_rest_api_obj, image_directory, logger_obj=None, max_workers=8,
+                 directory_layout=u'{site}/{workbook}/{view}'):
+        super(self.__class__, self).__init__()
+        """
+        :type tableau_rest_api_obj: TableauRestApiConnection
+        """
+        self.logger = logger_obj
+        self.log(u'Initializing a PreviewImageHarvester object')
+        self.t_rest_api = tableau_rest_api_obj
+        self.image_directory = image_directory
+        self.max_workers = max_workers
+        self.directory_layout = directory_layout
+        self.image_extension_map = [(u'image/png', u'.png'), (u'application/octet-stream', u'.png')]
+        self.__directory_lock = threading.Lock()
+
+    def get_site_name(self):
+        return get_export_site_name(self.t_rest_api)
+
+    # Returns one dict per view, with the name and updatedAt of the workbook it belongs to. As with
+    # ContentExporter.query_workbook_items, API versions that can't list a whole site's workbooks are refused
+    def query_view_items(self):
+        if self.t_rest_api.api_version in [u"2.0", u"2.1", u"2.2"]:
+            raise InvalidOptionException(u'Harvesting the previews of a whole site needs API version 2.3 or later')
+        ns_prefix = self.t_rest_api.ns_prefix
+        workbooks = {}
+        for workbook in self.t_rest_api.query_resource(u"workbooks").iter(ns_prefix + u'workbook'):
+            workbooks[workbook.get(u'id')] = workbook
+        items = []
+        for view in self.t_rest_api.query_views_for_site().iter(ns_prefix + u'view'):
+            wb_luid = None
+            view_workbook = view.find(ns_prefix + u'workbook')
+            if view_workbook is not None:
+                wb_luid = view_workbook.get(u'id')
+            workbook = workbooks.get(wb_luid)
+            if workbook is not None:
+                wb_name = workbook.get(u'name')
+                wb_updated_at = workbook.get(u'updatedAt')
+            else:
+                wb_name = wb_luid
+                wb_updated_at = None
+            items.append({u'luid': view.get(u'id'),
+                          u'name': view.get(u'name'),
+                          u'workbook_luid': wb_luid,
+                          u'workbook_name': wb_name,
+                          u'workbook_updated_at': wb_updated_at})
+        return items
+
+    def build_filename_no_extension(self, item):
+        relative_path = self.directory_layout.format(
+            site=ContentExporter.make_safe_filename(self.get_site_name()),
+            workbook=ContentExporter.make_safe_filename(item[u'workbook_name']),
+            view=ContentExporter.make_safe_filename(item[u'name']))
+        return os.path.join(self.image_directory, *relative_path.split(u'/'))
+
+    def save_view_preview_image(self, item):
+        entry = dict(item)
+        filename_no_extension = self.build_filename_no_extension(item)
+        with self.__directory_lock:
+            directory = os.path.dirname(filename_no_extension)
+            if directory != u'' and not os.path.isdir(directory):
+                os.makedirs(directory)
+        url = self.t_rest_api.build_api_url(u"workbooks/{}/views/{}/previewImage".format(item[u'workbook_luid'],
+                                                                                       item[u'luid']))
+        try:
+            entry[u'filename'] = self.t_rest_api.send_binary_get_request_to_file(url, filename_no_extension,
+                                                                                 self.image_extension_map)
+            entry[u'error'] = None
+        # You might be requesting something that doesn't exist
+        except RecoverableHTTPException as e:
+            self.log(u"Preview image for view {} resulted in HTTP error {}, Tableau Code {}".format(
+                item[u'luid'], e.http_code, e.tableau_error_code))
+            entry[u'error'] = u'HTTP error {}, Tableau Code {}'.format(e.http_code, e.tableau_error_code)
+        except IOError as e:
+            self.log(u"Preview image for view {} could not be saved: {}".format(item[u'luid'], e))
+            entry[u'error'] = unicode(e)
+        # Anything else is still only a failure of this view, as in ContentExporter.export_item
+        except Exception as e:
+            self.log(u"Preview image for view {} failed: {}".format(item[u'luid'], repr(e)))
+            entry[u'error'] = repr(e)
+        if entry[u'error'] is not None:
+            entry[u'filename'] = None
+        return entry
+
+    # Returns a dict with the saved and failed views and the number skipped because their workbook was unchanged
+    def harvest_view_preview_images(self, state_filename=u'preview_image_state.json'):
+        self.start_log_block()
+        state_file_location = os.path.join(self.image_directory, state_filename)
+        state = {}
+        if os.path.isfile(state_file_location):
+            state_fh = open(state_file_location, 'rb')
+            state = json.load(state_fh)
+            state_fh.close()
+
+        items = self.query_view_items()
+        items_to_save = []
+        for item in items:
+            if item[u'workbook_updated_at'] is None or state.get(item[u'luid']) != item[u'workbook_updated_at']:
+                items_to_save.append(item)
+        self.log(u'Saving preview images for {} of {} views'.format(len(items_to_save), len(items)))
+
+        pool = ThreadPool(self.max_workers)
+        try:
+            entries = pool.map(self.save_view_preview_image, items_to_save)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Views that no longer exist are dropped from the state
+        new_state = {}
+        current_luids = {}
+        for item in items:
+            current_luids[item[u'luid']] = True
+        for luid in state:
+            if luid in current_luids:
+                new_state[luid] = state[luid]
+        saved = []
+        errors = []
+        for entry in entries:
+            if entry[u'error'] is None:
+                new_state[entry[u'luid']] = entry[u'workbook_updated_at']
+                saved.append(entry)
+            else:
+                errors.append(entry)
+
+        if not os.path.isdir(self.image_directory):
+            os.makedirs(self.image_directory)
+        save_json_file(new_state, state_file_location)
+        self.end_log_block()
+        return {u'saved': saved, u'errors': errors, u'skipped': len(items) - len(items_to_save)}
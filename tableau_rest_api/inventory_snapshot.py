@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+import time
+import sqlite3
+import threading
+
+from ..tableau_base import TableauBase
+from ..tableau_exceptions import *
+from rest_records import *
+
+
+# Copies the users, groups, group memberships, projects, workbooks, views, datasources, schedules and permissions of
+# one or every site into a local SQLite database, so questions that would take several full REST downloads to answer
+# become a single indexed SQL query.
+# Each list is pulled in one paginated pass per refresh. The per-object calls (permissions, group members) are the
+# expensive part, so on an incremental refresh they are only repeated for objects that are new, whose updatedAt has
+# changed, or whose details are older than detail_max_age seconds. Permissions changes don't alter updatedAt, so set
+# detail_max_age to how stale you can accept those being (None means never refetch unchanged objects)
+class InventorySnapshot(TableauBase):
+    def __init__(self, database_filename, logger_obj=None, detail_max_age=(60 * 60 * 24)):
+        super(self.__class__, self).__init__()
+        self.logger = logger_obj
+        self.log(u'Initializing an InventorySnapshot object')
+        self.database_filename = database_filename
+        self.detail_max_age = detail_max_age
+        # The REST connection can read from the snapshot from other threads, so all access goes through the lock
+        self.db = sqlite3.connect(database_filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.__lock = threading.RLock()
+        self.create_tables()
+
+    def close(self):
+        with self.__lock:
+            self.db.close()
+
+    def create_tables(self):
+        with self.__lock:
+            self.db.executescript(inventory_snapshot_schema)
+            self.db.commit()
+
+    #
+    # Building and refreshing the snapshot
+    #
+
+    # Snapshots every site (or just those in site_content_urls) that the signed in user can reach. A connection to
+    # each site is made and signed in to in turn
+    def refresh_server(self, tableau_rest_api_obj, site_content_urls=None, include_permissions=True,
+                       incremental=True):
+        """
+        :type tableau_rest_api_obj: TableauRestApiConnection
+        """
+        self.start_log_block()
+        sites = tableau_rest_api_obj.query_sites(as_records=True)
+        with self.__lock:
+            self.db.execute(u'DELETE FROM sites')
+            for site in sites:
+                self.db.execute(u'INSERT INTO sites (site_luid, name, content_url, admin_mode, state) '
+                                u'VALUES (?, ?, ?, ?, ?)',
+                                (site.id, site.name, site.content_url, site.admin_mode, site.state))
+            self.db.commit()
+        self.refresh_schedules(tableau_rest_api_obj)
+        for site in sites:
+            if site_content_urls is not None and site.content_url not in site_content_urls:
+                continue
+            self.log(u'Snapshotting site {}'.format(site.content_url))
+            site_connection = tableau_rest_api_obj.create_connection_to_site(site.content_url)
+            site_connection.signin()
+            try:
+                self.refresh_site(site_connection, include_permissions, incremental)
+            finally:
+                site_connection.signout()
+        self.end_log_block()
+
+    # Snapshots the site the connection is signed in to
+    def refresh_site(self, tableau_rest_api_obj, include_permissions=True, incremental=True):
+        """
+        :type tableau_rest_api_obj: TableauRestApiConnection
+        """
+        self.start_log_block()
+        t = tableau_rest_api_obj
+        site_luid = t.site_luid
+        # A full refresh starts the details from scratch. The detail rows go along with detail_state, otherwise the
+        # details of objects deleted from the site would never be cleaned up
+        if incremental is False:
+            detail_types = [u'group_members']
+            if include_permissions is True:
+                detail_types.extend([u'project_permissions', u'workbook_permissions', u'datasource_permissions'])
+            with self.__lock:
+                for detail_type in detail_types:
+                    (table_name, key_column) = inventory_snapshot_detail_tables[detail_type]
+                    self.db.execute(u'DELETE FROM {} WHERE site_luid = ?'.format(table_name), (site_luid, ))
+                    self.db.execute(u'DELETE FROM detail_state WHERE site_luid = ? AND detail_type = ?',
+                                    (site_luid, detail_type))
+                self.db.commit()
+
+        users = t.query_users(as_records=True)
+        self.replace_site_rows(site_luid, u'users', [(u.id, u.name, u.full_name, u.site_role, u.last_login)
+                                                     for u in users])
+        groups = t.query_groups(as_records=True)
+        self.replace_site_rows(site_luid, u'groups', [(g.id, g.name, g.domain_name) for g in groups])
+        projects = t.query_projects(as_records=True)
+        self.replace_site_rows(site_luid, u'projects', [(p.id, p.name, p.description, p.parent_project_id)
+                                                        for p in projects])
+        datasources = t.query_datasources(as_records=True)
+        self.replace_site_rows(site_luid, u'datasources', [(d.id, d.name, d.content_url, d.type, d.project_id,
+                                                            d.project_name, d.owner_id, d.created_at, d.updated_at)
+                                                           for d in datasources])
+        refreshed = [u'users', u'groups', u'projects', u'datasources', u'group_members']
+        # Only the whole site's list will do here: a partial one would drop the other workbooks and their permissions
+        try:
+            workbooks = t.query_workbooks_for_site(as_records=True)
+            self.replace_site_rows(site_luid, u'workbooks', [(w.id, w.name, w.content_url, w.project_id,
+                                                              w.project_name, w.owner_id, w.created_at, w.updated_at)
+                                                             for w in workbooks])
+            refreshed.append(u'workbooks')
+        except InvalidOptionException:
+            self.log(u'Workbooks for the whole site need API 2.3+, skipping them')
+            workbooks = None
+        try:
+            views = t.query_views_for_site(as_records=True)
+            self.replace_site_rows(site_luid, u'views', [(v.id, v.name, v.content_url, v.workbook_id, v.owner_id)
+                                                         for v in views])
+            refreshed.append(u'views')
+        except InvalidOptionException:
+            self.log(u'Views for the whole site need API 2.2+, skipping them')
+
+        # Groups have no updatedAt, so their members are refetched only when new or past detail_max_age
+        for (luid, updated_at) in self.get_objects_needing_details(site_luid, u'group_members',
+                                                                   [(g.id, None) for g in groups]):
+            members = t.query_resource_records(u'groups/{}/users'.format(luid), UserRecord)
+            self.replace_detail_rows(site_luid, u'group_members', luid, updated_at, [(m.id, ) for m in members])
+
+        if include_permissions is True:
+            object_lists = [(u'project', [(p.id, None) for p in projects]),
+                            (u'datasource', [(d.id, d.updated_at) for d in datasources])]
+            if workbooks is not None:
+                object_lists.append((u'workbook', [(w.id, w.updated_at) for w in workbooks]))
+            for (object_type, objects) in object_lists:
+                detail_type = object_type + u'_permissions'
+                for (luid, updated_at) in self.get_objects_needing_details(site_luid, detail_type, objects):
+                    permissions_xml = t.query_permissions_by_luid(object_type, luid)
+                    rows = self.convert_permissions_xml_to_rows(permissions_xml, object_type, t.ns_prefix)
+                    self.replace_detail_rows(site_luid, detail_type, luid, updated_at, rows)
+            refreshed.append(u'permissions')
+
+        self.set_refreshed(site_luid, refreshed)
+        self.end_log_block()
+
+    def refresh_schedules(self, tableau_rest_api_obj):
+        self.start_log_block()
+        try:
+            schedules_xml = tableau_rest_api_obj.query_schedules()
+        except InvalidOptionException:
+            self.log(u'Schedules need API 2.2+, skipping them')
+            self.end_log_block()
+            return
+        rows = []
+        for schedule in schedules_xml.iter(tableau_rest_api_obj.ns_prefix + u'schedule'):
+            rows.append((schedule.get(u'id'), schedule.get(u'name'), schedule.get(u'state'),
+                         schedule.get(u'priority'), schedule.get(u'type'), schedule.get(u'frequency'),
+                         schedule.get(u'nextRunAt')))
+        with self.__lock:
+            self.db.execute(u'DELETE FROM schedules')
+            self.db.executemany(u'INSERT INTO schedules (schedule_luid, name, state, priority, type, frequency, '
+                                u'next_run_at) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.commit()
+        self.set_refreshed(u'', [u'schedules'])
+        self.end_log_block()
+
+    # Every (grantee, capability) in a permissions response becomes a row
+    @staticmethod
+    def convert_permissions_xml_to_rows(permissions_xml, object_type, ns_prefix):
+        rows = []
+        for gcaps in permissions_xml.iter(ns_prefix + u'granteeCapabilities'):
+            grantee_type = None
+            grantee_luid = None
+            for child in gcaps:
+                if child.tag in [ns_prefix + u'group', ns_prefix + u'user']:
+                    grantee_type = child.tag[len(ns_prefix):]
+                    grantee_luid = child.get(u'id')
+            for capability in gcaps.iter(ns_prefix + u'capability'):
+                rows.append((object_type, grantee_type, grantee_luid, capability.get(u'name'),
+                             capability.get(u'mode')))
+        return rows
+
+    # Lists are small next to the per-object details, so each refresh simply replaces the site's rows
+    def replace_site_rows(self, site_luid, table_name, rows):
+        columns = inventory_snapshot_columns[table_name]
+        with self.__lock:
+            self.db.execute(u'DELETE FROM {} WHERE site_luid = ?'.format(table_name), (site_luid, ))
+            self.db.executemany(u'INSERT INTO {} (site_luid, {}) VALUES (?, {})'.format(
+                                table_name, u', '.join(columns), u', '.join([u'?'] * len(columns))),
+                                [(site_luid, ) + tuple(row) for row in rows])
+            self.db.commit()
+        self.log(u'{} {} rows saved for site {}'.format(len(rows), table_name, site_luid))
+
+    # Replaces the details of one object and records when they were fetched, in the same transaction so an
+    # interrupted refresh never leaves an object marked as fetched without its rows
+    def replace_detail_rows(self, site_luid, detail_type, object_luid, updated_at, rows):
+        (table_name, key_column) = inventory_snapshot_detail_tables[detail_type]
+        columns = inventory_snapshot_columns[table_name]
+        with self.__lock:
+            self.db.execute(u'DELETE FROM {} WHERE site_luid = ? AND {} = ?'.format(table_name, key_column),
+                            (site_luid, object_luid))
+            self.db.executemany(u'INSERT INTO {} (site_luid, {}, {}) VALUES (?, ?, {})'.format(
+                                table_name, key_column, u', '.join(columns), u', '.join([u'?'] * len(columns))),
+                                [(site_luid, object_luid) + tuple(row) for row in rows])
+            self.db.execute(u'INSERT OR REPLACE INTO detail_state (site_luid, detail_type, object_luid, updated_at, '
+                            u'refreshed_at) VALUES (?, ?, ?, ?, ?)',
+                            (site_luid, detail_type, object_luid, updated_at, time.time()))
+            self.db.commit()
+
+    # objects is a list of (luid, updated_at). Returns the (luid, updated_at) pairs whose details have to be fetched
+    # again. Details of objects that no longer exist are removed
+    def get_objects_needing_details(self, site_luid, detail_type, objects):
+        now = time.time()
+        needed = []
+        with self.__lock:
+            existing = {}
+            for row in self.db.execute(u'SELECT object_luid, updated_at, refreshed_at FROM detail_state '
+                                       u'WHERE site_luid = ? AND detail_type = ?', (site_luid, detail_type)):
+                existing[row['object_luid']] = row
+            for (luid, updated_at) in objects:
+                state = existing.pop(luid, None)
+                if state is None or state['updated_at'] != updated_at:
+                    needed.append((luid, updated_at))
+                elif self.detail_max_age is not None and now - state['refreshed_at'] > self.detail_max_age:
+                    needed.append((luid, updated_at))
+            # Whatever is left over has been deleted from the site
+            (table_name, key_column) = inventory_snapshot_detail_tables[detail_type]
+            for luid in existing:
+                self.db.execute(u'DELETE FROM {} WHERE site_luid = ? AND {} = ?'.format(table_name, key_column),
+                                (site_luid, luid))
+                self.db.execute(u'DELETE FROM detail_state WHERE site_luid = ? AND detail_type = ? '
+                                u'AND object_luid = ?', (site_luid, detail_type, luid))
+            self.db.commit()
+        self.log(u'{} of {} objects need {} refreshed'.format(len(needed), len(objects), detail_type))
+        return needed
+
+    def set_refreshed(self, site_luid, resources):
+        now = time.time()
+        with self.__lock:
+            self.db.executemany(u'INSERT OR REPLACE INTO snapshot_state (site_luid, resource, refreshed_at) '
+                                u'VALUES (?, ?, ?)', [(site_luid, resource, now) for resource in resources])
+            self.db.commit()
+
+    #
+    # Reading from the snapshot
+    #
+
+    # Seconds since the resource (u'users', u'workbooks', u'permissions' etc.) was refreshed for the site,
+    # or None if it never has been
+    def get_age(self, site_luid, resource):
+        with self.__lock:
+            row = self.db.execute(u'SELECT refreshed_at FROM snapshot_state WHERE site_luid = ? AND resource = ?',
+                                  (site_luid, resource)).fetchone()
+        if row is None:
+            return None
+        return time.time() - row['refreshed_at']
+
+    def is_fresh(self, site_luid, resource, max_age_seconds):
+        age = self.get_age(site_luid, resource)
+        return age is not None and age <= max_age_seconds
+
+    # Runs any SQL against the snapshot, returning a list of dicts
+    def query(self, sql, parameters=()):
+        with self.__lock:
+            rows = self.db.execute(sql, parameters).fetchall()
+        return [dict(zip(row.keys(), row)) for row in rows]
+
+    # LUIDs of everything in a table with the given name, optionally limited to a project (by name or luid)
+    def query_luids_by_name(self, site_luid, table_name, name, project_name_or_luid=None):
+        sql = u'SELECT {}_luid AS luid FROM {} WHERE site_luid = ? AND name = ?'.format(table_name[:-1], table_name)
+        parameters = [site_luid, name]
+        if project_name_or_luid is not None:
+            if self.is_luid(project_name_or_luid):
+                sql += u' AND project_luid = ?'
+            else:
+                sql += u' AND project_name = ?'
+            parameters.append(project_name_or_luid)
+        return [row['luid'] for row in self.query(sql, parameters)]
+
+    # Records in the same form that the as_records=True queries return
+    def query_records(self, site_luid, table_name):
+        record_class = inventory_snapshot_record_classes[table_name]
+        records = []
+        for row in self.query(u'SELECT * FROM {} WHERE site_luid = ?'.format(table_name), (site_luid, )):
+            values = {}
+            for slot in record_class.__slots__:
+                values[slot] = row.get(inventory_snapshot_record_columns.get(slot, slot))
+            values[u'id'] = row['{}_luid'.format(table_name[:-1])]
+            records.append(record_class(**values))
+        return records
+
+    def query_workbooks_owned_by_user_in_project(self, site_luid, username, project_name):
+        return self.query(u'SELECT w.* FROM workbooks w JOIN users u ON u.site_luid = w.site_luid '
+                          u'AND u.user_luid = w.owner_luid WHERE w.site_luid = ? AND u.name = ? '
+                          u'AND w.project_name = ?', (site_luid, username, project_name))
+
+    def query_groups_for_user(self, site_luid, username):
+        return self.query(u'SELECT g.* FROM groups g JOIN group_members m ON m.site_luid = g.site_luid '
+                          u'AND m.group_luid = g.group_luid JOIN users u ON u.site_luid = m.site_luid '
+                          u'AND u.user_luid = m.user_luid WHERE g.site_luid = ? AND u.name = ?',
+                          (site_luid, username))
+
+    def query_permissions_for_object(self, site_luid, object_luid):
+        return self.query(u'SELECT * FROM permissions WHERE site_luid = ? AND object_luid = ?',
+                          (site_luid, object_luid))
+
+
+# Columns after site_luid, in the order the refresh methods give them. Detail tables leave out their key column
+inventory_snapshot_columns = {
+    u'users': (u'user_luid', u'name', u'full_name', u'site_role', u'last_login'),
+    u'groups': (u'group_luid', u'name', u'domain_name'),
+    u'projects': (u'project_luid', u'name', u'description', u'parent_project_luid'),
+    u'workbooks': (u'workbook_luid', u'name', u'content_url', u'project_luid', u'project_name', u'owner_luid',
+                   u'created_at', u'updated_at'),
+    u'datasources': (u'datasource_luid', u'name', u'content_url', u'type', u'project_luid', u'project_name',
+                     u'owner_luid', u'created_at', u'updated_at'),
+    u'views': (u'view_luid', u'name', u'content_url', u'workbook_luid', u'owner_luid'),
+    u'group_members': (u'user_luid', ),
+    u'permissions': (u'object_type', u'grantee_type', u'grantee_luid', u'capability', u'mode')
+}
+
+# detail type : (table, key column)
+inventory_snapshot_detail_tables = {
+    u'group_members': (u'group_members', u'group_luid'),
+    u'project_permissions': (u'permissions', u'object_luid'),
+    u'workbook_permissions': (u'permissions', u'object_luid'),
+    u'datasource_permissions': (u'permissions', u'object_luid')
+}
+
+inventory_snapshot_record_classes = {u'users': UserRecord, u'groups': GroupRecord, u'projects': ProjectRecord,
+                                     u'workbooks': WorkbookRecord, u'datasources': DatasourceRecord,
+                                     u'views': ViewRecord}
+
+# Record attributes that are stored under a different column name
+inventory_snapshot_record_columns = {u'project_id': u'project_luid', u'owner_id': u'owner_luid',
+                                     u'workbook_id': u'workbook_luid', u'parent_project_id': u'parent_project_luid'}
+
+inventory_snapshot_schema = u'''
+CREATE TABLE IF NOT EXISTS sites (site_luid TEXT PRIMARY KEY, name TEXT, content_url TEXT, admin_mode TEXT,
+    state TEXT);
+CREATE TABLE IF NOT EXISTS users (site_luid TEXT, user_luid TEXT, name TEXT, full_name TEXT, site_role TEXT,
+    last_login TEXT, PRIMARY KEY (site_luid, user_luid));
+CREATE INDEX IF NOT EXISTS users_name ON users (site_luid, name);
+CREATE TABLE IF NOT EXISTS groups (site_luid TEXT, group_luid TEXT, name TEXT, domain_name TEXT,
+    PRIMARY KEY (site_luid, group_luid));
+CREATE INDEX IF NOT EXISTS groups_name ON groups (site_luid, name);
+CREATE TABLE IF NOT EXISTS group_members (site_luid TEXT, group_luid TEXT, user_luid TEXT,
+    PRIMARY KEY (site_luid, group_luid, user_luid));
+CREATE INDEX IF NOT EXISTS group_members_user ON group_members (site_luid, user_luid);
+CREATE TABLE IF NOT EXISTS projects (site_luid TEXT, project_luid TEXT, name TEXT, description TEXT,
+    parent_project_luid TEXT, PRIMARY KEY (site_luid, project_luid));
+CREATE INDEX IF NOT EXISTS projects_name ON projects (site_luid, name);
+CREATE TABLE IF NOT EXISTS workbooks (site_luid TEXT, workbook_luid TEXT, name TEXT, content_url TEXT,
+    project_luid TEXT, project_name TEXT, owner_luid TEXT, created_at TEXT, updated_at TEXT,
+    PRIMARY KEY (site_luid, workbook_luid));
+CREATE INDEX IF NOT EXISTS workbooks_name ON workbooks (site_luid, name);
+CREATE INDEX IF NOT EXISTS workbooks_project ON workbooks (site_luid, project_luid);
+CREATE INDEX IF NOT EXISTS workbooks_owner ON workbooks (site_luid, owner_luid);
+CREATE TABLE IF NOT EXISTS datasources (site_luid TEXT, datasource_luid TEXT, name TEXT, content_url TEXT, type TEXT,
+    project_luid TEXT, project_name TEXT, owner_luid TEXT, created_at TEXT, updated_at TEXT,
+    PRIMARY KEY (site_luid, datasource_luid));
+CREATE INDEX IF NOT EXISTS datasources_name ON datasources (site_luid, name);
+CREATE INDEX IF NOT EXISTS datasources_project ON datasources (site_luid, project_luid);
+CREATE TABLE IF NOT EXISTS views (site_luid TEXT, view_luid TEXT, name TEXT, content_url TEXT, workbook_luid TEXT,
+    owner_luid TEXT, PRIMARY KEY (site_luid, view_luid));
+CREATE INDEX IF NOT EXISTS views_workbook ON views (site_luid, workbook_luid);
+CREATE TABLE IF NOT EXISTS schedules (schedule_luid TEXT PRIMARY KEY, name TEXT, state TEXT, priority TEXT,
+    type TEXT, frequency TEXT, next_run_at TEXT);
+CREATE TABLE IF NOT EXISTS permissions (site_luid TEXT, object_luid TEXT, object_type TEXT, grantee_type TEXT,
+    grantee_luid TEXT, capability TEXT, mode TEXT);
+CREATE INDEX IF NOT EXISTS permissions_object ON permissions (site_luid, object_luid);
+CREATE INDEX IF NOT EXISTS permissions_grantee ON permissions (site_luid, grantee_luid);
+CREATE TABLE IF NOT EXISTS detail_state (site_luid TEXT, detail_type TEXT, object_luid TEXT, updated_at TEXT,
+    refreshed_at REAL, PRIMARY KEY (site_luid, detail_type, object_luid));
+CREATE TABLE IF NOT EXISTS snapshot_state (site_luid TEXT, resource TEXT, refreshed_at REAL,
+    PRIMARY KEY (site_luid, resource));
+'''
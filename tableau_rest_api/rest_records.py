@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+
+# Compact stand-ins for the elements of REST API list responses. Each record holds only the values listed in its
+# class, in __slots__, so a list of them is a small fraction of the size of the lxml tree it was read from.
+# get() accepts either the XML attribute name (u'updatedAt') or the record attribute name (u'updated_at'), so a list
+# of records can be passed to anything that calls .get() on elements, like convert_xml_list_to_name_id_dict
+class RestRecord(object):
+    __slots__ = ()
+    # Tag of the elements in the response that become records
+    tag = None
+    # (record attribute, XML attribute) read from the element itself
+    attributes = ()
+    # (record attribute, child tag, XML attribute) read from a child element, like <project> or <owner>
+    child_attributes = ()
+    # { XML attribute : record attribute }, filled in by register_rest_record()
+    xml_attribute_map = {}
+
+    def __init__(self, **values):
+        for slot in self.__slots__:
+            setattr(self, slot, values.get(slot))
+
+    @classmethod
+    def from_element(cls, element, ns_prefix):
+        record = cls.__new__(cls)
+        for (slot, xml_attribute) in cls.attributes:
+            setattr(record, slot, element.get(xml_attribute))
+        for (slot, child_tag, xml_attribute) in cls.child_attributes:
+            child = element.find(ns_prefix + child_tag)
+            if child is None:
+                setattr(record, slot, None)
+            else:
+                setattr(record, slot, child.get(xml_attribute))
+        return record
+
+    def get(self, key, default=None):
+        slot = self.xml_attribute_map.get(key, key)
+        if slot in self.__slots__:
+            value = getattr(self, slot)
+            if value is not None:
+                return value
+        return default
+
+    def to_dict(self):
+        d = {}
+        for slot in self.__slots__:
+            d[slot] = getattr(self, slot)
+        return d
+
+    def __repr__(self):
+        return u'<{} id={} name={}>'.format(self.__class__.__name__, self.get(u'id'), self.get(u'name')).encode('utf-8')
+
+
+# Fills in the XML attribute map from the attribute list, so each record class only lists its attributes once
+def register_rest_record(record_class):
+    xml_attribute_map = {}
+    for (slot, xml_attribute) in record_class.attributes:
+        xml_attribute_map[xml_attribute] = slot
+    record_class.xml_attribute_map = xml_attribute_map
+    return record_class
+
+
+class WorkbookRecord(RestRecord):
+    __slots__ = (u'id', u'name', u'content_url', u'show_tabs', u'size', u'created_at', u'updated_at',
+                 u'project_id', u'project_name', u'owner_id')
+    tag = u'workbook'
+    attributes = ((u'id', u'id'), (u'name', u'name'), (u'content_url', u'contentUrl'), (u'show_tabs', u'showTabs'),
+                  (u'size', u'size'), (u'created_at', u'createdAt'), (u'updated_at', u'updatedAt'))
+    child_attributes = ((u'project_id', u'project', u'id'), (u'project_name', u'project', u'name'),
+                        (u'owner_id', u'owner', u'id'))
+
+
+class DatasourceRecord(RestRecord):
+    __slots__ = (u'id', u'name', u'content_url', u'type', u'created_at', u'updated_at',
+                 u'project_id', u'project_name', u'owner_id')
+    tag = u'datasource'
+    attributes = ((u'id', u'id'), (u'name', u'name'), (u'content_url', u'contentUrl'), (u'type', u'type'),
+                  (u'created_at', u'createdAt'), (u'updated_at', u'updatedAt'))
+    child_attributes = ((u'project_id', u'project', u'id'), (u'project_name', u'project', u'name'),
+                        (u'owner_id', u'owner', u'id'))
+
+
+class ProjectRecord(RestRecord):
+    __slots__ = (u'id', u'name', u'description', u'content_permissions', u'parent_project_id')
+    tag = u'project'
+    attributes = ((u'id', u'id'), (u'name', u'name'), (u'description', u'description'),
+                  (u'content_permissions', u'contentPermissions'), (u'parent_project_id', u'parentProjectId'))
+
+
+class UserRecord(RestRecord):
+    __slots__ = (u'id', u'name', u'full_name', u'site_role', u'last_login', u'external_auth_user_id')
+    tag = u'user'
+    attributes = ((u'id', u'id'), (u'name', u'name'), (u'full_name', u'fullName'), (u'site_role', u'siteRole'),
+                  (u'last_login', u'lastLogin'), (u'external_auth_user_id', u'externalAuthUserId'))
+
+
+class GroupRecord(RestRecord):
+    __slots__ = (u'id', u'name', u'domain_name')
+    tag = u'group'
+    attributes = ((u'id', u'id'), (u'name', u'name'))
+    child_attributes = ((u'domain_name', u'domain', u'name'), )
+
+
+class ViewRecord(RestRecord):
+    __slots__ = (u'id', u'name', u'content_url', u'workbook_id', u'owner_id', u'total_view_count')
+    tag = u'view'
+    attributes = ((u'id', u'id'), (u'name', u'name'), (u'content_url', u'contentUrl'))
+    child_attributes = ((u'workbook_id', u'workbook', u'id'), (u'owner_id', u'owner', u'id'),
+                        (u'total_view_count', u'usage', u'totalViewCount'))
+
+
+class SiteRecord(RestRecord):
+    __slots__ = (u'id', u'name', u'content_url', u'admin_mode', u'state')
+    tag = u'site'
+    attributes = ((u'id', u'id'), (u'name', u'name'), (u'content_url', u'contentUrl'), (u'admin_mode', u'adminMode'),
+                  (u'state', u'state'))
+
+
+for rest_record_class in [WorkbookRecord, DatasourceRecord, ProjectRecord, UserRecord, GroupRecord, ViewRecord,
+                          SiteRecord]:
+    register_rest_record(rest_record_class)
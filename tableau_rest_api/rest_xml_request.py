@@ -3,6 +3,7 @@ from ..tableau_exceptions import *
 import urllib2
 from lxml import etree
 from HTMLParser import HTMLParser
+from rest_xpath import run_rest_xpath
 from StringIO import StringIO
 import re
 import math
@@ -85,7 +86,8 @@ class RestXmlRequest(TableauBase):
     # Using urllib2 with some modification, you could substitute in Requests or httplib
     # depending on preference. Must be able to do the verbs listed in self.defined_http_verbs
     # Larger requests require pagination (starting at 1), thus page_number argument can be called.
-    def __make_request(self, page_number=1):
+    # Returns the open response object, with the headers read but none of the body
+    def __open_request(self, page_number=1):
         self.log(u"HTTP verb is {}".format(self.__http_verb))
         url = self.__base_url.encode('utf8')
         if page_number > 0:
@@ -125,30 +127,9 @@ class RestXmlRequest(TableauBase):
             if self.__xml_request is not None:
                 self.log(u"Request XML:\n{}".format(self.__xml_request))
             response = opener.open(request)
-
-            # Tableau 9.0 doesn't return real UTF-8 but escapes all unicode characters using numeric character encoding
-            initial_response = response.read()  # Leave the UTF8 decoding to lxml
             self.__last_response_content_type = response.info().getheader('Content-Type')
             self.log(u"Content type from headers: {}".format(self.__last_response_content_type))
-            # Don't botherw with any extra work if the response is expected to be binary
-            if self.__response_type == u'binary':
-                self.__raw_response = initial_response
-                return initial_response
-
-            # Use HTMLParser to get rid of the escaped unicode sequences, then encode the thing as utf-8
-            parser = HTMLParser()
-            unicode_raw_response = parser.unescape(initial_response)
-
-            try:
-                self.__raw_response = unicode_raw_response.encode('utf-8')
-            # Sometimes it appears we actually send this stuff in UTF8
-            except UnicodeDecodeError:
-                self.__raw_response = unicode_raw_response
-                unicode_raw_response = unicode_raw_response.decode('utf-8')
-
-            if self.__response_type == 'xml':
-                self.log(u"Raw Response:\n{}".format(unicode_raw_response))
-            return True
+            return response
         except urllib2.HTTPError as e:
             # No recoverying from a 500
             if e.code >= 500:
@@ -161,16 +142,16 @@ class RestXmlRequest(TableauBase):
             utf8_parser = etree.XMLParser(encoding='utf-8')
             xml = etree.parse(StringIO(raw_error_response), parser=utf8_parser)
             try:
-                tableau_error = xml.xpath(u'//t:error', namespaces=self.ns_map)
+                tableau_error = run_rest_xpath(xml, u'all_error', self.ns_map)
                 error_code = tableau_error[0].get('code')
-                tableau_detail = xml.xpath(u'//t:detail', namespaces=self.ns_map)
+                tableau_detail = run_rest_xpath(xml, u'all_detail', self.ns_map)
                 detail_text = tableau_detail[0].text
             # This is to capture an error from the old API version when doing tests
             except IndexError:
                 old_ns_map = {'t': 'http://tableausoftware.com/api'}
-                tableau_error = xml.xpath(u'//t:error', namespaces=old_ns_map)
+                tableau_error = run_rest_xpath(xml, u'all_error', old_ns_map)
                 error_code = tableau_error[0].get('code')
-                tableau_detail = xml.xpath(u'//t:detail', namespaces=old_ns_map)
+                tableau_detail = run_rest_xpath(xml, u'all_detail', old_ns_map)
                 detail_text = tableau_detail[0].text
             detail_luid_match_obj = re.search(self.__luid_pattern, detail_text)
             if detail_luid_match_obj:
@@ -190,6 +171,68 @@ class RestXmlRequest(TableauBase):
         except:
             raise
 
+    def __make_request(self, page_number=1):
+        response = self.__open_request(page_number)
+
+        # Tableau 9.0 doesn't return real UTF-8 but escapes all unicode characters using numeric character encoding
+        initial_response = response.read()  # Leave the UTF8 decoding to lxml
+        # Don't botherw with any extra work if the response is expected to be binary
+        if self.__response_type == u'binary':
+            self.__raw_response = initial_response
+            return initial_response
+
+        # Use HTMLParser to get rid of the escaped unicode sequences, then encode the thing as utf-8
+        parser = HTMLParser()
+        unicode_raw_response = parser.unescape(initial_response)
+
+        try:
+            self.__raw_response = unicode_raw_response.encode('utf-8')
+        # Sometimes it appears we actually send this stuff in UTF8
+        except UnicodeDecodeError:
+            self.__raw_response = unicode_raw_response
+            unicode_raw_response = unicode_raw_response.decode('utf-8')
+
+        if self.__response_type == 'xml':
+            self.log(u"Raw Response:\n{}".format(unicode_raw_response))
+        return True
+
+    # For large binary responses. Returns the open response object so the body can be read in chunks by the caller,
+    # rather than being held in memory. Content type is available from get_last_response_content_type() beforehand
+    def open_binary_response_stream(self):
+        self.set_response_type(u'binary')
+        return self.__open_request(0)
+
+    # Alternative to request_from_api for list responses. Each page is read with iterparse and every element of
+    # record_class.tag is turned into a record (see rest_records) and then thrown away, so the full lxml tree is never
+    # built. Returns the list of records from all of the pages
+    def request_records_from_api(self, record_class):
+        self.set_response_type(u'xml')
+        ns_prefix = u'{' + self.ns_map['t'] + u'}'
+        pagination_tag = ns_prefix + u'pagination'
+        records = []
+        page_number = 1
+        total_pages = 1
+        while page_number <= total_pages:
+            self.__make_request(page_number)
+            if self.__raw_response == '':
+                break
+            for (event, element) in etree.iterparse(StringIO(self.__raw_response), events=('end', ),
+                                                    tag=(pagination_tag, ns_prefix + record_class.tag),
+                                                    recover=True, huge_tree=True):
+                if element.tag == pagination_tag:
+                    page_size = int(element.get('pageSize'))
+                    total_available = int(element.get('totalAvailable'))
+                    total_pages = int(math.ceil(float(total_available) / float(page_size)))
+                    continue
+                records.append(record_class.from_element(element, ns_prefix))
+                # Free the element and any already handled before it
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            page_number += 1
+        self.log(u'{} {} records read from {} pages'.format(len(records), record_class.tag, page_number - 1))
+        return records
+
     def request_from_api(self, page_number=1):
         try:
             self.__make_request(page_number)
@@ -204,7 +247,7 @@ class RestXmlRequest(TableauBase):
             self.__xml_object = xml
             combined_xml_string = u'<tsResponse xmlns="{}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="{} {}/ts-api-2.0.xsd">'.format(
                     self.ns_map['t'], self.ns_map['t'], self.ns_map['t'])
-            for pagination in xml.xpath(u'//t:pagination', namespaces=self.ns_map):
+            for pagination in run_rest_xpath(xml, u'all_pagination', self.ns_map):
 
                 # page_number = int(pagination.get('pageNumber'))
                 page_size = int(pagination.get('pageSize'))
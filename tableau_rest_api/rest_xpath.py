@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from lxml import etree
+
+
+# XPath expressions used against REST API responses. Values are passed in as XPath variables ($name) rather than
+# formatted into the expression, so each one is compiled once and names containing quotes can't break the query
+rest_xpaths = {
+    u'datasource_by_name': u'//t:datasource[@name = $name]',
+    u'datasource_by_name_in_project_luid': u'//t:datasource[@name = $name][t:project/@id = $project]',
+    u'datasource_by_name_in_project_name': u'//t:datasource[@name = $name][t:project/@name = $project]',
+    u'datasource_by_type': u'//t:datasource[@type = $type]',
+    u'datasource_in_project_luid': u'//t:datasource[t:project/@id = $project]',
+    u'group_by_luid': u'//t:group[@id = $luid]',
+    u'group_by_name': u'//t:group[@name = $name]',
+    u'project_by_luid': u'//t:project[@id = $luid]',
+    u'project_by_name': u'//t:project[@name = $name]',
+    u'user_by_name': u'//t:user[@name = $name]',
+    u'workbook_by_name': u'//t:workbook[@name = $name]',
+    u'workbook_by_name_in_project_luid': u'//t:workbook[@name = $name][t:project/@id = $project]',
+    u'workbook_by_name_in_project_name': u'//t:workbook[@name = $name][t:project/@name = $project]',
+    u'workbook_in_project_luid': u'//t:workbook[t:project/@id = $project]'
+}
+
+# Every element of a given type, e.g. 'all_job' for the job in a response
+for rest_xpath_tag in [u'credentials', u'datasource', u'detail', u'error', u'fileUpload', u'granteeCapabilities',
+                       u'group', u'job', u'pagination', u'project', u'schedule', u'site', u'subscription', u'user',
+                       u'workbook']:
+    rest_xpaths[u'all_{}'.format(rest_xpath_tag)] = u'//t:{}'.format(rest_xpath_tag)
+
+# { (expression name, namespace URL) : etree.XPath }. The namespace changes with the API version, so it is part of
+# the key. Compiled XPath objects are safe to share between threads
+rest_xpath_cache = {}
+
+
+def get_rest_xpath(expression_name, ns_map):
+    key = (expression_name, ns_map[u't'])
+    compiled = rest_xpath_cache.get(key)
+    if compiled is None:
+        compiled = etree.XPath(rest_xpaths[expression_name], namespaces=ns_map)
+        rest_xpath_cache[key] = compiled
+    return compiled
+
+
+# Runs one of the named expressions, with any variables given as keyword arguments
+def run_rest_xpath(lxml_obj, expression_name, ns_map, **variables):
+    return get_rest_xpath(expression_name, ns_map)(lxml_obj, **variables)
+
+
+# One pass over a list response, building { attribute value : [ elements ] } for every element of the given tag.
+# Use when looking up many values in the same response, rather than running an XPath for each one
+def build_rest_xml_index(lxml_obj, tag, ns_map, attribute=u'name'):
+    index = {}
+    for element in lxml_obj.iter(u'{{{}}}{}'.format(ns_map[u't'], tag)):
+        value = element.get(attribute)
+        if value in index:
+            index[value].append(element)
+        else:
+            index[value] = [element]
+    return index
+
+
+# One pass over a list response, building { project luid : [ elements ] } for workbooks or datasources
+def build_rest_xml_project_index(lxml_obj, tag, ns_map):
+    index = {}
+    project_tag = u'{{{}}}project'.format(ns_map[u't'])
+    for element in lxml_obj.iter(u'{{{}}}{}'.format(ns_map[u't'], tag)):
+        project = element.find(project_tag)
+        project_luid = None
+        if project is not None:
+            project_luid = project.get(u'id')
+        if project_luid in index:
+            index[project_luid].append(element)
+        else:
+            index[project_luid] = [element]
+    return index
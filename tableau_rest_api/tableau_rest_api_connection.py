@@ -2,6 +2,7 @@
 
 import os
 import copy
+import tempfile
 
 from ..tableau_base import *
 from ..tableau_documents.tableau_packaged_file import TableauPackagedFile
@@ -10,6 +11,8 @@ from ..tableau_documents.tableau_datasource import TableauDatasource
 from ..tableau_exceptions import *
 from grantee_capabilities import GranteeCapabilities
 from rest_xml_request import RestXmlRequest
+from rest_records import *
+from rest_xpath import run_rest_xpath, build_rest_xml_index, build_rest_xml_project_index
 from published_content import Project, Workbook, Datasource
 
 
@@ -32,6 +35,15 @@ class TableauRestApiConnection(TableauBase):
         self.logger = None
         self.__last_response_content_type = None
 
+        # (Content-Type, file extension) pairs for the binary responses of the download methods
+        self.workbook_extension_map = [(u'application/xml', u'.twb'), (u'application/octet-stream', u'.twbx')]
+        self.datasource_extension_map = [(u'application/xml', u'.tds'), (u'application/octet-stream', u'.tdsx')]
+        # Downloads without a filename are kept in memory up to this size, then spooled to an anonymous temp file
+        self.spooled_download_max_size = 1024 * 1024 * 100
+        # See use_inventory_snapshot()
+        self.inventory_snapshot = None
+        self.inventory_snapshot_max_age = None
+
         # All defined in TableauBase superclass
         self.__site_roles = self.site_roles
         self.__permissionable_objects = self.permissionable_objects
@@ -48,6 +60,34 @@ class TableauRestApiConnection(TableauBase):
     def set_last_error(self, error):
         self.__last_error = error
 
+    # A new (not signed in) connection to another site on the same server, with the same credentials
+    def create_connection_to_site(self, site_content_url):
+        t = self.__class__(self.__server, self.__username, self.__password, site_content_url=site_content_url)
+        if self.logger is not None:
+            t.enable_logging(self.logger)
+        return t
+
+    # Answers the LUID lookups and as_records=True list queries for users, groups, projects and datasources from an
+    # InventorySnapshot of this site, as long as that part of the snapshot is no older than max_age_seconds.
+    # Anything older, or not in the snapshot, goes to the server as usual
+    def use_inventory_snapshot(self, inventory_snapshot, max_age_seconds=(60 * 60)):
+        self.inventory_snapshot = inventory_snapshot
+        self.inventory_snapshot_max_age = max_age_seconds
+
+    def stop_using_inventory_snapshot(self):
+        self.inventory_snapshot = None
+        self.inventory_snapshot_max_age = None
+
+    # The snapshot if resource (u'users', u'projects' etc.) can be answered from it, otherwise None
+    def get_fresh_inventory_snapshot(self, resource):
+        if self.inventory_snapshot is None:
+            return None
+        if self.inventory_snapshot.is_fresh(self.site_luid, resource, self.inventory_snapshot_max_age):
+            self.log(u'Answering from the inventory snapshot of {}'.format(resource))
+            return self.inventory_snapshot
+        self.log(u'Inventory snapshot of {} is missing or too old, querying the server'.format(resource))
+        return None
+
     #
     # REST API Helper Methods
     #
@@ -58,6 +98,19 @@ class TableauRestApiConnection(TableauBase):
         else:
             return self.__server + u"/api/" + self.api_version + u"/sites/" + self.site_luid + u"/" + call
 
+    # Runs one of the precompiled expressions in rest_xpath, passing values as XPath variables
+    # e.g. self.run_xpath(groups, u'group_by_name', name=group_name)
+    def run_xpath(self, lxml_obj, expression_name, **variables):
+        return run_rest_xpath(lxml_obj, expression_name, self.ns_map, **variables)
+
+    # { attribute value : [ elements ] } built in one pass, for looking up many values in the same list response
+    def build_xml_index(self, lxml_obj, tag, attribute=u'name'):
+        return build_rest_xml_index(lxml_obj, tag, self.ns_map, attribute)
+
+    # { project luid : [ elements ] } for a list of workbooks or datasources, built in one pass
+    def build_xml_project_index(self, lxml_obj, tag):
+        return build_rest_xml_project_index(lxml_obj, tag, self.ns_map)
+
     #
     # Internal REST API Helpers (mostly XML definitions that are reused between methods)
     #
@@ -104,8 +157,9 @@ class TableauRestApiConnection(TableauBase):
         new_gcap_obj_list = []
         orig_site_groups = orig_site.query_groups()
         orig_site_users = orig_site.query_users()
-        orig_site_groups_dict = self.convert_xml_list_to_name_id_dict(orig_site_groups)
-        orig_site_users_dict = self.convert_xml_list_to_name_id_dict(orig_site_users)
+        # Indexed by LUID, so each name is found without scanning the whole list
+        orig_site_groups_by_luid = self.build_xml_index(orig_site_groups, u'group', u'id')
+        orig_site_users_by_luid = self.build_xml_index(orig_site_users, u'user', u'id')
 
         new_site_groups = self.query_groups()
         new_site_users = self.query_users()
@@ -115,18 +169,18 @@ class TableauRestApiConnection(TableauBase):
             orig_luid = gcap_obj.get_luid()
             if gcap_obj.get_obj_type() == 'group':
                 # Find the name that matches the LUID
-                try:
-                    orig_name = (key for key, value in orig_site_groups_dict.items() if value == orig_luid).next()
-                except StopIteration:
+                if orig_luid in orig_site_groups_by_luid:
+                    orig_name = orig_site_groups_by_luid[orig_luid][0].get(u'name')
+                else:
                     raise NoMatchFoundException(u"No matching name for luid {} found on the original site".format(
                                                 orig_luid))
                 new_luid = new_site_groups_dict.get(orig_name)
 
             elif gcap_obj.get_obj_type() == 'user':
                 # Find the name that matches the LUID
-                try:
-                    orig_name = (key for key, value in orig_site_users_dict.items() if value == orig_luid).next()
-                except StopIteration:
+                if orig_luid in orig_site_users_by_luid:
+                    orig_name = orig_site_users_by_luid[orig_luid][0].get(u'name')
+                else:
                     raise NoMatchFoundException(u"No matching name for luid {} found on the original site".format(
                                                 orig_luid))
                 new_luid = new_site_users_dict.get(orig_name)
@@ -144,7 +198,7 @@ class TableauRestApiConnection(TableauBase):
         self.start_log_block()
         obj_list = []
 
-        xml = lxml_obj.xpath(u'//t:granteeCapabilities', namespaces=self.ns_map)
+        xml = self.run_xpath(lxml_obj, u'all_granteeCapabilities')
         if len(xml) == 0:
             return []
         else:
@@ -215,11 +269,11 @@ class TableauRestApiConnection(TableauBase):
                 api.request_from_api(0)
                 # self.log(api.get_raw_response())
                 xml = api.get_response()
-                credentials_element = xml.xpath(u'//t:credentials', namespaces=self.ns_map)
+                credentials_element = self.run_xpath(xml, u'all_credentials')
                 self.__token = credentials_element[0].get("token").encode('utf-8')
                 self.log(u"Token is " + self.__token)
-                self.site_luid = credentials_element[0].xpath(u"//t:site", namespaces=self.ns_map)[0].get("id").encode('utf-8')
-                self.user_luid = credentials_element[0].xpath(u"//t:user", namespaces=self.ns_map)[0].get("id").encode('utf-8')
+                self.site_luid = self.run_xpath(xml, u'all_site')[0].get("id").encode('utf-8')
+                self.user_luid = self.run_xpath(xml, u'all_user')[0].get("id").encode('utf-8')
                 self.log(u"Site ID is " + self.site_luid)
                 self.log(u"Trying to get workbooks for user to test if API version is really available")
                 self.query_workbooks()
@@ -255,6 +309,17 @@ class TableauRestApiConnection(TableauBase):
         self.end_log_block()
         return xml
 
+    # Same as query_resource for list calls, but returns a list of record_class objects (see rest_records) instead of
+    # lxml. The records are built while each page is parsed, so the whole response is never held as a tree
+    def query_resource_records(self, url_ending, record_class, login=False):
+        self.start_log_block()
+        api_call = self.build_api_url(url_ending, login)
+        api = RestXmlRequest(api_call, self.__token, self.logger, ns_map_url=self.ns_map['t'])
+        self.log_uri(u'get', api_call)
+        records = api.request_records_from_api(record_class)
+        self.end_log_block()
+        return records
+
     def send_post_request(self, url):
         self.start_log_block()
         api = RestXmlRequest(url, self.__token, self.logger, ns_map_url=self.ns_map['t'])
@@ -340,6 +405,83 @@ class TableauRestApiConnection(TableauBase):
         self.end_log_block()
         return api.get_response()
 
+    # Streams a binary response straight to disk in chunks rather than holding it all in memory.
+    # extension_map is a list of (content type, file extension) pairs. The extension is picked from the Content-Type
+    # header before any of the body is read. Returns the full name of the file that was saved
+    # Pass a hashlib object as checksum_obj to have it updated with each chunk as it is written
+    def send_binary_get_request_to_file(self, url, filename_no_extension, extension_map,
+                                        chunk_size=(1024 * 1024 * 10), checksum_obj=None):
+        self.start_log_block()
+        # The log block is closed however the download ends, so a failure doesn't leave the log indented
+        try:
+            api = RestXmlRequest(url, self.__token, self.logger, ns_map_url=self.ns_map['t'])
+            self.log_uri(u'binary get', url)
+            api.set_http_verb(u'get')
+            response = api.open_binary_response_stream()
+            content_type = api.get_last_response_content_type()
+            self.__last_response_content_type = content_type
+            try:
+                extension = self.get_extension_for_content_type(content_type, extension_map)
+                save_filename = filename_no_extension + extension
+                save_file = open(save_filename, 'wb')
+                try:
+                    self.copy_response_to_file(response, save_file, chunk_size, checksum_obj)
+                except:
+                    # Don't leave a truncated download behind
+                    save_file.close()
+                    os.remove(save_filename)
+                    raise
+                finally:
+                    save_file.close()
+            finally:
+                response.close()
+        finally:
+            self.end_log_block()
+        return save_filename
+
+    # Same as send_binary_get_request_to_file, but into a SpooledTemporaryFile that stays in memory up to max_size
+    # bytes and only rolls over to an anonymous temp file beyond that. Returns (file object, extension), with the
+    # file object rewound to the start
+    def send_binary_get_request_to_spooled_file(self, url, extension_map, max_size=(1024 * 1024 * 100),
+                                                chunk_size=(1024 * 1024 * 10)):
+        self.start_log_block()
+        try:
+            api = RestXmlRequest(url, self.__token, self.logger, ns_map_url=self.ns_map['t'])
+            self.log_uri(u'binary get', url)
+            api.set_http_verb(u'get')
+            response = api.open_binary_response_stream()
+            content_type = api.get_last_response_content_type()
+            self.__last_response_content_type = content_type
+            try:
+                extension = self.get_extension_for_content_type(content_type, extension_map)
+                spooled_file = tempfile.SpooledTemporaryFile(max_size=max_size)
+                try:
+                    self.copy_response_to_file(response, spooled_file, chunk_size)
+                    spooled_file.seek(0)
+                except:
+                    # Frees the buffer, or the temp file it has rolled over to
+                    spooled_file.close()
+                    raise
+            finally:
+                response.close()
+        finally:
+            self.end_log_block()
+        return spooled_file, extension
+
+    def copy_response_to_file(self, response, file_obj, chunk_size=(1024 * 1024 * 10), checksum_obj=None):
+        for chunk in self.read_file_in_chunks(response, chunk_size):
+            file_obj.write(chunk)
+            if checksum_obj is not None:
+                checksum_obj.update(chunk)
+
+    @staticmethod
+    def get_extension_for_content_type(content_type, extension_map):
+        if content_type is not None:
+            for (map_content_type, extension) in extension_map:
+                if content_type.find(map_content_type) != -1:
+                    return extension
+        raise IOError(u'File extension could not be determined')
+
 #
 # Basic Querying / Get Methods
 #
@@ -348,9 +490,18 @@ class TableauRestApiConnection(TableauBase):
     # Begin Datasource Querying Methods
     #
 
-    def query_datasources(self):
+    def query_datasources(self, as_records=False):
         self.start_log_block()
-        datasources = self.query_resource(u"datasources")
+        # The snapshot only holds records, so it is only consulted when records were asked for
+        snapshot = None
+        if as_records is True:
+            snapshot = self.get_fresh_inventory_snapshot(u'datasources')
+        if snapshot is not None:
+            datasources = snapshot.query_records(self.site_luid, u'datasources')
+        elif as_records is True:
+            datasources = self.query_resource_records(u"datasources", DatasourceRecord)
+        else:
+            datasources = self.query_resource(u"datasources")
         self.end_log_block()
         return datasources
 
@@ -363,8 +514,19 @@ class TableauRestApiConnection(TableauBase):
     # Datasources in different projects can have the same 'pretty name'.
     def query_datasource_luid_by_name_in_project(self, name, p_name_or_luid=False):
         self.start_log_block()
+        snapshot = self.get_fresh_inventory_snapshot(u'datasources')
+        if snapshot is not None:
+            if p_name_or_luid is False:
+                luids = snapshot.query_luids_by_name(self.site_luid, u'datasources', name)
+            else:
+                luids = snapshot.query_luids_by_name(self.site_luid, u'datasources', name, p_name_or_luid)
+            if len(luids) == 1:
+                self.end_log_block()
+                return luids[0]
+            # Not found or ambiguous in the snapshot, which may predate a change, so the server decides
+            self.log(u'No single match in the inventory snapshot, querying the server')
         datasources = self.query_datasources()
-        datasources_with_name = datasources.xpath(u'//t:datasource[@name="{}"]'.format(name), namespaces=self.ns_map)
+        datasources_with_name = self.run_xpath(datasources, u'datasource_by_name', name=name)
         if len(datasources_with_name) == 0:
             self.end_log_block()
             raise NoMatchFoundException(u"No datasource found with name {} in any project".format(name))
@@ -378,9 +540,11 @@ class TableauRestApiConnection(TableauBase):
 
         else:
             if self.is_luid(p_name_or_luid):
-                ds_in_proj = datasources.xpath(u'//t:project[@id="{}"]/..'.format(p_name_or_luid), namespaces=self.ns_map)
+                ds_in_proj = self.run_xpath(datasources, u'datasource_by_name_in_project_luid', name=name,
+                                            project=p_name_or_luid)
             else:
-                ds_in_proj = datasources.xpath(u'//t:project[@name="{}"]/..'.format(p_name_or_luid), namespaces=self.ns_map)
+                ds_in_proj = self.run_xpath(datasources, u'datasource_by_name_in_project_name', name=name,
+                                            project=p_name_or_luid)
             if len(ds_in_proj) == 0:
                 self.end_log_block()
                 raise NoMatchFoundException(u"No datasource found with name {} in project {}".format(name, p_name_or_luid))
@@ -425,14 +589,14 @@ class TableauRestApiConnection(TableauBase):
             project_luid = self.query_project_luid_by_name(project_name_or_luid)
         datasources = self.query_datasources()
         # This brings back the datasource itself
-        ds_in_project = datasources.xpath(u'//t:project[@id="{}"]/..'.format(project_luid), namespaces=self.ns_map)
+        ds_in_project = self.run_xpath(datasources, u'datasource_in_project_luid', project=project_luid)
         self.end_log_block()
         return ds_in_project
 
     def query_extract_datasources(self):
         self.start_log_block()
         datasources = self.query_datasources()
-        ds_with_extracts = datasources.xpath(u'//t:datasource[@type="sqlproxy"]', namespaces=self.ns_map)
+        ds_with_extracts = self.run_xpath(datasources, u'datasource_by_type', type=u'sqlproxy')
         self.end_log_block()
         return ds_with_extracts
 
@@ -486,9 +650,18 @@ class TableauRestApiConnection(TableauBase):
     # Start Group Query Methods
     #
 
-    def query_groups(self):
+    def query_groups(self, as_records=False):
         self.start_log_block()
-        groups = self.query_resource(u"groups")
+        # The snapshot only holds records, so it is only consulted when records were asked for
+        snapshot = None
+        if as_records is True:
+            snapshot = self.get_fresh_inventory_snapshot(u'groups')
+        if snapshot is not None:
+            groups = snapshot.query_records(self.site_luid, u'groups')
+        elif as_records is True:
+            groups = self.query_resource_records(u"groups", GroupRecord)
+        else:
+            groups = self.query_resource(u"groups")
         self.end_log_block()
         return groups
 
@@ -506,7 +679,7 @@ class TableauRestApiConnection(TableauBase):
     def query_group_by_luid(self, group_luid):
         self.start_log_block()
         groups = self.query_groups()
-        group = groups.xpath(u'//t:group[@id="{}"]'.format(group_luid), namespaces=self.ns_map)
+        group = self.run_xpath(groups, u'group_by_luid', luid=group_luid)
         if len(group) == 1:
             self.end_log_block()
             return group[0]
@@ -517,8 +690,16 @@ class TableauRestApiConnection(TableauBase):
     # Groups luckily cannot have the same 'pretty name' on one site
     def query_group_luid_by_name(self, name):
         self.start_log_block()
+        snapshot = self.get_fresh_inventory_snapshot(u'groups')
+        if snapshot is not None:
+            luids = snapshot.query_luids_by_name(self.site_luid, u'groups', name)
+            if len(luids) == 1:
+                self.end_log_block()
+                return luids[0]
+            # Anything created since the snapshot was taken is only on the server
+            self.log(u'Not found in the inventory snapshot, querying the server')
         groups = self.query_groups()
-        group = groups.xpath(u'//t:group[@name="{}"]'.format(name), namespaces=self.ns_map)
+        group = self.run_xpath(groups, u'group_by_name', name=name)
         if len(group) == 1:
             self.end_log_block()
             return group[0].get("id")
@@ -541,9 +722,18 @@ class TableauRestApiConnection(TableauBase):
     # Start Project Querying methods
     #
 
-    def query_projects(self):
+    def query_projects(self, as_records=False):
         self.start_log_block()
-        projects = self.query_resource(u"projects")
+        # The snapshot only holds records, so it is only consulted when records were asked for
+        snapshot = None
+        if as_records is True:
+            snapshot = self.get_fresh_inventory_snapshot(u'projects')
+        if snapshot is not None:
+            projects = snapshot.query_records(self.site_luid, u'projects')
+        elif as_records is True:
+            projects = self.query_resource_records(u"projects", ProjectRecord)
+        else:
+            projects = self.query_resource(u"projects")
         self.end_log_block()
         return projects
 
@@ -560,7 +750,7 @@ class TableauRestApiConnection(TableauBase):
     def query_project_by_luid(self, luid):
         self.start_log_block()
         projects = self.query_projects()
-        project = projects.xpath(u'//t:project[@id="{}"]'.format(luid), namespaces=self.ns_map)
+        project = self.run_xpath(projects, u'project_by_luid', luid=luid)
         if len(project) == 1:
             self.end_log_block()
             return project[0]
@@ -570,8 +760,16 @@ class TableauRestApiConnection(TableauBase):
 
     def query_project_luid_by_name(self, name):
         self.start_log_block()
+        snapshot = self.get_fresh_inventory_snapshot(u'projects')
+        if snapshot is not None:
+            luids = snapshot.query_luids_by_name(self.site_luid, u'projects', name)
+            if len(luids) == 1:
+                self.end_log_block()
+                return luids[0]
+            # Anything created since the snapshot was taken is only on the server
+            self.log(u'Not found in the inventory snapshot, querying the server')
         projects = self.query_projects()
-        project = projects.xpath(u'//t:project[@name="{}"]'.format(name), namespaces=self.ns_map)
+        project = self.run_xpath(projects, u'project_by_name', name=name)
         if len(project) == 1:
             self.end_log_block()
             return project[0].get("id")
@@ -693,9 +891,12 @@ class TableauRestApiConnection(TableauBase):
     #
 
     # Site queries don't have the site portion of the URL, so login option gets correct format
-    def query_sites(self):
+    def query_sites(self, as_records=False):
         self.start_log_block()
-        sites = self.query_resource(u"sites/", login=True)
+        if as_records is True:
+            sites = self.query_resource_records(u"sites/", SiteRecord, login=True)
+        else:
+            sites = self.query_resource(u"sites/", login=True)
         self.end_log_block()
         return sites
 
@@ -785,17 +986,34 @@ class TableauRestApiConnection(TableauBase):
         self.end_log_block()
         return user
 
-    def query_users(self):
+    def query_users(self, as_records=False):
         self.start_log_block()
-        users = self.query_resource(u"users")
+        # The snapshot only holds records, so it is only consulted when records were asked for
+        snapshot = None
+        if as_records is True:
+            snapshot = self.get_fresh_inventory_snapshot(u'users')
+        if snapshot is not None:
+            users = snapshot.query_records(self.site_luid, u'users')
+        elif as_records is True:
+            users = self.query_resource_records(u"users", UserRecord)
+        else:
+            users = self.query_resource(u"users")
         self.log(u'Found {} users'.format(unicode(len(users))))
         self.end_log_block()
         return users
 
     def query_user_luid_by_username(self, username):
         self.start_log_block()
+        snapshot = self.get_fresh_inventory_snapshot(u'users')
+        if snapshot is not None:
+            luids = snapshot.query_luids_by_name(self.site_luid, u'users', username)
+            if len(luids) == 1:
+                self.end_log_block()
+                return luids[0]
+            # Anything created since the snapshot was taken is only on the server
+            self.log(u'Not found in the inventory snapshot, querying the server')
         users = self.query_users()
-        user = users.xpath(u'//t:user[@name="{}"]'.format(username), namespaces=self.ns_map)
+        user = self.run_xpath(users, u'user_by_name', name=username)
         if len(user) == 1:
             self.end_log_block()
             return user[0].get("id")
@@ -830,16 +1048,19 @@ class TableauRestApiConnection(TableauBase):
         self.end_log_block()
         return workbook
 
-    def query_workbooks_for_user_by_luid(self, luid):
+    def query_workbooks_for_user_by_luid(self, luid, as_records=False):
         self.start_log_block()
-        workbooks = self.query_resource(u"users/{}/workbooks".format(luid))
+        if as_records is True:
+            workbooks = self.query_resource_records(u"users/{}/workbooks".format(luid), WorkbookRecord)
+        else:
+            workbooks = self.query_resource(u"users/{}/workbooks".format(luid))
         self.end_log_block()
         return workbooks
 
     # This uses the logged in username for convenience
-    def query_workbooks(self):
+    def query_workbooks(self, as_records=False):
         self.start_log_block()
-        workbooks = self.query_workbooks_for_user_by_luid(self.user_luid)
+        workbooks = self.query_workbooks_for_user_by_luid(self.user_luid, as_records)
         self.end_log_block()
         return workbooks
 
@@ -847,7 +1068,7 @@ class TableauRestApiConnection(TableauBase):
     def query_workbook_for_username_by_workbook_name_in_project(self, username, wb_name, p_name_or_luid=False):
         self.start_log_block()
         workbooks = self.query_workbooks_by_username(username)
-        workbooks_with_name = workbooks.xpath(u'//t:workbook[@name="{}"]'.format(wb_name), namespaces=self.ns_map)
+        workbooks_with_name = self.run_xpath(workbooks, u'workbook_by_name', name=wb_name)
         if len(workbooks_with_name) == 0:
             self.end_log_block()
             raise NoMatchFoundException(u"No workbook found for username '{}' named {}".format(username, wb_name))
@@ -862,9 +1083,11 @@ class TableauRestApiConnection(TableauBase):
                 raise MultipleMatchesFoundException(u'More than one workbook found by name {} without a project specified').format(wb_name)
         else:
             if self.is_luid(p_name_or_luid):
-                wb_in_proj = workbooks.xpath(u'//t:workbook[@name="{}"]/:project[@id="{}"]/..'.format(p_name_or_luid), namespaces=self.ns_map)
+                wb_in_proj = self.run_xpath(workbooks, u'workbook_by_name_in_project_luid', name=wb_name,
+                                            project=p_name_or_luid)
             else:
-                wb_in_proj = workbooks.xpath(u'//t:workbook[@name="{}"]/t:project[@name="{}"]/..'.format(p_name_or_luid), namespaces=self.ns_map)
+                wb_in_proj = self.run_xpath(workbooks, u'workbook_by_name_in_project_name', name=wb_name,
+                                            project=p_name_or_luid)
             if len(wb_in_proj) == 0:
                 self.end_log_block()
                 raise NoMatchFoundException(u'No workbook found with name {} in project {}').format(wb_name, p_name_or_luid)
@@ -885,7 +1108,7 @@ class TableauRestApiConnection(TableauBase):
     def query_workbook_for_user_luid_by_workbook_name_in_project(self, user_luid, wb_name, p_name_or_luid=False):
         self.start_log_block()
         workbooks = self.query_workbooks_for_user_by_luid(user_luid)
-        workbooks_with_name = workbooks.xpath(u'//t:workbook[@name="{}"]'.format(wb_name), namespaces=self.ns_map)
+        workbooks_with_name = self.run_xpath(workbooks, u'workbook_by_name', name=wb_name)
         if len(workbooks_with_name) == 0:
             self.end_log_block()
             raise NoMatchFoundException(u"No workbook found for user luid '{}' named {}".format(user_luid, wb_name))
@@ -896,9 +1119,11 @@ class TableauRestApiConnection(TableauBase):
             return wb
         elif len(workbooks_with_name) > 1 and p_name_or_luid is not False:
             if self.is_luid(p_name_or_luid):
-                wb_in_proj = workbooks.xpath(u'//t:workbook[@name="{}"]/t:project[@id="{}"]/..'.format(p_name_or_luid), namespaces=self.ns_map)
+                wb_in_proj = self.run_xpath(workbooks, u'workbook_by_name_in_project_luid', name=wb_name,
+                                            project=p_name_or_luid)
             else:
-                wb_in_proj = workbooks.xpath(u'//t:workbook[@name="{}"]/t:project[@name="{}"]/..'.format(p_name_or_luid), namespaces=self.ns_map)
+                wb_in_proj = self.run_xpath(workbooks, u'workbook_by_name_in_project_name', name=wb_name,
+                                            project=p_name_or_luid)
             if len(wb_in_proj) == 0:
                 self.end_log_block()
                 raise NoMatchFoundException(u'No workbook found with name {} in project {}').format(wb_name, p_name_or_luid)
@@ -925,20 +1150,88 @@ class TableauRestApiConnection(TableauBase):
             project_luid = self.query_project_luid_by_name(project_name_or_luid)
         workbooks = self.query_workbooks_by_username(username)
         # This brings back the workbook itself
-        wbs_in_project = workbooks.xpath(u'//t:project[@id="{}"]/..'.format(project_luid), namespaces=self.ns_map)
+        wbs_in_project = self.run_xpath(workbooks, u'workbook_in_project_luid', project=project_luid)
         self.end_log_block()
         return wbs_in_project
 
-    def query_workbooks_in_project(self, project_name_or_luid):
+    # Every workbook on the site, in one paginated pass and without looking up a user first. Listing workbooks by
+    # site needs API 2.3+. Before that only a user's own list is available, which callers have to ask for explicitly
+    # (query_workbooks_for_user_by_luid), since treating it as the whole site silently leaves workbooks out
+    def query_workbooks_for_site(self, as_records=False):
+        self.start_log_block()
+        if self.api_version in [u"2.0", u"2.1", u"2.2"]:
+            raise InvalidOptionException(u"Query Workbooks for Site only available in Tableau Server 10.0+")
+        if as_records is True:
+            workbooks = self.query_resource_records(u"workbooks", WorkbookRecord)
+        else:
+            workbooks = self.query_resource(u"workbooks")
+        self.end_log_block()
+        return workbooks
+
+    # { project luid : [ workbooks ] } for the whole site, from one query_workbooks_for_site() call. Build it once and
+    # pass it to query_workbooks_in_project() when looking up more than one project
+    def query_workbooks_by_project(self, as_records=False):
+        self.start_log_block()
+        workbooks = self.query_workbooks_for_site(as_records)
+        if as_records is True:
+            index = {}
+            for workbook in workbooks:
+                if workbook.project_id in index:
+                    index[workbook.project_id].append(workbook)
+                else:
+                    index[workbook.project_id] = [workbook]
+        else:
+            index = self.build_xml_project_index(workbooks, u'workbook')
+        self.end_log_block()
+        return index
+
+    # Before API 2.3 there is no site index, so the workbooks the signed in user can see are searched instead
+    def query_workbooks_in_project(self, project_name_or_luid, workbooks_by_project=None):
         self.start_log_block()
-        wbs = self.query_workbooks_in_project_for_username(project_name_or_luid, self.__username)
+        if workbooks_by_project is None and self.api_version in [u"2.0", u"2.1", u"2.2"]:
+            wbs = self.query_workbooks_in_project_for_username(project_name_or_luid, self.__username)
+            self.end_log_block()
+            return wbs
+        if self.is_luid(project_name_or_luid):
+            project_luid = project_name_or_luid
+        else:
+            project_luid = self.query_project_luid_by_name(project_name_or_luid)
+        if workbooks_by_project is None:
+            workbooks_by_project = self.query_workbooks_by_project()
+        wbs = workbooks_by_project.get(project_luid, [])
         self.end_log_block()
         return wbs
 
-    # Assume the current logged in user
+    # Assume the current logged in user. From API 2.3 the name is looked up in the site's workbook list, in one pass
+    # rather than through the user's own list
     def query_workbook_by_name_in_project(self, wb_name, p_name_or_luid=False):
         self.start_log_block()
-        wb = self.query_workbook_for_user_luid_by_workbook_name_in_project(self.user_luid, wb_name, p_name_or_luid)
+        if self.api_version in [u"2.0", u"2.1", u"2.2"]:
+            wb = self.query_workbook_for_user_luid_by_workbook_name_in_project(self.user_luid, wb_name, p_name_or_luid)
+            self.end_log_block()
+            return wb
+        workbooks = self.query_workbooks_for_site()
+        if p_name_or_luid is False:
+            workbooks_with_name = self.run_xpath(workbooks, u'workbook_by_name', name=wb_name)
+            if len(workbooks_with_name) == 0:
+                self.end_log_block()
+                raise NoMatchFoundException(u"No workbook found named {}".format(wb_name))
+            elif len(workbooks_with_name) > 1:
+                self.end_log_block()
+                raise MultipleMatchesFoundException(
+                    u'More than one workbook found by name {} without a project specified'.format(wb_name))
+        else:
+            if self.is_luid(p_name_or_luid):
+                workbooks_with_name = self.run_xpath(workbooks, u'workbook_by_name_in_project_luid', name=wb_name,
+                                                     project=p_name_or_luid)
+            else:
+                workbooks_with_name = self.run_xpath(workbooks, u'workbook_by_name_in_project_name', name=wb_name,
+                                                     project=p_name_or_luid)
+            if len(workbooks_with_name) == 0:
+                self.end_log_block()
+                raise NoMatchFoundException(u'No workbook found with name {} in project {}'.format(wb_name,
+                                                                                                    p_name_or_luid))
+        wb = self.query_workbook_by_luid(workbooks_with_name[0].get("id"))
         self.end_log_block()
         return wb
 
@@ -952,7 +1245,7 @@ class TableauRestApiConnection(TableauBase):
     def query_workbook_luid_for_username_by_workbook_name_in_project(self, username, wb_name, p_name_or_luid=False):
         self.start_log_block()
         workbooks = self.query_workbooks_by_username(username)
-        workbooks_with_name = workbooks.xpath(u'//t:workbook[@name="{}"]'.format(wb_name), namespaces=self.ns_map)
+        workbooks_with_name = self.run_xpath(workbooks, u'workbook_by_name', name=wb_name)
         if len(workbooks_with_name) == 0:
             self.end_log_block()
             raise NoMatchFoundException(u"No workbook found for username '{}' named {}".format(username, wb_name))
@@ -962,9 +1255,11 @@ class TableauRestApiConnection(TableauBase):
             return wb_luid
         elif len(workbooks_with_name) > 1 and p_name_or_luid is not False:
             if self.is_luid(p_name_or_luid):
-                wb_in_proj = workbooks.xpath(u'//t:workbook[@name="{}"]/t:project[@id="{}"]/..'.format(wb_name, p_name_or_luid), namespaces=self.ns_map)
+                wb_in_proj = self.run_xpath(workbooks, u'workbook_by_name_in_project_luid', name=wb_name,
+                                            project=p_name_or_luid)
             else:
-                wb_in_proj = workbooks.xpath(u'//t:workbook[@name="{}"]/t:project[@name="{}"]/..'.format(wb_name, p_name_or_luid), namespaces=self.ns_map)
+                wb_in_proj = self.run_xpath(workbooks, u'workbook_by_name_in_project_name', name=wb_name,
+                                            project=p_name_or_luid)
             if len(wb_in_proj) == 0:
                 self.end_log_block()
                 raise NoMatchFoundException(u'No workbook found with name {} in project {}').format(wb_name, p_name_or_luid)
@@ -982,10 +1277,10 @@ class TableauRestApiConnection(TableauBase):
         self.end_log_block()
         return luid
 
-    def query_workbooks_by_username(self, username):
+    def query_workbooks_by_username(self, username, as_records=False):
         self.start_log_block()
         user_luid = self.query_user_luid_by_username(username)
-        wbs = self.query_workbooks_for_user_by_luid(user_luid)
+        wbs = self.query_workbooks_for_user_by_luid(user_luid, as_records)
         self.end_log_block()
         return wbs
 
@@ -1013,13 +1308,17 @@ class TableauRestApiConnection(TableauBase):
         self.end_log_block()
         return vws
 
-    def query_views_for_site(self, usage=False):
+    def query_views_for_site(self, usage=False, as_records=False):
         self.start_log_block()
         if self.api_version in [u"2.0", u"2.1"]:
             raise InvalidOptionException(u"Query Views for Site only available in Tableau Server 9.3+")
         if usage not in [True, False]:
             raise InvalidOptionException(u'Usage can only be set to True or False')
-        vws = self.query_resource(u"sites/views?includeUsageStatistics={}".format(str(usage).lower()))
+        if as_records is True:
+            vws = self.query_resource_records(u"sites/views?includeUsageStatistics={}".format(str(usage).lower()),
+                                              ViewRecord)
+        else:
+            vws = self.query_resource(u"sites/views?includeUsageStatistics={}".format(str(usage).lower()))
         self.end_log_block()
         return vws
 
@@ -1189,44 +1488,36 @@ class TableauRestApiConnection(TableauBase):
     # Do not include file extension. Without filename, only returns the response
     def download_datasource_by_luid(self, ds_luid, filename=None):
         self.start_log_block()
+        url = self.build_api_url(u"datasources/{}/content".format(ds_luid))
         try:
-            url = self.build_api_url(u"datasources/{}/content".format(ds_luid))
-            ds = self.send_binary_get_request(url)
-            extension = None
-            if self.__last_response_content_type.find(u'application/xml') != -1:
-                extension = u'.tds'
-            elif self.__last_response_content_type.find(u'application/octet-stream') != -1:
-                extension = u'.tdsx'
-            if extension is None:
-                raise IOError(u'File extension could not be determined')
+            # Without a filename, nothing touches the disk unless the download is bigger than the spool size
+            if filename is None:
+                (ds_file, extension) = self.send_binary_get_request_to_spooled_file(url, self.datasource_extension_map,
+                                                                                   self.spooled_download_max_size)
+            else:
+                save_filename = self.send_binary_get_request_to_file(url, filename, self.datasource_extension_map)
+                extension = os.path.splitext(save_filename)[1]
+                ds_file = open(save_filename, 'rb')
         except RecoverableHTTPException as e:
             self.log(u"download_datasource_by_luid resulted in HTTP error {}, Tableau Code {}".format(e.http_code, e.tableau_error_code))
             self.end_log_block()
             raise
-        except:
+        except IOError:
+            self.log(u"Error: File '{}' cannot be opened to save to".format(filename))
             self.end_log_block()
             raise
-        try:
-            if filename is None:
-                save_filename = 'temp_ds' + extension
-            else:
-                save_filename = filename + extension
-            save_file = open(save_filename, 'wb')
-            save_file.write(ds)
-            save_file.close()
-            if extension == u'.tdsx':
-                self.log(u'Detected TDSX, creating TableauPackagedFile object')
-                saved_file = open(save_filename, 'rb')
-                return_obj = TableauPackagedFile(saved_file, self.logger)
-                saved_file.close()
-                if filename is None:
-                    os.remove(save_filename)
-        except IOError:
-            self.log(u"Error: File '{}' cannot be opened to save to".format(filename + extension))
+        except:
+            self.end_log_block()
             raise
-        if extension == '.tds':
+        if extension == u'.tdsx':
+            self.log(u'Detected TDSX, creating TableauPackagedFile object')
+            # The packaged file keeps reading from the open file handle when it is saved again later
+            return_obj = TableauPackagedFile(ds_file, self.logger)
+        else:
             self.log(u'Detected TDS, creating TableauDatasource object')
-            return_obj = TableauDatasource(ds, self.logger)
+            # lxml parses straight from the file, no copy of the XML is made first
+            return_obj = TableauDatasource(ds_file, self.logger)
+            ds_file.close()
 
         self.end_log_block()
         return return_obj
@@ -1235,49 +1526,47 @@ class TableauRestApiConnection(TableauBase):
     # Use no_obj_return for save without opening and processing
     def download_workbook_by_luid(self, wb_luid, filename=None, no_obj_return=False):
         self.start_log_block()
+        url = self.build_api_url(u"workbooks/{}/content".format(wb_luid))
         try:
-            url = self.build_api_url(u"workbooks/{}/content".format(wb_luid))
-            wb = self.send_binary_get_request(url)
-            extension = None
-            if self.__last_response_content_type.find(u'application/xml') != -1:
-                extension = u'.twb'
-            elif self.__last_response_content_type.find(u'application/octet-stream') != -1:
-                extension = u'.twbx'
-            if extension is None:
-                raise IOError(u'File extension could not be determined')
+            # Without a filename, nothing touches the disk unless the download is bigger than the spool size
+            if filename is None:
+                (wb_file, extension) = self.send_binary_get_request_to_spooled_file(url, self.workbook_extension_map,
+                                                                                   self.spooled_download_max_size)
+            else:
+                save_filename = self.send_binary_get_request_to_file(url, filename, self.workbook_extension_map)
+                extension = os.path.splitext(save_filename)[1]
+                if no_obj_return is True:
+                    self.end_log_block()
+                    return
+                wb_file = open(save_filename, 'rb')
         except RecoverableHTTPException as e:
             self.log(u"download_workbook_by_luid resulted in HTTP error {}, Tableau Code {}".format(e.http_code, e.tableau_error_code))
             self.end_log_block()
             raise
-        except:
+        except IOError:
+            self.log(u"Error: File '{}' cannot be opened to save to".format(filename))
             self.end_log_block()
             raise
-        try:
-            if filename is None:
-                save_filename = 'temp_wb' + extension
-            else:
-                save_filename = filename + extension
-
-            save_file = open(save_filename, 'wb')
-            save_file.write(wb)
-            save_file.close()
-            if no_obj_return is True:
-                return
-            if extension == u'.twbx':
-                self.log(u'Detected TWBX, creating TableauPackagedFile object')
-                saved_file = open(save_filename, 'rb')
-                return_obj = TableauPackagedFile(saved_file, self.logger)
-                if filename is None:
-                    os.remove(save_filename)
-
-        except IOError:
-            self.log(u"Error: File '{}' cannot be opened to save to".format(filename + extension))
+        except:
+            self.end_log_block()
             raise
         if no_obj_return is True:
+            wb_file.close()
+            self.end_log_block()
             return
-        if extension == u'.twb':
+        if extension == u'.twbx':
+            self.log(u'Detected TWBX, creating TableauPackagedFile object')
+            # The packaged file keeps reading from the open file handle when it is saved again later
+            return_obj = TableauPackagedFile(wb_file, self.logger)
+        else:
             self.log(u'Detected TWB, creating TableauWorkbook object')
-            return_obj = TableauWorkbook(wb, self.logger)
+            # A saved TWB is memory-mapped from disk. Asking a spooled file for its fileno() would force it to disk,
+            # so that one is read instead
+            if filename is None:
+                return_obj = TableauWorkbook(wb_file.read(), self.logger)
+            else:
+                return_obj = TableauWorkbook(save_filename, self.logger)
+            wb_file.close()
         self.end_log_block()
         return return_obj
 
@@ -1302,7 +1591,7 @@ class TableauRestApiConnection(TableauBase):
         url = self.build_api_url(u'users')
         try:
             new_user = self.send_add_request(url, add_request)
-            new_user_luid = new_user.xpath(u'//t:user', namespaces=self.ns_map)[0].get("id")
+            new_user_luid = self.run_xpath(new_user, u'all_user')[0].get("id")
             self.end_log_block()
             return new_user_luid
         # If already exists, update site role unless overridden.
@@ -1346,7 +1635,7 @@ class TableauRestApiConnection(TableauBase):
         try:
             new_group = self.send_add_request(url, add_request)
             self.end_log_block()
-            return new_group.xpath(u'//t:group', namespaces=self.ns_map)[0].get("id")
+            return self.run_xpath(new_group, u'all_group')[0].get("id")
         # If the name already exists, a HTTP 409 throws, so just find and return the existing LUID
         except RecoverableHTTPException as e:
             if e.http_code == 409:
@@ -1371,12 +1660,12 @@ class TableauRestApiConnection(TableauBase):
         response = self.send_add_request(url, add_request)
         # Response is different from immediate to background update. job ID lets you track progress on background
         if sync_as_background is True:
-            job = response.xpath(u'//t:job', namespaces=self.ns_map)
+            job = self.run_xpath(response, u'all_job')
             self.end_log_block()
             return job[0].get('id')
         if sync_as_background is False:
             self.end_log_block()
-            group = response.xpath(u'//t:group', namespaces=self.ns_map)
+            group = self.run_xpath(response, u'all_group')
             return group[0].get('id')
 
     def create_project(self, project_name, project_desc=None, locked_permissions=False):
@@ -1393,7 +1682,7 @@ class TableauRestApiConnection(TableauBase):
         try:
             new_project = self.send_add_request(url, add_request)
             self.end_log_block()
-            return new_project.xpath(u'//t:project', namespaces=self.ns_map)[0].get("id")
+            return self.run_xpath(new_project, u'all_project')[0].get("id")
         except RecoverableHTTPException as e:
             if e.http_code == 409:
                 self.log(u'Project named {} already exists, finding and returning the LUID'.format(project_name))
@@ -1424,7 +1713,7 @@ class TableauRestApiConnection(TableauBase):
         self.log(u'Creating a site using the following XML: {}'.format(add_request))
         self.log(u'Sending create request via: {}'.format(url))
         new_site = self.send_add_request(url, add_request)
-        return new_site.xpath(u'//t:site', namespaces=self.ns_map)[0].get("id")
+        return self.run_xpath(new_site, u'all_site')[0].get("id")
 
     # Take a single user_luid string or a collection of luid_strings
     def add_users_to_group_by_luid(self, user_luid_s, group_luid):
@@ -1588,7 +1877,7 @@ class TableauRestApiConnection(TableauBase):
         # Schedule requests happen at the server rather than site level, like a login
         url = self.build_api_url(u"schedules", login=True)
         new_schedule = self.send_add_request(url, request)
-        new_schedule_luid = new_schedule.xpath(u'//t:schedule', namespaces=self.ns_map)[0].get("id")
+        new_schedule_luid = self.run_xpath(new_schedule, u'all_schedule')[0].get("id")
         self.end_log_block()
         return new_schedule_luid
 
@@ -1610,7 +1899,7 @@ class TableauRestApiConnection(TableauBase):
         url = self.build_api_url()
         url = url[:-1]
         new_subscription = self.send_add_request(url, request)
-        new_subscription_luid = new_subscription.xpath(u'//t:subscription', namespaces=self.ns_map)[0].get("id")
+        new_subscription_luid = self.run_xpath(new_subscription, u'all_subscription')[0].get("id")
         self.end_log_block()
         return new_subscription_luid
 
@@ -1756,11 +2045,11 @@ class TableauRestApiConnection(TableauBase):
         response = self.send_update_request(url, request)
         # Response is different from immediate to background update. job ID lets you track progress on background
         if sync_as_background is True:
-            job = response.xpath(u'//t:job', namespaces=self.ns_map)
+            job = self.run_xpath(response, u'all_job')
             self.end_log_block()
             return job[0].get('id')
         if sync_as_background is False:
-            group = response.xpath(u'//t:group', namespaces=self.ns_map)
+            group = self.run_xpath(response, u'all_group')
             self.end_log_block()
             return group[0].get('id')
 
@@ -2292,14 +2581,14 @@ class TableauRestApiConnection(TableauBase):
         xml = self.publish_content(u'workbook', workbook_filename, workbook_name, project_luid, overwrite,
                                    connection_username, connection_password, save_credentials, show_tabs=show_tabs,
                                    check_published_ds=check_published_ds)
-        workbook = xml.xpath(u'//t:workbook', namespaces=self.ns_map)
+        workbook = self.run_xpath(xml, u'all_workbook')
         return workbook[0].get('id')
 
     def publish_datasource(self, ds_filename, ds_name, project_luid, overwrite=False, connection_username=None,
                            connection_password=None, save_credentials=True):
         xml = self.publish_content(u'datasource', ds_filename, ds_name, project_luid, overwrite, connection_username,
                                    connection_password, save_credentials)
-        datasource = xml.xpath(u'//t:datasource', namespaces=self.ns_map)
+        datasource = self.run_xpath(xml, u'all_datasource')
         return datasource[0].get('id')
 
     # Main method for publishing a workbook. Should intelligently decide to chunk up if necessary
@@ -2437,7 +2726,7 @@ class TableauRestApiConnection(TableauBase):
     def initiate_file_upload(self):
         url = self.build_api_url(u"fileUploads")
         xml = self.send_post_request(url)
-        file_upload = xml.xpath(u'//t:fileUpload', namespaces=self.ns_map)
+        file_upload = self.run_xpath(xml, u'all_fileUpload')
         return file_upload[0].get("uploadSessionId")
 
     # Uploads a chunk to an already started session
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from lxml import etree
+
+from tableau_tools.tableau_exceptions import *
+from tableau_tools.tableau_rest_api.inventory_snapshot import InventorySnapshot
+from tableau_tools.tableau_rest_api.rest_records import *
+
+
+permissions_response = u'''<tsResponse xmlns="http://tableau.com/api"><permissions><granteeCapabilities>
+<group id="g1"/><capabilities><capability name="Read" mode="Allow"/></capabilities>
+</granteeCapabilities></permissions></tsResponse>'''
+
+
+# Answers the list calls InventorySnapshot.refresh_site makes from plain lists, and records every per-object call
+class FakeRestConnection(object):
+    def __init__(self):
+        self.site_luid = u's1'
+        self.ns_prefix = u'{http://tableau.com/api}'
+        self.workbooks = [(u'w1', u'2017-01-01T00:00:00Z'), (u'w2', u'2017-01-01T00:00:00Z')]
+        self.datasources = [(u'd1', u'2017-01-01T00:00:00Z')]
+        self.site_workbooks_supported = True
+        self.detail_calls = []
+
+    def query_users(self, as_records=False):
+        return [UserRecord(id=u'u1', name=u'alice')]
+
+    def query_groups(self, as_records=False):
+        return [GroupRecord(id=u'g1', name=u'All Users')]
+
+    def query_projects(self, as_records=False):
+        return [ProjectRecord(id=u'p1', name=u'Sales')]
+
+    def query_workbooks_for_site(self, as_records=False):
+        if self.site_workbooks_supported is False:
+            raise InvalidOptionException(u'Query Workbooks for Site only available in Tableau Server 10.0+')
+        return [WorkbookRecord(id=luid, name=luid, project_id=u'p1', project_name=u'Sales', owner_id=u'u1',
+                               updated_at=updated_at) for (luid, updated_at) in self.workbooks]
+
+    def query_datasources(self, as_records=False):
+        return [DatasourceRecord(id=luid, name=luid, project_id=u'p1', project_name=u'Sales', updated_at=updated_at)
+                for (luid, updated_at) in self.datasources]
+
+    def query_views_for_site(self, as_records=False):
+        return [ViewRecord(id=u'v1', name=u'View', workbook_id=u'w1')]
+
+    def query_resource_records(self, url, record_class):
+        self.detail_calls.append(url)
+        return [UserRecord(id=u'u1', name=u'alice')]
+
+    def query_permissions_by_luid(self, object_type, luid):
+        self.detail_calls.append(luid)
+        return etree.fromstring(permissions_response)
+
+
+class InventorySnapshotRefreshTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot = InventorySnapshot(os.path.join(self.directory, u'snapshot.db'), detail_max_age=None)
+        self.connection = FakeRestConnection()
+        self.snapshot.refresh_site(self.connection)
+
+    def tearDown(self):
+        self.snapshot.close()
+        shutil.rmtree(self.directory)
+
+    def refresh_and_get_detail_calls(self, incremental=True):
+        self.connection.detail_calls = []
+        self.snapshot.refresh_site(self.connection, incremental=incremental)
+        return sorted(self.connection.detail_calls)
+
+    def count_permissions(self, object_luid):
+        return len(self.snapshot.query_permissions_for_object(u's1', object_luid))
+
+    def test_first_refresh_fetches_every_detail(self):
+        self.assertEqual(self.count_permissions(u'w1'), 1)
+        self.assertEqual(self.count_permissions(u'd1'), 1)
+        self.assertEqual(len(self.snapshot.query(u'SELECT * FROM group_members')), 1)
+
+    def test_incremental_refresh_skips_unchanged_objects(self):
+        self.assertEqual(self.refresh_and_get_detail_calls(), [])
+
+    def test_incremental_refresh_fetches_changed_and_new_objects(self):
+        self.connection.workbooks = [(u'w1', u'2017-02-01T00:00:00Z'), (u'w2', u'2017-01-01T00:00:00Z'),
+                                     (u'w3', u'2017-02-01T00:00:00Z')]
+        self.assertEqual(self.refresh_and_get_detail_calls(), [u'w1', u'w3'])
+
+    def test_details_older_than_detail_max_age_are_fetched_again(self):
+        self.snapshot.detail_max_age = -1
+        self.assertEqual(self.refresh_and_get_detail_calls(), [u'd1', u'groups/g1/users', u'p1', u'w1', u'w2'])
+
+    def test_deleted_objects_lose_their_details(self):
+        self.connection.workbooks = [(u'w1', u'2017-01-01T00:00:00Z')]
+        self.connection.datasources = []
+        self.refresh_and_get_detail_calls()
+        self.assertEqual(self.count_permissions(u'w2'), 0)
+        self.assertEqual(self.count_permissions(u'd1'), 0)
+        self.assertEqual(self.count_permissions(u'w1'), 1)
+        self.assertEqual(len(self.snapshot.query(u'SELECT * FROM workbooks')), 1)
+
+    def test_full_refresh_fetches_everything_again(self):
+        self.assertEqual(self.refresh_and_get_detail_calls(incremental=False),
+                         [u'd1', u'groups/g1/users', u'p1', u'w1', u'w2'])
+
+    def test_workbooks_are_kept_when_the_site_list_is_unavailable(self):
+        self.connection.site_workbooks_supported = False
+        self.assertEqual(self.refresh_and_get_detail_calls(), [])
+        self.assertEqual(len(self.snapshot.query(u'SELECT * FROM workbooks')), 2)
+        self.assertEqual(self.count_permissions(u'w2'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
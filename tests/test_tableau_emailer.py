@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import email
+import Queue
+import shutil
+import socket
+import smtplib
+import tempfile
+import threading
+import unittest
+
+from tableau_tools import tableau_emailer
+from tableau_tools.tableau_base import TableauBase
+from tableau_tools.tableau_emailer import TableauEmailer, SmtpConnectionPool
+
+
+# Stands in for Tabcmd.create_export. Each export contains the name of the user it was rendered for, and takes a
+# moment so that the next render overlaps the message stage reading the previous one
+class FakeTabcmd(object):
+    def __init__(self, tabcmd_folder):
+        self.tabcmd_folder = tabcmd_folder
+        self.site = None
+        self.export_type = None
+
+    @staticmethod
+    def build_export_filename(export_type, filename):
+        return filename + u'.pdf'
+
+    def create_export(self, export_type, view_location, view_filter_map=None, user_to_impersonate=None,
+                      filename='tableau_workbook'):
+        full_file_location = self.tabcmd_folder + self.build_export_filename(export_type, filename)
+        export_fh = open(full_file_location, 'wb')
+        export_fh.write(user_to_impersonate)
+        export_fh.close()
+        time.sleep(0.02)
+        if view_location == u'broken':
+            raise IOError(u'tabcmd failed part way through')
+        return full_file_location
+
+
+class FakeSmtpPool(object):
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def sendmail(self, from_user, to_user, msg_string):
+        with self.lock:
+            self.sent.append((to_user, msg_string))
+
+
+class RenderPipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.emailer = TableauEmailer.__new__(TableauEmailer)
+        TableauBase.__init__(self.emailer)
+        self.emailer.tabcmd = FakeTabcmd(self.directory + os.sep)
+        self.emailer.smtp_pool = FakeSmtpPool()
+        self.emailer.pipeline_queue_size = 1
+        self.emailer.templates = {u'template': (u'See attached', u'<p>See attached</p>')}
+        self.emailer.templates_lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def build_subscriptions(users, view_location=u'wb/view', recipients_per_user=2):
+        subscriptions = []
+        for user in users:
+            for i in xrange(0, recipients_per_user):
+                subscriptions.append({u'subject': u'Report', u'user': user, u'site': u'default',
+                                      u'view_location': view_location,
+                                      u'email': u'{}-{}@example.com'.format(user, i), u'view_filter_map': None})
+        return subscriptions
+
+    @staticmethod
+    def get_attachment(msg_string):
+        for part in email.message_from_string(msg_string).walk():
+            if part.get_filename() is not None:
+                return part.get_payload(decode=True)
+        return None
+
+    def test_every_recipient_gets_the_render_of_their_own_user(self):
+        users = [u'alice', u'bob', u'carol']
+        render_plans = TableauEmailer.plan_renders(self.build_subscriptions(users))
+        self.emailer.send_render_plans(render_plans, u'reports@example.com', u'template')
+
+        self.assertEqual([p[u'error'] for p in render_plans], [None, None, None])
+        self.assertEqual(len(self.emailer.smtp_pool.sent), 6)
+        for (to_user, msg_string) in self.emailer.smtp_pool.sent:
+            self.assertEqual(self.get_attachment(msg_string), to_user.split(u'-')[0])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_failed_render_is_not_sent_and_its_partial_file_is_removed(self):
+        subscriptions = self.build_subscriptions([u'alice'], view_location=u'broken')
+        subscriptions.extend(self.build_subscriptions([u'bob']))
+        render_plans = TableauEmailer.plan_renders(subscriptions)
+        self.emailer.send_render_plans(render_plans, u'reports@example.com', u'template')
+
+        self.assertEqual(render_plans[0][u'error'], u'tabcmd failed part way through')
+        self.assertIsNone(render_plans[0][u'filename'])
+        self.assertIsNone(render_plans[1][u'error'])
+        self.assertEqual(sorted([to_user for (to_user, msg_string) in self.emailer.smtp_pool.sent]),
+                         [u'bob-0@example.com', u'bob-1@example.com'])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_message_stage_always_stops_the_send_workers(self):
+        rendered_queue = Queue.Queue()
+        message_queue = Queue.Queue()
+        missing_file = os.path.join(self.directory, u'missing.pdf')
+        render_plan = {u'error': None, u'filename': missing_file,
+                       u'recipients': self.build_subscriptions([u'alice'], recipients_per_user=1)}
+        rendered_queue.put(render_plan)
+        rendered_queue.put(None)
+        self.emailer.run_message_stage(rendered_queue, message_queue, u'reports@example.com', u'template', 3)
+
+        self.assertIsNotNone(render_plan[u'error'])
+        self.assertEqual([message_queue.get_nowait() for i in xrange(0, 3)], [None, None, None])
+        self.assertTrue(message_queue.empty())
+
+
+# smtplib.SMTP replacement. Each sendmail takes the next outcome from outcomes: None to succeed, or an exception
+class FakeSmtp(object):
+    outcomes = []
+    connections = []
+
+    def __init__(self, smtp_server):
+        self.sent = []
+        self.closed = False
+        FakeSmtp.connections.append(self)
+
+    def sendmail(self, from_user, to_user, msg_string):
+        outcome = FakeSmtp.outcomes.pop(0)
+        if outcome is not None:
+            raise outcome
+        self.sent.append(to_user)
+
+    def noop(self):
+        return 250, u'OK'
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class SmtpConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.original_smtp = tableau_emailer.smtplib.SMTP
+        tableau_emailer.smtplib.SMTP = FakeSmtp
+        FakeSmtp.outcomes = []
+        FakeSmtp.connections = []
+        self.pool = SmtpConnectionPool(u'smtp.example.com')
+
+    def tearDown(self):
+        tableau_emailer.smtplib.SMTP = self.original_smtp
+
+    def get_pooled_connections(self):
+        connections = []
+        while not self.pool.idle_connections.empty():
+            connections.append(self.pool.idle_connections.get_nowait()[0])
+        return connections
+
+    def test_connection_is_reused(self):
+        FakeSmtp.outcomes = [None, None]
+        self.pool.sendmail(u'a@example.com', u'b@example.com', u'message')
+        self.pool.sendmail(u'a@example.com', u'c@example.com', u'message')
+        self.assertEqual(len(FakeSmtp.connections), 1)
+        self.assertEqual(FakeSmtp.connections[0].sent, [u'b@example.com', u'c@example.com'])
+
+    def check_reconnects_after(self, exception):
+        FakeSmtp.outcomes = [None, exception, None]
+        self.pool.sendmail(u'a@example.com', u'b@example.com', u'message')
+        self.pool.sendmail(u'a@example.com', u'c@example.com', u'message')
+        (dropped, reconnected) = FakeSmtp.connections
+        self.assertTrue(dropped.closed)
+        self.assertEqual(reconnected.sent, [u'c@example.com'])
+        self.assertEqual(self.get_pooled_connections(), [reconnected])
+
+    def test_reconnects_when_the_server_disconnected(self):
+        self.check_reconnects_after(smtplib.SMTPServerDisconnected(u'Connection unexpectedly closed'))
+
+    def test_reconnects_after_a_socket_error(self):
+        self.check_reconnects_after(socket.error(104, u'Connection reset by peer'))
+
+    def test_failed_resend_closes_the_new_connection(self):
+        FakeSmtp.outcomes = [smtplib.SMTPServerDisconnected(u'gone'), socket.error(32, u'Broken pipe')]
+        self.assertRaises(socket.error, self.pool.sendmail, u'a@example.com', u'b@example.com', u'message')
+        self.assertEqual([c.closed for c in FakeSmtp.connections], [True, True])
+        self.assertEqual(self.get_pooled_connections(), [])
+
+    def test_refused_recipient_keeps_the_connection(self):
+        FakeSmtp.outcomes = [smtplib.SMTPRecipientsRefused({u'b@example.com': (550, u'No such user')})]
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self.pool.sendmail, u'a@example.com', u'b@example.com',
+                          u'message')
+        self.assertEqual(self.get_pooled_connections(), FakeSmtp.connections)
+
+    def test_idle_connection_is_replaced(self):
+        FakeSmtp.outcomes = [None, None]
+        self.pool.max_idle_seconds = -1
+        self.pool.sendmail(u'a@example.com', u'b@example.com', u'message')
+        self.pool.sendmail(u'a@example.com', u'c@example.com', u'message')
+        self.assertEqual(len(FakeSmtp.connections), 2)
+        self.assertTrue(FakeSmtp.connections[0].closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
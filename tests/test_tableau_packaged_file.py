@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+from tableau_tools.tableau_documents.tableau_packaged_file import TableauPackagedFile
+
+
+workbook_xml = u'''<?xml version='1.0' encoding='utf-8' ?>
+<workbook version='10.0' xmlns:user='http://www.tableausoftware.com/xml/user'><datasources/></workbook>'''
+
+
+class PackagedFileCopyTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.members = {u'Sales.twb': (workbook_xml.encode('utf-8'), zipfile.ZIP_DEFLATED),
+                        u'Data/Extracts/sales.tde': (os.urandom(200000), zipfile.ZIP_STORED),
+                        u'Image/logo.png': ('logo' * 5000, zipfile.ZIP_DEFLATED)}
+        self.twbx_filename = os.path.join(self.directory, u'Sales.twbx')
+        zf = zipfile.ZipFile(self.twbx_filename, 'w')
+        for name in sorted(self.members):
+            (data, compress_type) = self.members[name]
+            zf.writestr(zipfile.ZipInfo(name, (2017, 1, 1, 0, 0, 0)), data, compress_type)
+        zf.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unchanged_package_round_trips(self):
+        packaged_file = TableauPackagedFile(open(self.twbx_filename, 'rb'))
+        saved_filename = packaged_file.save_new_packaged_file(os.path.join(self.directory, u'Copy'))
+        self.assertEqual(saved_filename, os.path.join(self.directory, u'Copy.twbx'))
+
+        zf = zipfile.ZipFile(saved_filename)
+        self.assertIsNone(zf.testzip())
+        self.assertEqual(sorted(zf.namelist()), sorted(self.members))
+        for name in self.members:
+            (data, compress_type) = self.members[name]
+            self.assertEqual(zf.read(name), data)
+            self.assertEqual(zf.getinfo(name).compress_type, compress_type)
+        zf.close()
+
+    def test_raw_member_copy_keeps_compressed_bytes(self):
+        source_zf = zipfile.ZipFile(self.twbx_filename)
+        dest_filename = os.path.join(self.directory, u'copy.zip')
+        dest_zf = zipfile.ZipFile(dest_filename, 'w', allowZip64=True)
+        source_info = source_zf.getinfo(u'Image/logo.png')
+        TableauPackagedFile.copy_zip_member_without_recompressing(source_zf, dest_zf, source_info, chunk_size=1000)
+        dest_zf.close()
+        source_zf.close()
+
+        zf = zipfile.ZipFile(dest_filename)
+        dest_info = zf.getinfo(u'Image/logo.png')
+        self.assertEqual((dest_info.CRC, dest_info.compress_size, dest_info.file_size),
+                         (source_info.CRC, source_info.compress_size, source_info.file_size))
+        self.assertEqual(zf.read(u'Image/logo.png'), self.members[u'Image/logo.png'][0])
+        zf.close()
+
+    def test_zip64_extra_field_is_removed(self):
+        zip64_field = '\x01\x00\x08\x00' + '\x00' * 8
+        other_field = '\x55\x54\x05\x00' + '\x01' * 5
+        self.assertEqual(TableauPackagedFile.remove_zip64_extra_field(other_field + zip64_field + other_field),
+                         other_field + other_field)
+
+
+if __name__ == '__main__':
+    unittest.main()